@@ -0,0 +1,389 @@
+"""
+准入控制：按 API key 限流、按上游自适应并发上限、带优先级的有界等待队列
+
+突发流量在代理处排队或被快速拒绝（429 + Retry-After），而不是变成上游的 429 / 超时
+再被客户端重试放大。
+"""
+import asyncio
+import json
+import math
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from metrics import ADMISSION_QUEUED, ADMISSION_REJECTED_TOTAL
+from tracing import current_trace
+
+# 参与准入控制的路由
+ADMISSION_ROUTES = frozenset({"/v1/chat/completions", "/v1/messages"})
+
+# 优先级从高到低；未通过请求头指定时，流式请求视为 interactive，其余为 batch
+PRIORITIES = ("interactive", "batch")
+PRIORITY_HEADER = b"x-priority"
+
+_STREAM_PATTERN = re.compile(rb'"stream"\s*:\s*true')
+_MAX_TOKENS_PATTERN = re.compile(rb'"max_tokens"\s*:\s*(\d+)')
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，burst 为桶容量"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, amount: float) -> float:
+        """取出 amount 个令牌；不足时不扣减，返回需要等待的秒数（成功返回 0）"""
+        self._refill()
+        # 超过桶容量的单次请求只要求桶是满的，避免永远无法通过
+        amount = min(amount, self.burst)
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return 0.0
+        return (amount - self._tokens) / self.rate if self.rate > 0 else math.inf
+
+    def give_back(self, amount: float) -> None:
+        self._tokens = min(self.burst, self._tokens + amount)
+
+
+class KeyLimiter:
+    """
+    按 API key 的请求数和估算 token 数限流
+
+    rate 为 0 表示不限制对应维度；最多跟踪 max_keys 个 key，超出时淘汰最久未使用的。
+    """
+
+    def __init__(
+        self,
+        request_rate: float,
+        request_burst: float,
+        token_rate: float,
+        token_burst: float,
+        max_keys: int = 10000
+    ):
+        self.request_rate = request_rate
+        self.request_burst = request_burst
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _get(self, key: str) -> tuple:
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = (
+                TokenBucket(self.request_rate, self.request_burst) if self.request_rate > 0 else None,
+                TokenBucket(self.token_rate, self.token_burst) if self.token_rate > 0 else None,
+            )
+            self._buckets[key] = buckets
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return buckets
+
+    def check(self, key: str, tokens: int) -> Optional[float]:
+        """通过时扣减两个桶并返回 None，否则返回建议的等待秒数"""
+        requests, token_bucket = self._get(key)
+        if requests is not None:
+            wait = requests.try_take(1)
+            if wait:
+                return wait
+        if token_bucket is not None:
+            wait = token_bucket.try_take(tokens)
+            if wait:
+                if requests is not None:
+                    requests.give_back(1)
+                return wait
+        return None
+
+
+class AdaptiveLimit:
+    """
+    单个上游的自适应并发上限（AIMD）
+
+    正常响应时加性增长（每个完整窗口 +1）；流式请求的首字节延迟超过基线的 tolerance 倍时
+    按 decrease 乘性收缩，上游返回 429 / 503 或超时时按 backoff 乘性收缩。
+    基线取最近 window 个样本中的最小延迟。
+    """
+
+    def __init__(
+        self,
+        initial: float = 32,
+        minimum: float = 4,
+        maximum: float = 256,
+        tolerance: float = 2.0,
+        decrease: float = 0.9,
+        backoff: float = 0.5,
+        window: int = 200
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.backoff = backoff
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.throttled = 0
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def on_sample(self, latency: Optional[float]) -> None:
+        """请求成功；latency 为流式请求的首字节延迟，非流式请求传 None"""
+        if latency is not None:
+            self._latencies.append(latency)
+            baseline = min(self._latencies)
+            if len(self._latencies) >= 10 and latency > baseline * self.tolerance:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                return
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self) -> None:
+        self.throttled += 1
+        self.limit = max(self.minimum, self.limit * self.backoff)
+
+
+class AdmissionController:
+    """
+    准入控制器
+
+    总并发上限为所有可用上游的自适应上限之和。请求先经过 per-key 限流，
+    有空闲并发时立即放行，否则进入对应优先级的有界队列，释放时总是先唤醒高优先级的请求。
+    队列已满或排队超过 max_wait 时拒绝。
+    """
+
+    def __init__(
+        self,
+        limits: Callable[[], List[AdaptiveLimit]],
+        key_limiter: Optional[KeyLimiter] = None,
+        queue_size: int = 100,
+        max_wait: float = 30.0
+    ):
+        self._limits = limits
+        self.key_limiter = key_limiter
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.inflight = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = {p: deque() for p in PRIORITIES}
+        # 单个请求占用并发槽的平均时长，用于估算 Retry-After
+        self._hold_ewma = 1.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def capacity(self) -> int:
+        return max(1, sum(limit.current for limit in self._limits()))
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _retry_after(self) -> float:
+        return max(1.0, self._hold_ewma * (self.queued() + 1) / self.capacity())
+
+    def _reject(self, reason: str, retry_after: float) -> AdmissionRejected:
+        self.rejected += 1
+        ADMISSION_REJECTED_TOTAL.labels(reason).inc()
+        return AdmissionRejected(reason, retry_after)
+
+    async def acquire(self, key: str, priority: str, tokens: int) -> float:
+        """获取一个并发槽，返回获取时间（传给 release）；未准入时抛出 AdmissionRejected"""
+        if self.key_limiter is not None:
+            wait = self.key_limiter.check(key, tokens)
+            if wait is not None:
+                raise self._reject("key_rate_limit", wait)
+
+        if self.inflight < self.capacity() and not self.queued():
+            self.inflight += 1
+            self.admitted += 1
+            return time.monotonic()
+
+        queue = self._queues[priority]
+        if len(queue) >= self.queue_size:
+            raise self._reject("queue_full", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        ADMISSION_QUEUED.labels(priority).inc()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 已分配到并发槽但调用方超时或被取消，归还
+                self.release(time.monotonic())
+            else:
+                future.cancel()
+                queue.remove(future)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("queue_timeout", self._retry_after()) from None
+            raise
+        finally:
+            ADMISSION_QUEUED.labels(priority).dec()
+        self.admitted += 1
+        return time.monotonic()
+
+    def release(self, acquired_at: float) -> None:
+        self.inflight -= 1
+        self._hold_ewma += 0.1 * (time.monotonic() - acquired_at - self._hold_ewma)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按优先级把空闲的并发槽分配给排队的请求"""
+        capacity = self.capacity()
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self.inflight < capacity:
+                future = queue.popleft()
+                if future.done():
+                    continue
+                self.inflight += 1
+                future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": self.inflight,
+            "capacity": self.capacity(),
+            "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+def _header(scope: dict, name: bytes) -> str:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+def request_credential(scope: dict) -> str:
+    credential = _header(scope, b"x-api-key") or _header(scope, b"authorization")
+    return credential[7:] if credential.startswith("Bearer ") else credential
+
+
+def request_priority(scope: dict, body: bytes) -> str:
+    priority = _header(scope, PRIORITY_HEADER).lower()
+    if priority in PRIORITIES:
+        return priority
+    return "interactive" if _STREAM_PATTERN.search(body) else "batch"
+
+
+def estimate_tokens(body: bytes) -> int:
+    """粗略估算请求消耗的 token：请求体约 4 字节一个 token，加上 max_tokens"""
+    match = _MAX_TOKENS_PATTERN.search(body)
+    return len(body) // 4 + (int(match.group(1)) if match else 0)
+
+
+def rejection_response(path: str, error: AdmissionRejected) -> tuple:
+    """按路由的 API 格式构造 429 响应体，返回 (body, headers)"""
+    message = f"Too many requests ({error.reason}), retry after {math.ceil(error.retry_after)}s"
+    if path == "/v1/messages":
+        payload = {"type": "error", "error": {"type": "rate_limit_error", "message": message}}
+    else:
+        payload = {"error": {"message": message, "type": "rate_limit_exceeded", "code": error.reason}}
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"retry-after", str(math.ceil(error.retry_after)).encode()),
+    ]
+    return json.dumps(payload).encode(), headers
+
+
+class AdmissionMiddleware:
+    """
+    ASGI 中间件：读取完整请求体后申请准入，请求（包括流式响应）结束时释放并发槽
+
+    排队期间监听客户端断开，已放弃的请求不再占用并发槽。
+    请求体读取后原样交给应用，后续的 receive 调用（断开检测）直接转交。
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope.get("path") not in ADMISSION_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        controller = getattr(scope["app"].state, "admission", None) if "app" in scope else None
+        if controller is None:
+            await self.app(scope, receive, send)
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+
+        replayed = False
+
+        async def replay_receive() -> dict:
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        trace = current_trace()
+        queued_at = time.perf_counter()
+        acquire = asyncio.ensure_future(controller.acquire(
+            request_credential(scope), request_priority(scope, body), estimate_tokens(body)
+        ))
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            await asyncio.wait({acquire, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            disconnect.cancel()
+            await self._abandon(controller, acquire)
+            raise
+        if disconnect.done():
+            # 客户端在排队期间断开
+            await self._abandon(controller, acquire)
+            return
+        disconnect.cancel()
+
+        if trace is not None:
+            trace.add("queue", time.perf_counter() - queued_at)
+        try:
+            acquired_at = acquire.result()
+        except AdmissionRejected as e:
+            content, headers = rejection_response(scope["path"], e)
+            await send({"type": "http.response.start", "status": 429, "headers": headers})
+            await send({"type": "http.response.body", "body": content})
+            return
+
+        try:
+            await self.app(scope, replay_receive, send)
+        finally:
+            controller.release(acquired_at)
+
+    @staticmethod
+    async def _abandon(controller: AdmissionController, acquire: asyncio.Future) -> None:
+        """放弃申请：未完成时取消，已分配到并发槽时归还"""
+        if not acquire.done():
+            acquire.cancel()
+        try:
+            acquired_at = await acquire
+        except BaseException:
+            return
+        controller.release(acquired_at)
@@ -5,27 +5,143 @@ import json
 from typing import Any, Dict, List, Optional
 from uuid import uuid4
 
+from message_transformer import ReasoningContentTransformer, ThinkingStreamExtractor
+
+# OpenAI finish_reason -> Anthropic stop_reason
+STOP_REASONS = {
+    "stop": "end_turn",
+    "length": "max_tokens",
+    "tool_calls": "tool_use",
+    "function_call": "tool_use",
+}
+
+# thinking.budget_tokens 低于上限时对应的 reasoning_effort，更大的预算为 high
+REASONING_EFFORT_BUDGETS = ((4096, "low"), (16384, "medium"))
+
+# 上游状态码 -> Anthropic 错误类型
+ERROR_TYPES = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    403: "permission_error",
+    404: "not_found_error",
+    413: "request_too_large",
+    429: "rate_limit_error",
+    529: "overloaded_error",
+}
+
+
+def _tool_result_text(content: Any) -> str:
+    """tool_result 的 content 可以是字符串或 content block 数组"""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+
+def _image_part(block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Anthropic image 块 -> OpenAI image_url 部件（base64 转为 data URL）"""
+    source = block.get("source") or {}
+    if source.get("type") == "base64" and source.get("data"):
+        url = f"data:{source.get('media_type', 'image/png')};base64,{source['data']}"
+    elif source.get("type") == "url" and source.get("url"):
+        url = source["url"]
+    else:
+        return None
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def _reasoning_effort(budget_tokens: int) -> str:
+    """thinking 预算 -> OpenAI 格式的 reasoning_effort 档位"""
+    for limit, effort in REASONING_EFFORT_BUDGETS:
+        if budget_tokens < limit:
+            return effort
+    return "high"
+
+
+def _system_text(system: Any) -> str:
+    if isinstance(system, list):
+        return "\n".join(part.get("text", "") for part in system if part.get("type") == "text")
+    return system or ""
+
+
+def _convert_usage(usage: Dict[str, Any]) -> Dict[str, int]:
+    converted = {
+        "input_tokens": usage.get("prompt_tokens", 0),
+        "output_tokens": usage.get("completion_tokens", 0),
+    }
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached:
+        converted["cache_read_input_tokens"] = cached
+    return converted
+
 
 class AnthropicAdapter:
     """Anthropic <-> OpenAI 格式转换器"""
 
     @staticmethod
     def anthropic_to_openai_messages(anthropic_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """将 Anthropic 消息格式转换为 OpenAI 格式"""
+        """
+        将 Anthropic 消息格式转换为 OpenAI 格式
+
+        thinking 块转为 reasoning_content，tool_use 块转为 tool_calls，image 块转为 image_url 部件
+        （此时 content 为按原顺序排列的 text / image_url 部件数组），
+        tool_result 块拆成独立的 tool 消息（放在同一条消息的其余文本之前）。
+        """
         openai_messages = []
         for msg in anthropic_messages:
             role = msg.get("role", "user")
             content = msg.get("content", "")
 
-            # Anthropic 支持 content 为数组格式，需要转换为字符串
-            if isinstance(content, list):
-                text_parts = []
-                for part in content:
-                    if part.get("type") == "text":
-                        text_parts.append(part.get("text", ""))
-                content = "\n".join(text_parts)
+            if not isinstance(content, list):
+                openai_messages.append({"role": role, "content": content})
+                continue
+
+            text_parts = []
+            # 按原顺序排列的 text / image_url 部件，只在出现图片时使用
+            content_parts: List[Dict[str, Any]] = []
+            has_images = False
+            reasoning_parts = []
+            tool_calls = []
+            has_tool_results = False
+            for part in content:
+                part_type = part.get("type")
+                if part_type == "text":
+                    text_parts.append(part.get("text", ""))
+                    content_parts.append({"type": "text", "text": part.get("text", "")})
+                elif part_type == "image":
+                    image = _image_part(part)
+                    if image is not None:
+                        has_images = True
+                        content_parts.append(image)
+                elif part_type == "thinking":
+                    reasoning_parts.append(part.get("thinking", ""))
+                elif part_type == "tool_use":
+                    tool_calls.append({
+                        "id": part.get("id"),
+                        "type": "function",
+                        "function": {
+                            "name": part.get("name", ""),
+                            "arguments": json.dumps(part.get("input") or {}, ensure_ascii=False),
+                        },
+                    })
+                elif part_type == "tool_result":
+                    # OpenAI 要求 tool 消息紧跟在发起调用的 assistant 消息之后
+                    has_tool_results = True
+                    openai_messages.append({
+                        "role": "tool",
+                        "tool_call_id": part.get("tool_use_id"),
+                        "content": _tool_result_text(part.get("content", "")),
+                    })
 
-            openai_messages.append({"role": role, "content": content})
+            # 只包含 tool_result 的 user 消息不再额外生成空消息
+            if has_tool_results and not (text_parts or has_images or tool_calls or reasoning_parts):
+                continue
+
+            converted = {"role": role, "content": content_parts if has_images else "\n".join(text_parts)}
+            if tool_calls:
+                converted["tool_calls"] = tool_calls
+            if reasoning_parts:
+                converted["reasoning_content"] = "\n".join(reasoning_parts)
+            openai_messages.append(converted)
         return openai_messages
 
     @staticmethod
@@ -44,16 +160,14 @@ class AnthropicAdapter:
 
         # 提取 usage
         if "usage" in openai_response:
-            usage = openai_response["usage"]
-            anthropic_response["usage"] = {
-                "input_tokens": usage.get("prompt_tokens", 0),
-                "output_tokens": usage.get("completion_tokens", 0)
-            }
+            anthropic_response["usage"] = _convert_usage(openai_response["usage"])
 
         # 提取内容
         if "choices" in openai_response and len(openai_response["choices"]) > 0:
             choice = openai_response["choices"][0]
-            message = choice.get("message", {})
+            message = ReasoningContentTransformer.ensure_assistant_message_complete(
+                choice.get("message", {})
+            )
             content = message.get("content", "")
 
             # 处理 reasoning_content
@@ -70,23 +184,38 @@ class AnthropicAdapter:
                     "text": content
                 })
 
+            # 处理 tool_calls
+            for call in message.get("tool_calls") or []:
+                function = call.get("function", {})
+                try:
+                    arguments = json.loads(function.get("arguments") or "{}")
+                except ValueError:
+                    arguments = {}
+                anthropic_response["content"].append({
+                    "type": "tool_use",
+                    "id": call.get("id") or f"toolu_{uuid4().hex[:24]}",
+                    "name": function.get("name", ""),
+                    "input": arguments
+                })
+
             # 处理 stop_reason
             finish_reason = choice.get("finish_reason")
-            if finish_reason == "stop":
-                anthropic_response["stop_reason"] = "end_turn"
-            elif finish_reason == "length":
-                anthropic_response["stop_reason"] = "max_tokens"
+            if finish_reason:
+                anthropic_response["stop_reason"] = STOP_REASONS.get(finish_reason, "end_turn")
 
         return anthropic_response
 
     @staticmethod
     def anthropic_request_to_openai(anthropic_body: Dict[str, Any]) -> Dict[str, Any]:
         """将 Anthropic 请求转换为 OpenAI 请求"""
+        messages = AnthropicAdapter.anthropic_to_openai_messages(anthropic_body.get("messages", []))
+        system = _system_text(anthropic_body.get("system"))
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+
         openai_body = {
             "model": anthropic_body.get("model", "kimi-k2.5"),
-            "messages": AnthropicAdapter.anthropic_to_openai_messages(
-                anthropic_body.get("messages", [])
-            ),
+            "messages": messages,
             "max_tokens": anthropic_body.get("max_tokens", 4096),
         }
 
@@ -97,41 +226,261 @@ class AnthropicAdapter:
             openai_body["top_p"] = anthropic_body["top_p"]
         if "stop_sequences" in anthropic_body:
             openai_body["stop"] = anthropic_body["stop_sequences"]
+
+        # thinking 原样传给上游（Kimi 等兼容接口识别该字段），预算同时映射为 OpenAI 的 reasoning_effort
+        thinking = anthropic_body.get("thinking")
+        if isinstance(thinking, dict):
+            openai_body["thinking"] = thinking
+            budget = thinking.get("budget_tokens")
+            if thinking.get("type") == "enabled" and isinstance(budget, int):
+                openai_body["reasoning_effort"] = _reasoning_effort(budget)
         if "stream" in anthropic_body:
             openai_body["stream"] = anthropic_body["stream"]
+            if anthropic_body["stream"]:
+                # 流的最后一个 chunk 带上 usage，用于 message_delta
+                openai_body["stream_options"] = {"include_usage": True}
+
+        if anthropic_body.get("tools"):
+            openai_body["tools"] = [
+                {
+                    "type": "function",
+                    "function": {
+                        "name": tool.get("name", ""),
+                        "description": tool.get("description", ""),
+                        "parameters": tool.get("input_schema") or {"type": "object", "properties": {}},
+                    },
+                }
+                for tool in anthropic_body["tools"]
+            ]
+        tool_choice = anthropic_body.get("tool_choice")
+        if isinstance(tool_choice, dict):
+            choice_type = tool_choice.get("type")
+            if choice_type == "tool":
+                openai_body["tool_choice"] = {"type": "function", "function": {"name": tool_choice.get("name")}}
+            elif choice_type in ("auto", "none"):
+                openai_body["tool_choice"] = choice_type
+            elif choice_type == "any":
+                openai_body["tool_choice"] = "required"
 
         return openai_body
 
     @staticmethod
-    def openai_chunk_to_anthropic(openai_chunk: Dict[str, Any], model: str) -> Optional[Dict[str, Any]]:
-        """将 OpenAI 流式 chunk 转换为 Anthropic 流式事件"""
-        if "choices" not in openai_chunk or len(openai_chunk["choices"]) == 0:
-            return None
-
-        choice = openai_chunk["choices"][0]
-        delta = choice.get("delta", {})
-
-        # Anthropic 流式事件格式
-        anthropic_event = {
-            "type": "content_block_delta",
-            "index": 0,
-            "delta": {}
+    def error_response(status_code: int, content: bytes) -> Dict[str, Any]:
+        """把上游（OpenAI 格式）的错误响应体转换为 Anthropic 错误格式"""
+        message = content.decode(errors="replace")
+        try:
+            error = json.loads(content).get("error")
+            if isinstance(error, dict):
+                message = error.get("message", message)
+            elif isinstance(error, str):
+                message = error
+        except (ValueError, AttributeError):
+            pass
+        return {
+            "type": "error",
+            "error": {"type": ERROR_TYPES.get(status_code, "api_error"), "message": message},
         }
 
-        # 处理 content
-        content = delta.get("content", "")
+
+def _sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + json.dumps(data, ensure_ascii=False).encode() + b"\n\n"
+
+
+class AnthropicStreamTranslator:
+    """
+    OpenAI 格式 SSE 流 -> Anthropic 事件序列的增量转换器（每个流一个实例）
+
+    接口与 SSERelay 相同（feed / flush），每个完整的上游帧转换后立即输出，不增加缓冲。
+    输出 message_start、各内容块的 content_block_start / delta / stop、
+    带 stop_reason 和 usage 的 message_delta，以及 message_stop。
+    content 中的 <thinking> 标签被增量拆分为 thinking 块。
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.message_id = f"msg_{uuid4().hex[:24]}"
+        self.stop_reason: Optional[str] = None
+        self.usage: Dict[str, int] = {"input_tokens": 0, "output_tokens": 0}
+        self._buffer = b""
+        self._started = False
+        self._finished = False
+        self._index = -1
+        self._block_type: Optional[str] = None
+        # OpenAI tool_call index -> Anthropic 内容块 index
+        self._tool_blocks: Dict[int, int] = {}
+        self._extractor = ThinkingStreamExtractor()
+
+    def feed(self, chunk: bytes) -> bytes:
+        """输入一段上游字节，返回转换后的 Anthropic 事件字节"""
+        data = self._buffer + chunk if self._buffer else chunk
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+
+        cut = data.rfind(b"\n\n")
+        if cut == -1:
+            self._buffer = data
+            return b""
+
+        complete, self._buffer = data[:cut], data[cut + 2:]
+        return b"".join(self._process_frame(frame) for frame in complete.split(b"\n\n"))
+
+    def flush(self) -> bytes:
+        """上游结束时处理残留的帧，并补齐未关闭的块和 message_stop"""
+        data, self._buffer = self._buffer, b""
+        out = self._process_frame(data.strip()) if data.strip() else b""
+        return out + b"".join(self.finish())
+
+    def _process_frame(self, frame: bytes) -> bytes:
+        payload = None
+        for line in frame.split(b"\n"):
+            if line.startswith(b"data:"):
+                payload = line[5:].strip()
+        if payload is None:
+            return b""
+        if payload == b"[DONE]":
+            return b"".join(self.finish())
+
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            return b""
+        if not isinstance(chunk, dict):
+            return b""
+        return b"".join(self.translate(chunk))
+
+    def translate(self, chunk: Dict[str, Any]) -> List[bytes]:
+        """转换一个 OpenAI chunk，返回 Anthropic 事件列表"""
+        if self._finished:
+            return []
+        events = self._start()
+
+        if "error" in chunk:
+            error = chunk["error"]
+            message = error.get("message", "") if isinstance(error, dict) else str(error)
+            events.append(_sse_event("error", {
+                "type": "error", "error": {"type": "api_error", "message": message},
+            }))
+            return events
+
+        if chunk.get("usage"):
+            self.usage.update(_convert_usage(chunk["usage"]))
+
+        for choice in chunk.get("choices") or []:
+            if choice.get("index", 0) != 0:
+                continue
+            delta = choice.get("delta") or {}
+
+            reasoning = delta.get("reasoning_content")
+            if reasoning:
+                # 上游原生返回推理内容，content 开头不会再出现 <thinking>
+                self._extractor.stop()
+                events += self._block_delta("thinking", {"type": "thinking_delta", "thinking": reasoning})
+
+            content = delta.get("content")
+            if content:
+                thinking, content = self._extractor.feed(content)
+                if thinking:
+                    events += self._block_delta("thinking", {"type": "thinking_delta", "thinking": thinking})
+                if content:
+                    events += self._block_delta("text", {"type": "text_delta", "text": content})
+
+            for call in delta.get("tool_calls") or []:
+                events += self._tool_delta(call)
+
+            finish_reason = choice.get("finish_reason")
+            if finish_reason:
+                events += self._flush_extractor()
+                self.stop_reason = STOP_REASONS.get(finish_reason, "end_turn")
+        return events
+
+    def finish(self) -> List[bytes]:
+        """关闭当前内容块，输出 message_delta 和 message_stop（只输出一次）"""
+        if self._finished:
+            return []
+        events = self._start() + self._flush_extractor() + self._close_block()
+        self._finished = True
+        events.append(_sse_event("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": self.stop_reason or "end_turn", "stop_sequence": None},
+            "usage": dict(self.usage),
+        }))
+        events.append(_sse_event("message_stop", {"type": "message_stop"}))
+        return events
+
+    def _start(self) -> List[bytes]:
+        if self._started:
+            return []
+        self._started = True
+        return [_sse_event("message_start", {
+            "type": "message_start",
+            "message": {
+                "id": self.message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": self.model,
+                "content": [],
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": self.usage["input_tokens"], "output_tokens": 0},
+            },
+        })]
+
+    def _flush_extractor(self) -> List[bytes]:
+        thinking, content = self._extractor.flush()
+        events = []
+        if thinking:
+            events += self._block_delta("thinking", {"type": "thinking_delta", "thinking": thinking})
         if content:
-            anthropic_event["delta"] = {"type": "text_delta", "text": content}
-            return anthropic_event
+            events += self._block_delta("text", {"type": "text_delta", "text": content})
+        return events
+
+    def _open_block(self, block_type: str, content_block: Dict[str, Any]) -> List[bytes]:
+        events = self._close_block()
+        self._index += 1
+        self._block_type = block_type
+        events.append(_sse_event("content_block_start", {
+            "type": "content_block_start", "index": self._index, "content_block": content_block,
+        }))
+        return events
+
+    def _close_block(self) -> List[bytes]:
+        if self._block_type is None:
+            return []
+        self._block_type = None
+        return [_sse_event("content_block_stop", {"type": "content_block_stop", "index": self._index})]
 
-        # 处理 reasoning_content
-        reasoning = delta.get("reasoning_content")
-        if reasoning:
-            anthropic_event["delta"] = {"type": "thinking_delta", "thinking": reasoning}
-            return anthropic_event
+    def _block_delta(self, block_type: str, delta: Dict[str, Any]) -> List[bytes]:
+        events = []
+        if self._block_type != block_type:
+            start = {"type": "thinking", "thinking": ""} if block_type == "thinking" else {"type": "text", "text": ""}
+            events = self._open_block(block_type, start)
+        events.append(_sse_event("content_block_delta", {
+            "type": "content_block_delta", "index": self._index, "delta": delta,
+        }))
+        return events
 
-        # 检查是否完成
-        if choice.get("finish_reason"):
-            return {"type": "message_stop"}
+    def _tool_delta(self, call: Dict[str, Any]) -> List[bytes]:
+        """OpenAI 的 tool_calls 按 index 依次流出，每个调用对应一个 tool_use 块"""
+        events = []
+        tool_index = call.get("index", 0)
+        function = call.get("function") or {}
+        if tool_index not in self._tool_blocks:
+            events = self._open_block("tool_use", {
+                "type": "tool_use",
+                "id": call.get("id") or f"toolu_{uuid4().hex[:24]}",
+                "name": function.get("name", ""),
+                "input": {},
+            })
+            self._tool_blocks[tool_index] = self._index
+        elif self._tool_blocks[tool_index] != self._index:
+            # Anthropic 的块关闭后不能再追加内容，交错到达的参数片段无法表示
+            return events
 
-        return None
\ No newline at end of file
+        arguments = function.get("arguments")
+        if arguments:
+            events.append(_sse_event("content_block_delta", {
+                "type": "content_block_delta",
+                "index": self._index,
+                "delta": {"type": "input_json_delta", "partial_json": arguments},
+            }))
+        return events
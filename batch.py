@@ -0,0 +1,437 @@
+"""
+本地批处理：把 JSONL 批次中的请求按并发窗口在进程内走完整的代理流程
+
+每个条目经由应用自身（ASGI）处理，与普通请求一样经过准入控制、消息修复和共享的上游连接池，
+完成一条即以 JSONL 流式返回一条。结果同时追加到磁盘，进程崩溃后以相同的批次 ID 重新提交即可续跑。
+批次绑定创建它的凭证，其他凭证查询或续跑时视为不存在；超过保留期的已结束批次由后台定期清理。
+"""
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import json
+import os
+import re
+import shutil
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+import httpx
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows 无 fcntl，只能在进程内防止重复执行
+    fcntl = None
+
+# 条目可以发往的路由
+BATCH_ROUTES = frozenset({"/v1/messages", "/v1/chat/completions"})
+# 转发给条目请求的客户端请求头
+FORWARDED_HEADERS = ("authorization", "x-api-key", "anthropic-version")
+# 这些状态码的结果在续跑时重新执行
+RETRY_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504, 529})
+
+_BATCH_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class BatchError(Exception):
+    """批次无法执行（格式错误、ID 冲突等），status_code 为返回给客户端的状态码"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_items(data: bytes, max_items: int) -> List[Dict[str, Any]]:
+    """
+    解析 JSONL 批次，每行为 {"custom_id": ..., "params": {...}}（Anthropic 风格）
+    或 {"custom_id": ..., "url": "/v1/chat/completions", "body": {...}}（OpenAI 风格）
+    返回 [{"custom_id", "url", "body"}]
+    """
+    items = []
+    seen: Set[str] = set()
+    for number, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise BatchError(f"line {number}: invalid JSON")
+        body = entry.get("params", entry.get("body")) if isinstance(entry, dict) else None
+        if not isinstance(body, dict):
+            raise BatchError(f"line {number}: expected an object with params or body")
+        url = entry.get("url") or "/v1/messages"
+        if url not in BATCH_ROUTES:
+            raise BatchError(f"line {number}: unsupported url {url}")
+        custom_id = str(entry.get("custom_id") or f"item-{number}")
+        if custom_id in seen:
+            raise BatchError(f"line {number}: duplicate custom_id {custom_id}")
+        seen.add(custom_id)
+        items.append({"custom_id": custom_id, "url": url, "body": body})
+        if len(items) > max_items:
+            raise BatchError(f"batch exceeds {max_items} items", 413)
+    if not items:
+        raise BatchError("empty batch")
+    return items
+
+
+def owner_digest(headers: Any) -> str:
+    """批次所有者：请求凭证（x-api-key 或 Authorization）的 SHA-256，磁盘上不保存凭证原文"""
+    credential = headers.get("x-api-key") or headers.get("authorization") or ""
+    if credential.startswith("Bearer "):
+        credential = credential[7:]
+    return hashlib.sha256(credential.encode()).hexdigest()
+
+
+def _release_opened(opening: "asyncio.Future[Any]") -> None:
+    if not opening.cancelled() and opening.exception() is None:
+        os.close(opening.result()[0])
+
+
+def _done(record: Dict[str, Any]) -> bool:
+    """结果是否为最终结果（续跑时不再执行）"""
+    response = record.get("response")
+    return isinstance(response, dict) and response.get("status_code") not in RETRY_STATUS_CODES
+
+
+class BatchRunner:
+    """
+    批次执行器（每个 worker 一个实例）
+
+    directory 下每个批次一个子目录：input.jsonl 为规范化后的条目，results.jsonl 为按完成顺序追加的结果，
+    owner 为创建者凭证的摘要。
+    concurrency 为单个批次的并发窗口；批次在后台任务中运行，客户端断开后继续执行直到完成。
+    运行中的批次对其目录持有 flock，多个 worker（或多个进程）不会同时执行同一批次。
+    retention 为已结束批次的保留秒数（按最后一次写入结果计算，0 为不清理），每 sweep_interval 秒清理一次。
+    文件读写都在线程池中进行，不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        directory: str = "batches",
+        concurrency: int = 8,
+        max_items: int = 10000,
+        retention: float = 0,
+        sweep_interval: float = 3600
+    ):
+        self.directory = directory
+        self.concurrency = max(concurrency, 1)
+        self.max_items = max_items
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        # 进程内直接调用应用本身，不经过网络
+        self._client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://batch", timeout=None
+        )
+        self._running: Dict[str, asyncio.Task] = {}
+        # 批次 ID -> 正在读取结果流的客户端队列，客户端断开后移除，不再写入
+        self._listeners: Dict[str, "asyncio.Queue[Optional[bytes]]"] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.completed = 0
+        self.failed = 0
+        self.swept = 0
+
+    def start(self) -> None:
+        """启动定期清理过期批次的后台任务"""
+        if self.retention > 0:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+
+    async def aclose(self) -> None:
+        tasks = list(self._running.values())
+        if self._sweeper is not None:
+            tasks.append(self._sweeper)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await self._client.aclose()
+
+    def _paths(self, batch_id: str) -> Tuple[str, str]:
+        path = os.path.join(self.directory, batch_id)
+        return os.path.join(path, "input.jsonl"), os.path.join(path, "results.jsonl")
+
+    def _owned(self, batch_id: str, owner: str) -> bool:
+        """批次由 owner 创建；没有 owner 文件的批次不属于任何人"""
+        try:
+            with open(os.path.join(self.directory, batch_id, "owner"), encoding="ascii") as f:
+                return hmac.compare_digest(f.read().strip(), owner)
+        except (OSError, UnicodeDecodeError):
+            return False
+
+    def load_results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        """读取已保存的结果，同一条目以最后一条记录为准"""
+        _, results_path = self._paths(batch_id)
+        results: Dict[str, Dict[str, Any]] = {}
+        if not os.path.exists(results_path):
+            return results
+        with open(results_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的行
+                results[record.get("custom_id")] = record
+        return results
+
+    def _lock(self, batch_id: str) -> Optional[int]:
+        """对批次目录加非阻塞排他锁，返回持有锁的文件描述符（关闭即释放）；已被其他执行者持有时返回 None"""
+        path = os.path.join(self.directory, batch_id)
+        os.makedirs(path, exist_ok=True)
+        fd = os.open(path, os.O_RDONLY)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _load_items(self, batch_id: str, data: bytes, owner: str) -> List[Dict[str, Any]]:
+        input_path, _ = self._paths(batch_id)
+        if os.path.exists(input_path):
+            with open(input_path, "rb") as f:
+                return parse_items(f.read(), self.max_items)
+
+        items = parse_items(data, self.max_items)
+        # 先写 owner 再写 input：input 存在即表示批次已创建，且一定有所有者
+        with open(os.path.join(os.path.dirname(input_path), "owner"), "w", encoding="ascii") as f:
+            f.write(owner)
+        tmp_path = input_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, input_path)
+        return items
+
+    def _open(
+        self,
+        batch_id: str,
+        data: bytes,
+        owner: str
+    ) -> Tuple[int, List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """加锁并载入批次的条目和已保存的结果（在线程池中执行），返回 (锁, 条目, 结果)"""
+        input_path, _ = self._paths(batch_id)
+        if os.path.exists(input_path) and not self._owned(batch_id, owner):
+            # 与不存在的批次无法区分，不向其他凭证泄露批次 ID 是否被占用
+            raise BatchError(f"batch {batch_id} not found", 404)
+        lock = self._lock(batch_id)
+        if lock is None:
+            raise BatchError(f"batch {batch_id} is already running", 409)
+
+        try:
+            items = self._load_items(batch_id, data, owner)
+            return lock, items, self.load_results(batch_id)
+        except BaseException:
+            os.close(lock)
+            if not os.path.exists(input_path):
+                shutil.rmtree(os.path.dirname(input_path), ignore_errors=True)
+            raise
+
+    async def prepare(
+        self,
+        batch_id: Optional[str],
+        data: bytes,
+        headers: Dict[str, str]
+    ) -> Tuple[str, AsyncIterator[bytes]]:
+        """
+        新建批次或载入已有批次（已有批次忽略新提交的内容），并立即在后台开始执行尚未完成的条目
+        返回 (批次 ID, 结果流)；结果流先产出之前已完成的结果，再按完成顺序产出本次执行的结果
+        批次属于 headers 中凭证以外的所有者时按不存在处理（404）
+        """
+        if batch_id is None:
+            batch_id = f"batch_{uuid4().hex[:24]}"
+        elif not _BATCH_ID_PATTERN.match(batch_id):
+            raise BatchError("invalid batch id")
+        owner = owner_digest(headers)
+        if batch_id in self._running:
+            if not await asyncio.to_thread(self._owned, batch_id, owner):
+                raise BatchError(f"batch {batch_id} not found", 404)
+            raise BatchError(f"batch {batch_id} is already running", 409)
+
+        opening = asyncio.ensure_future(asyncio.to_thread(self._open, batch_id, data, owner))
+        try:
+            lock, items, previous = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # 线程中的 _open 无法中断，完成后归还它取得的锁
+            opening.add_done_callback(_release_opened)
+            raise
+        replay = [
+            json.dumps(previous[item["custom_id"]], ensure_ascii=False).encode() + b"\n"
+            for item in items
+            if _done(previous.get(item["custom_id"], {}))
+        ]
+        pending = [item for item in items if not _done(previous.get(item["custom_id"], {}))]
+        if not pending:
+            os.close(lock)
+            return batch_id, self._stream(batch_id, replay, None)
+
+        if previous:
+            print(f"[Proxy] Resuming batch {batch_id}: {len(pending)}/{len(items)} items left")
+        # 在返回响应之前登记并启动，客户端是否读取结果流都不影响执行
+        outbox: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue()
+        self._listeners[batch_id] = outbox
+        task = asyncio.create_task(self._execute(batch_id, pending, headers))
+        self._running[batch_id] = task
+
+        def finished(_: asyncio.Task) -> None:
+            self._running.pop(batch_id, None)
+            os.close(lock)
+
+        task.add_done_callback(finished)
+        return batch_id, self._stream(batch_id, replay, outbox)
+
+    async def _stream(
+        self,
+        batch_id: str,
+        replay: List[bytes],
+        outbox: "Optional[asyncio.Queue[Optional[bytes]]]"
+    ) -> AsyncIterator[bytes]:
+        """
+        客户端断开时生成器被关闭，队列随之注销，后台任务继续执行，结果仍会写入磁盘
+        """
+        try:
+            for line in replay:
+                yield line
+            while outbox is not None:
+                line = await outbox.get()
+                if line is None:
+                    break
+                yield line
+        finally:
+            if outbox is not None and self._listeners.get(batch_id) is outbox:
+                del self._listeners[batch_id]
+
+    def _publish(self, batch_id: str, line: Optional[bytes]) -> None:
+        outbox = self._listeners.get(batch_id)
+        if outbox is not None:
+            outbox.put_nowait(line)
+
+    async def _execute(
+        self,
+        batch_id: str,
+        items: List[Dict[str, Any]],
+        headers: Dict[str, str]
+    ) -> None:
+        _, results_path = self._paths(batch_id)
+        queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        # 不带缓冲区：每行一次 write 系统调用，崩溃时最多丢失正在写的一行
+        with open(results_path, "ab", buffering=0) as results:
+            async def worker() -> None:
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    line = json.dumps(await self._send(item, headers), ensure_ascii=False).encode() + b"\n"
+                    await asyncio.to_thread(results.write, line)
+                    self._publish(batch_id, line)
+
+            try:
+                await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(items)))))
+            finally:
+                self._publish(batch_id, None)
+                self._listeners.pop(batch_id, None)
+
+    async def _send(self, item: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+        # 条目结果以完整 JSON 返回，强制非流式（thinking 模式由代理在上游侧流式聚合）
+        body = dict(item["body"], stream=False)
+        try:
+            response = await self._client.post(item["url"], json=body, headers=headers)
+        except Exception as e:
+            self.failed += 1
+            return {"custom_id": item["custom_id"], "error": {"message": str(e)}}
+
+        try:
+            content: Any = response.json()
+        except ValueError:
+            content = response.text
+        if response.status_code in RETRY_STATUS_CODES:
+            self.failed += 1
+        else:
+            self.completed += 1
+        return {"custom_id": item["custom_id"], "response": {"status_code": response.status_code, "body": content}}
+
+    def status(self, batch_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """批次进度；批次不存在或不属于 owner 时返回 None（文件读取，在线程池中调用）"""
+        input_path, _ = self._paths(batch_id)
+        if not _BATCH_ID_PATTERN.match(batch_id) or not os.path.exists(input_path):
+            return None
+        if not self._owned(batch_id, owner):
+            return None
+        with open(input_path, "rb") as f:
+            total = sum(1 for line in f if line.strip())
+        results = self.load_results(batch_id)
+        return {
+            "id": batch_id,
+            "running": self._is_running(batch_id),
+            "total": total,
+            "completed": sum(1 for record in results.values() if _done(record)),
+            "failed": sum(1 for record in results.values() if not _done(record)),
+        }
+
+    def _is_running(self, batch_id: str) -> bool:
+        """本 worker 或其他进程正在执行该批次"""
+        if batch_id in self._running:
+            return True
+        lock = self._lock(batch_id)
+        if lock is None:
+            return True
+        os.close(lock)
+        return False
+
+    def sweep(self) -> int:
+        """删除超过保留期且未在执行的批次目录，返回删除的批次数（文件操作，在线程池中调用）"""
+        if self.retention <= 0 or not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - self.retention
+        removed = 0
+        for batch_id in os.listdir(self.directory):
+            path = os.path.join(self.directory, batch_id)
+            if batch_id in self._running or not _BATCH_ID_PATTERN.match(batch_id) or not os.path.isdir(path):
+                continue
+            _, results_path = self._paths(batch_id)
+            try:
+                updated = os.path.getmtime(results_path if os.path.exists(results_path) else path)
+            except OSError:
+                continue
+            if updated > cutoff:
+                continue
+            # 持有锁期间删除，其他 worker 不会同时续跑该批次
+            lock = self._lock(batch_id)
+            if lock is None:
+                continue
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                os.close(lock)
+            removed += 1
+        if removed:
+            self.swept += removed
+            print(f"[Proxy] Removed {removed} expired batch(es) from {self.directory}")
+        return removed
+
+    async def _sweep_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as e:
+                print(f"[Proxy] Batch sweep failed: {e!r}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "swept": self.swept,
+        }
+
+
+def forwarded_headers(headers: Any) -> Dict[str, str]:
+    """条目请求携带批次请求的凭证，并标记为 batch 优先级"""
+    forwarded = {name: headers[name] for name in FORWARDED_HEADERS if name in headers}
+    forwarded["x-priority"] = "batch"
+    return forwarded
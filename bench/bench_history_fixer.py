@@ -0,0 +1,90 @@
+"""
+消息历史修复的基准测试：对比全量修复与增量前缀记忆修复在长会话中的单次请求耗时
+incremental 按 freeze 计算消息哈希；raw spans 使用 RawJSONBody 解析时算好的原文片段哈希（代理的实际路径），
+两者中与历史长度线性相关的部分都只剩前缀哈希
+
+用法: python bench/bench_history_fixer.py [--turns 400] [--step 50]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_transformer import IncrementalHistoryFixer, MessageHashes, ReasoningContentTransformer
+from raw_body import RawJSONBody
+
+
+def build_turn(index: int):
+    """一轮工具调用：带 <thinking> 的 assistant 消息 + 工具结果"""
+    thinking = "step %d: " % index + "reasoning about the tool output " * 40
+    return [
+        {
+            "role": "assistant",
+            "content": "<thinking>%s</thinking>Calling tool %d" % (thinking, index),
+            "tool_calls": [{
+                "id": "call_%d" % index,
+                "type": "function",
+                "function": {"name": "search", "arguments": json.dumps({"q": "query %d" % index})},
+            }],
+        },
+        {"role": "tool", "tool_call_id": "call_%d" % index, "content": "result " * 200},
+    ]
+
+
+def time_call(fn, payload: str, repeat: int) -> float:
+    """每次调用前重新解析请求体，模拟每个请求都是新的 dict"""
+    total = 0.0
+    for _ in range(repeat):
+        messages = json.loads(payload)
+        start = time.perf_counter()
+        fn(messages)
+        total += time.perf_counter() - start
+    return total / repeat * 1000
+
+
+def time_raw(fixer: IncrementalHistoryFixer, payload: str, repeat: int) -> float:
+    """请求体由 RawJSONBody 解析（不计时），修复时使用原文片段哈希"""
+    raw = json.dumps({"messages": json.loads(payload)}).encode()
+    total = 0.0
+    for _ in range(repeat):
+        body = RawJSONBody(raw)
+        start = time.perf_counter()
+        fixer.fix(body["messages"], MessageHashes(body))
+        total += time.perf_counter() - start
+    return total / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=400)
+    parser.add_argument("--step", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_message)
+    raw_fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_message)
+    history = [{"role": "system", "content": "You are a helpful agent."},
+               {"role": "user", "content": "Investigate the issue."}]
+
+    print(f"{'turns':>6} {'messages':>9} {'full fix (ms)':>14} {'incremental (ms)':>17} {'raw spans (ms)':>15}")
+    for turn in range(1, args.turns + 1):
+        history.extend(build_turn(turn))
+        payload = json.dumps(history)
+        if turn % args.step:
+            # 会话中的每一轮都经过增量修复器，保持其前缀缓存与真实流量一致
+            fixer.fix(json.loads(payload))
+            body = RawJSONBody(json.dumps({"messages": history}).encode())
+            raw_fixer.fix(body["messages"], MessageHashes(body))
+            continue
+
+        full = time_call(ReasoningContentTransformer.fix_messages, payload, args.repeat)
+        incremental = time_call(fixer.fix, payload, args.repeat)
+        raw_spans = time_raw(raw_fixer, payload, args.repeat)
+        print(f"{turn:>6} {len(history):>9} {full:>14.3f} {incremental:>17.3f} {raw_spans:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
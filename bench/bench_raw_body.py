@@ -0,0 +1,91 @@
+"""
+请求体改写的基准测试：对比 json.loads + 修复 + json.dumps 与 RawJSONBody 拼接改写的耗时和峰值内存
+请求体包含长工具调用历史和 base64 图片，只有最后一条 assistant 消息需要修复
+
+用法: python bench/bench_raw_body.py [--turns 200] [--image-kb 512] [--images 4]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_transformer import IncrementalHistoryFixer, ReasoningContentTransformer
+from raw_body import RawJSONBody
+
+
+def build_body(turns: int, image_kb: int, images: int) -> bytes:
+    image = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+    messages = [{"role": "user", "content": [
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image}}
+        for _ in range(images)
+    ] + [{"type": "text", "text": "Investigate the screenshots."}]}]
+    for index in range(turns):
+        messages.append({"role": "assistant", "content": [
+            {"type": "thinking", "thinking": "reasoning " * 40},
+            {"type": "tool_use", "id": "toolu_%d" % index, "name": "search", "input": {"q": index}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": "toolu_%d" % index, "content": "result " * 200},
+        ]})
+    # 最后一条工具调用缺少 thinking，需要修复
+    messages.append({"role": "assistant", "content": [
+        {"type": "tool_use", "id": "toolu_last", "name": "search", "input": {}},
+    ]})
+    return json.dumps({"model": "kimi", "max_tokens": 4096, "stream": True, "messages": messages}).encode()
+
+
+def full_rewrite(raw: bytes, fixer: IncrementalHistoryFixer) -> bytes:
+    body = json.loads(raw)
+    body["messages"] = fixer.fix(body["messages"])
+    return json.dumps(body, ensure_ascii=False).encode()
+
+
+def splice_rewrite(raw: bytes, fixer: IncrementalHistoryFixer) -> bytes:
+    body = RawJSONBody(raw)
+    body["messages"] = fixer.fix(body["messages"])
+    return body.to_bytes()
+
+
+def measure(fn, raw: bytes, repeat: int):
+    fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_anthropic_message)
+    fn(raw, fixer)  # 预热前缀缓存，模拟多轮对话中的后续请求
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(raw, fixer)
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+
+    tracemalloc.start()
+    fn(raw, fixer)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--image-kb", type=int, default=512)
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    raw = build_body(args.turns, args.image_kb, args.images)
+    print(f"body: {len(raw) / 1024 / 1024:.1f} MiB, {args.turns * 2 + 2} messages")
+    print(f"{'':>8} {'time (ms)':>10} {'peak (MiB)':>11}")
+
+    results = {}
+    for name, fn in (("full", full_rewrite), ("splice", splice_rewrite)):
+        elapsed, peak, out = measure(fn, raw, args.repeat)
+        results[name] = out
+        print(f"{name:>8} {elapsed:>10.2f} {peak:>11.1f}")
+
+    assert json.loads(results["full"]) == json.loads(results["splice"])
+
+
+if __name__ == "__main__":
+    main()
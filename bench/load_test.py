@@ -0,0 +1,268 @@
+"""
+代理自身开销的压测（无需网络）
+
+启动本地模拟上游与代理进程，先直连模拟上游、再经过代理发送相同的负载，报告：
+吞吐、首字节与总耗时的 p50/p99、代理相对直连增加的延迟、每个请求的代理 CPU 时间和代理进程 RSS
+
+用法:
+  python bench/load_test.py --route /v1/messages --stream --concurrency 32 --requests 500
+  python bench/load_test.py --replay requests.jsonl --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_upstream import add_mock_arguments  # noqa: E402
+
+# 代理路由 -> 模拟上游路径（用于直连基线）
+UPSTREAM_PATHS = {
+    "/v1/chat/completions": "/chat/completions",
+    "/v1/messages": "/v1/messages",
+}
+
+BENCH_HEADERS = {
+    "Authorization": "Bearer bench",
+    "x-api-key": "bench",
+    "Content-Type": "application/json",
+}
+
+Workload = List[Tuple[str, Dict[str, Any]]]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+def process_usage(pid: int) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+    """读取 /proc 中的 (CPU 秒数, 当前 RSS KB, 峰值 RSS KB)，非 Linux 返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss = hwm = None
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    hwm = int(line.split()[1])
+        return cpu, rss, hwm
+    except (OSError, IndexError, ValueError):
+        return None, None, None
+
+
+def build_workload(args: argparse.Namespace) -> Workload:
+    if args.replay:
+        return load_replay(args.replay, args.requests)
+
+    history = [{"role": "user", "content": "Hello " * 50}]
+    for turn in range(args.history_turns):
+        if args.route == "/v1/messages":
+            history.append({"role": "assistant", "content": [
+                {"type": "text", "text": "Calling tool %d" % turn},
+                {"type": "tool_use", "id": "toolu_%d" % turn, "name": "search", "input": {"q": turn}},
+            ]})
+            history.append({"role": "user", "content": [
+                {"type": "tool_result", "tool_use_id": "toolu_%d" % turn, "content": "result " * 100},
+            ]})
+        else:
+            history.append({
+                "role": "assistant",
+                "content": "<thinking>step %d</thinking>Calling tool" % turn,
+                "tool_calls": [{"id": "call_%d" % turn, "type": "function",
+                                "function": {"name": "search", "arguments": "{}"}}],
+            })
+            history.append({"role": "tool", "tool_call_id": "call_%d" % turn, "content": "result " * 100})
+
+    body = {"model": "mock", "max_tokens": 1024, "stream": args.stream, "messages": history}
+    return [(args.route, body)] * args.requests
+
+
+def load_replay(path: str, limit: int) -> Workload:
+    """读取录制的流量：每行一个包含 path 与 body 的 JSON 对象，其余行忽略"""
+    workload: Workload = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            route = record.get("path")
+            body = record.get("body")
+            if route in UPSTREAM_PATHS and isinstance(body, dict):
+                workload.append((route, body))
+    if not workload:
+        raise SystemExit(f"no replayable records (with path and body) in {path}")
+    if limit:
+        workload = (workload * (limit // len(workload) + 1))[:limit]
+    return workload
+
+
+async def run_one(client: httpx.AsyncClient, url: str, body: Dict[str, Any]) -> Tuple[bool, float, float]:
+    start = time.perf_counter()
+    ttfb = None
+    async with client.stream("POST", url, json=body, headers=BENCH_HEADERS) as response:
+        async for chunk in response.aiter_raw():
+            if ttfb is None and chunk:
+                ttfb = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return response.status_code == 200, ttfb if ttfb is not None else total, total
+
+
+async def drive(base_url: str, workload: Workload, concurrency: int, direct: bool) -> Dict[str, Any]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in workload:
+        queue.put_nowait(item)
+
+    ttfbs: List[float] = []
+    totals: List[float] = []
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        while not queue.empty():
+            route, body = queue.get_nowait()
+            path = UPSTREAM_PATHS[route] if direct else route
+            try:
+                ok, ttfb, total = await run_one(client, base_url + path, body)
+            except httpx.HTTPError:
+                ok, ttfb, total = False, 0.0, 0.0
+            if not ok:
+                errors += 1
+                continue
+            ttfbs.append(ttfb)
+            totals.append(total)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300.0, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return {"elapsed": elapsed, "ttfb": sorted(ttfbs), "total": sorted(totals), "errors": errors}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def report(baseline: Dict[str, Any], proxied: Dict[str, Any], requests: int,
+           cpu: Optional[float], rss: Optional[int], hwm: Optional[int]) -> None:
+    print(f"{'':>10} {'req/s':>9} {'ttfb p50':>10} {'ttfb p99':>10} {'total p50':>10} {'total p99':>10} {'errors':>7}")
+    for name, result in (("direct", baseline), ("proxy", proxied)):
+        ok = len(result["total"])
+        print(f"{name:>10} {ok / result['elapsed']:>9.1f}"
+              f" {percentile(result['ttfb'], 50) * 1000:>9.1f}ms {percentile(result['ttfb'], 99) * 1000:>9.1f}ms"
+              f" {percentile(result['total'], 50) * 1000:>9.1f}ms {percentile(result['total'], 99) * 1000:>9.1f}ms"
+              f" {result['errors']:>7}")
+
+    print(f"{'added':>10} {'':>9}", end="")
+    for key in ("ttfb", "total"):
+        for pct in (50, 99):
+            added = percentile(proxied[key], pct) - percentile(baseline[key], pct)
+            print(f" {added * 1000:>9.1f}ms", end="")
+    print()
+
+    if cpu is not None:
+        print(f"proxy CPU: {cpu:.2f}s total, {cpu / requests * 1000:.2f}ms per request")
+    if rss is not None:
+        print(f"proxy RSS: {rss / 1024:.1f} MiB (peak {hwm / 1024:.1f} MiB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--route", choices=sorted(UPSTREAM_PATHS), default="/v1/messages")
+    parser.add_argument("--stream", action="store_true", help="发送流式请求")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--history-turns", type=int, default=20, help="生成的请求中工具调用历史的轮数")
+    parser.add_argument("--replay", help="回放录制流量的 JSONL 文件（每行含 path 与 body）")
+    parser.add_argument("--workers", type=int, default=1, help="代理的 uvicorn worker 数")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    workload = build_workload(args)
+    mock_port = free_port()
+    proxy_port = free_port()
+
+    mock_cmd = [
+        sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"),
+        "--port", str(mock_port),
+        "--ttfb", str(args.ttfb),
+        "--tokens-per-sec", str(args.tokens_per_sec),
+        "--tokens", str(args.tokens),
+        "--chunk-tokens", str(args.chunk_tokens),
+        "--thinking", args.thinking,
+        "--thinking-ratio", str(args.thinking_ratio),
+    ]
+    proxy_env = dict(os.environ)
+    proxy_env["UPSTREAMS"] = json.dumps([{
+        "url": f"http://127.0.0.1:{mock_port}",
+        "proxy": None,
+        "http2": False,
+        "max_connections": max(100, args.concurrency * 2),
+        "max_keepalive_connections": max(20, args.concurrency * 2),
+    }])
+    proxy_cmd = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(proxy_port),
+        "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+    ]
+
+    mock = subprocess.Popen(mock_cmd, cwd=REPO_DIR)
+    proxy = subprocess.Popen(proxy_cmd, cwd=REPO_DIR, env=proxy_env,
+                             stdout=subprocess.DEVNULL)
+    try:
+        wait_ready(f"http://127.0.0.1:{mock_port}/health")
+        wait_ready(f"http://127.0.0.1:{proxy_port}/health")
+
+        print(f"{len(workload)} requests, concurrency {args.concurrency}, "
+              f"ttfb {args.ttfb}s, {args.tokens} tokens @ {args.tokens_per_sec}/s, thinking={args.thinking}")
+        baseline = asyncio.run(drive(f"http://127.0.0.1:{mock_port}", workload, args.concurrency, direct=True))
+
+        cpu_before, _, _ = process_usage(proxy.pid)
+        proxied = asyncio.run(drive(f"http://127.0.0.1:{proxy_port}", workload, args.concurrency, direct=False))
+        cpu_after, rss, hwm = process_usage(proxy.pid)
+
+        cpu = cpu_after - cpu_before if cpu_before is not None and args.workers == 1 else None
+        report(baseline, proxied, len(workload), cpu, rss if args.workers == 1 else None, hwm)
+    finally:
+        for process in (proxy, mock):
+            process.terminate()
+        for process in (proxy, mock):
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+本地模拟上游：同时提供 OpenAI (/chat/completions) 与 Anthropic (/v1/messages) 接口
+支持 SSE 流式和非流式响应，可配置首字节延迟、token 速率、每个 chunk 的 token 数和 <thinking> 模式
+
+用法: python bench/mock_upstream.py --port 9100 --ttfb 0.2 --tokens-per-sec 500 --thinking tags
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import AsyncIterator, List, Tuple
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# thinking 模式：
+#   none  - 没有推理内容
+#   field - 推理内容放在 reasoning_content / thinking_delta 中
+#   tags  - 推理内容以 <thinking> 标签混在 content 中，标签可能在任意位置被 chunk 切断
+THINKING_MODES = ("none", "field", "tags")
+
+
+class MockSettings:
+    def __init__(
+        self,
+        ttfb: float = 0.1,
+        tokens_per_sec: float = 500.0,
+        tokens: int = 200,
+        chunk_tokens: int = 1,
+        thinking: str = "tags",
+        thinking_ratio: float = 0.5
+    ):
+        self.ttfb = ttfb
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.chunk_tokens = chunk_tokens
+        self.thinking = thinking
+        self.thinking_ratio = thinking_ratio
+
+
+def _split_tokens(settings: MockSettings) -> Tuple[List[str], List[str]]:
+    """生成 (推理 token, 回答 token)"""
+    thinking_count = int(settings.tokens * settings.thinking_ratio) if settings.thinking != "none" else 0
+    reasoning = ["think%d " % i for i in range(thinking_count)]
+    answer = ["word%d " % i for i in range(settings.tokens - thinking_count)]
+    return reasoning, answer
+
+
+def _tagged_pieces(reasoning: List[str], answer: List[str], chunk_tokens: int) -> List[str]:
+    """把带标签的完整文本切成 chunk，切点随机落在标签内部"""
+    text = "<thinking>" + "".join(reasoning) + "</thinking>" + "".join(answer)
+    pieces = []
+    pos = 0
+    average = max(1, len(text) // max(1, len(reasoning) + len(answer)) * chunk_tokens)
+    while pos < len(text):
+        size = random.randint(1, average * 2)
+        pieces.append(text[pos:pos + size])
+        pos += size
+    return pieces
+
+
+def _chunks(tokens: List[str], chunk_tokens: int) -> List[str]:
+    return ["".join(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+
+async def _paced(settings: MockSettings, items: List[bytes]) -> AsyncIterator[bytes]:
+    """按配置的首字节延迟和 token 速率输出"""
+    await asyncio.sleep(settings.ttfb)
+    interval = settings.chunk_tokens / settings.tokens_per_sec if settings.tokens_per_sec > 0 else 0
+    next_at = time.monotonic()
+    for item in items:
+        yield item
+        if interval:
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+def _openai_frames(settings: MockSettings, model: str) -> List[bytes]:
+    reasoning, answer = _split_tokens(settings)
+    base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model}
+    deltas = [{"role": "assistant", "content": ""}]
+    if settings.thinking == "tags":
+        deltas += [{"content": piece} for piece in _tagged_pieces(reasoning, answer, settings.chunk_tokens)]
+    else:
+        deltas += [{"reasoning_content": piece} for piece in _chunks(reasoning, settings.chunk_tokens)]
+        deltas += [{"content": piece} for piece in _chunks(answer, settings.chunk_tokens)]
+
+    frames = [
+        b"data: " + json.dumps(dict(base, choices=[{"index": 0, "delta": delta}])).encode() + b"\n\n"
+        for delta in deltas
+    ]
+    final = dict(
+        base,
+        choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        usage={"prompt_tokens": 10, "completion_tokens": settings.tokens, "total_tokens": settings.tokens + 10}
+    )
+    frames.append(b"data: " + json.dumps(final).encode() + b"\n\n")
+    frames.append(b"data: [DONE]\n\n")
+    return frames
+
+
+def _anthropic_event(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + json.dumps(data).encode() + b"\n\n"
+
+
+def _anthropic_frames(settings: MockSettings, model: str) -> List[bytes]:
+    reasoning, answer = _split_tokens(settings)
+    frames = [_anthropic_event("message_start", {
+        "type": "message_start",
+        "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model,
+            "content": [], "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 1},
+        },
+    })]
+
+    blocks = []
+    if settings.thinking == "tags":
+        blocks.append(("text", _tagged_pieces(reasoning, answer, settings.chunk_tokens)))
+    else:
+        if reasoning:
+            blocks.append(("thinking", _chunks(reasoning, settings.chunk_tokens)))
+        blocks.append(("text", _chunks(answer, settings.chunk_tokens)))
+
+    for index, (kind, pieces) in enumerate(blocks):
+        start_block = {"type": "thinking", "thinking": ""} if kind == "thinking" else {"type": "text", "text": ""}
+        frames.append(_anthropic_event("content_block_start", {
+            "type": "content_block_start", "index": index, "content_block": start_block,
+        }))
+        for piece in pieces:
+            delta = ({"type": "thinking_delta", "thinking": piece} if kind == "thinking"
+                     else {"type": "text_delta", "text": piece})
+            frames.append(_anthropic_event("content_block_delta", {
+                "type": "content_block_delta", "index": index, "delta": delta,
+            }))
+        frames.append(_anthropic_event("content_block_stop", {"type": "content_block_stop", "index": index}))
+
+    frames.append(_anthropic_event("message_delta", {
+        "type": "message_delta",
+        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+        "usage": {"output_tokens": settings.tokens},
+    }))
+    frames.append(_anthropic_event("message_stop", {"type": "message_stop"}))
+    return frames
+
+
+def _openai_message(settings: MockSettings, model: str) -> dict:
+    reasoning, answer = _split_tokens(settings)
+    message = {"role": "assistant", "content": "".join(answer)}
+    if settings.thinking == "tags":
+        message["content"] = "<thinking>" + "".join(reasoning) + "</thinking>" + message["content"]
+    elif reasoning:
+        message["reasoning_content"] = "".join(reasoning)
+    return {
+        "id": "chatcmpl-mock", "object": "chat.completion", "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": settings.tokens, "total_tokens": settings.tokens + 10},
+    }
+
+
+def _anthropic_message(settings: MockSettings, model: str) -> dict:
+    reasoning, answer = _split_tokens(settings)
+    content = []
+    if reasoning and settings.thinking == "field":
+        content.append({"type": "thinking", "thinking": "".join(reasoning)})
+    text = "".join(answer)
+    if settings.thinking == "tags":
+        text = "<thinking>" + "".join(reasoning) + "</thinking>" + text
+    content.append({"type": "text", "text": text})
+    return {
+        "id": "msg_mock", "type": "message", "role": "assistant", "model": model,
+        "content": content, "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": settings.tokens},
+    }
+
+
+def create_app(settings: MockSettings) -> Starlette:
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "mock")
+        if body.get("stream"):
+            frames = _openai_frames(settings, model)
+            return StreamingResponse(_paced(settings, frames), media_type="text/event-stream")
+        await asyncio.sleep(settings.ttfb + settings.tokens / settings.tokens_per_sec)
+        return JSONResponse(_openai_message(settings, model))
+
+    async def messages(request: Request):
+        body = await request.json()
+        model = body.get("model", "mock")
+        if body.get("stream"):
+            frames = _anthropic_frames(settings, model)
+            return StreamingResponse(_paced(settings, frames), media_type="text/event-stream")
+        await asyncio.sleep(settings.ttfb + settings.tokens / settings.tokens_per_sec)
+        return JSONResponse(_anthropic_message(settings, model))
+
+    async def models(request: Request):
+        return JSONResponse({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+
+    async def health(request: Request):
+        return JSONResponse({"status": "ok"})
+
+    return Starlette(routes=[
+        Route("/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/messages", messages, methods=["POST"]),
+        Route("/models", models),
+        Route("/health", health),
+    ])
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttfb", type=float, default=0.1, help="首字节延迟（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=500.0, help="输出 token 速率")
+    parser.add_argument("--tokens", type=int, default=200, help="每个响应的输出 token 数")
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="每个 SSE chunk 的 token 数")
+    parser.add_argument("--thinking", choices=THINKING_MODES, default="tags", help="推理内容的输出方式")
+    parser.add_argument("--thinking-ratio", type=float, default=0.5, help="推理 token 占比")
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        ttfb=args.ttfb,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+        chunk_tokens=args.chunk_tokens,
+        thinking=args.thinking,
+        thinking_ratio=args.thinking_ratio
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(settings_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
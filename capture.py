@@ -0,0 +1,187 @@
+"""
+流量录制：按采样率把请求/响应记录写入轮转的 JSONL 文件
+
+请求路径上只做采样判断和入队（不序列化），JSON 编码和磁盘 I/O 在后台线程完成。
+队列满时直接丢弃记录，内存占用受队列长度限制，磁盘占用受单文件大小和保留文件数限制。
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional
+
+# 录制时保留的请求头，其中认证相关的头会被脱敏
+CAPTURED_HEADERS = ("anthropic-version", "anthropic-beta", "user-agent", "authorization", "x-api-key")
+SENSITIVE_HEADERS = frozenset({"authorization", "x-api-key"})
+
+
+def redact(value: str) -> str:
+    """只保留凭证末 4 位，便于区分不同调用方"""
+    if not value:
+        return value
+    return "***" + value[-4:] if len(value) > 8 else "***"
+
+
+class TrafficCapture:
+    """
+    后台写入的流量录制器
+
+    每行一条记录：{"ts", "path", "headers", "body", "status", "duration", "response"}，
+    流式响应不缓存响应体，只记录状态码和建立流的耗时。
+    单条记录超过 max_record_bytes 时依次截断响应体和请求体。
+    计数器同时由事件循环（入队）和后台线程（写入）更新，读写都在 _lock 下进行。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 0.01,
+        max_file_bytes: int = 64 * 1024 * 1024,
+        max_files: int = 5,
+        queue_size: int = 1000,
+        max_record_bytes: int = 1024 * 1024
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.max_record_bytes = max_record_bytes
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+
+    def start(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """写完队列中剩余的记录后停止后台线程"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(
+        self,
+        path: str,
+        headers: Mapping[str, str],
+        body: Any,
+        status: int,
+        started: float,
+        response: Optional[bytes] = None
+    ) -> None:
+        """
+        入队一条记录；调用方负责先用 sampled() 做采样判断
+
+        body 为客户端发来的原始请求体字节（在后台线程中解析），回放时发送与客户端相同的请求；
+        也可以直接传入已解析的对象。
+        """
+        entry = {
+            "ts": time.time(),
+            "path": path,
+            "headers": {name: headers[name] for name in CAPTURED_HEADERS if name in headers},
+            "body": body,
+            "status": status,
+            "duration": round(time.monotonic() - started, 4),
+            "response": response,
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.captured += 1
+
+    def _encode(self, entry: Dict[str, Any]) -> bytes:
+        headers = entry["headers"]
+        for name in SENSITIVE_HEADERS.intersection(headers):
+            headers[name] = redact(headers[name])
+
+        body = entry["body"]
+        if isinstance(body, bytes):
+            try:
+                entry["body"] = json.loads(body)
+            except ValueError:
+                entry["body"] = body.decode("utf-8", errors="replace")
+
+        response = entry["response"]
+        if response is not None:
+            entry["response"] = response.decode("utf-8", errors="replace")
+
+        line = json.dumps(entry, ensure_ascii=False).encode()
+        for field in ("response", "body"):
+            if len(line) <= self.max_record_bytes:
+                break
+            if entry[field] is not None:
+                entry[field] = None
+                entry[field + "_truncated"] = True
+                line = json.dumps(entry, ensure_ascii=False).encode()
+        return line + b"\n"
+
+    def _rotate(self) -> None:
+        """requests.jsonl -> requests.jsonl.1 -> ... -> requests.jsonl.{max_files}，最旧的被删除"""
+        for index in range(self.max_files - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.max_files > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _run(self) -> None:
+        f = open(self.path, "ab")
+        size = f.tell()
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    return
+                try:
+                    line = self._encode(entry)
+                except (TypeError, ValueError) as e:
+                    print(f"[Capture] Failed to encode record: {e}")
+                    continue
+                if len(line) > self.max_record_bytes:
+                    with self._lock:
+                        self.dropped += 1
+                    continue
+
+                if size and size + len(line) > self.max_file_bytes:
+                    f.close()
+                    self._rotate()
+                    f = open(self.path, "ab")
+                    size = 0
+                f.write(line)
+                size += len(line)
+                with self._lock:
+                    self.written += 1
+                # 队列已空时落盘，突发流量下批量写入
+                if self._queue.empty():
+                    f.flush()
+        except OSError as e:
+            print(f"[Capture] Writer stopped: {e}")
+        finally:
+            f.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counters = {"captured": self.captured, "written": self.written, "dropped": self.dropped}
+        return dict(counters, queued=self._queue.qsize())
@@ -1,6 +1,7 @@
 """
 代理配置
 """
+import json
 import os
 
 # HTTP 代理配置
@@ -11,6 +12,9 @@ HTTPS_PROXY = "http://127.0.0.1:10808"
 MOONSHOT_API_KEY = os.getenv("ZENMUX_API_KEY", "")
 MOONSHOT_BASE_URL = os.getenv("MOONSHOT_BASE_URL", "https://zenmux.ai/api/anthropic")
 
+# /v1/messages 的上游格式：anthropic 直接转发，openai 转换为 /chat/completions 请求并把响应转换回 Anthropic 格式
+MESSAGES_UPSTREAM_FORMAT = os.getenv("MESSAGES_UPSTREAM_FORMAT", "anthropic").lower()
+
 # 代理服务配置
 PROXY_HOST = os.getenv("PROXY_HOST", "0.0.0.0")
 PROXY_PORT = int(os.getenv("PROXY_PORT", "8000"))
@@ -21,4 +25,121 @@ DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 # 自动修复配置
 AUTO_FIX_MISSING_REASONING = True
 AUTO_ENABLE_STREAM_FOR_THINKING = True
-MIN_TOKENS_FOR_THINKING = 16000
\ No newline at end of file
+MIN_TOKENS_FOR_THINKING = 16000
+
+# 非流式响应缓存（默认关闭）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 相同并发请求合并（/v1/models 始终合并）
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "false").lower() == "true"
+SINGLE_FLIGHT_BUFFER_CHUNKS = int(os.getenv("SINGLE_FLIGHT_BUFFER_CHUNKS", "1024"))
+SINGLE_FLIGHT_REPLAY_CHUNKS = int(os.getenv("SINGLE_FLIGHT_REPLAY_CHUNKS", "256"))
+
+# 消息历史修复的前缀缓存条目数
+HISTORY_FIXER_CACHE_SIZE = int(os.getenv("HISTORY_FIXER_CACHE_SIZE", "1024"))
+
+# 上游列表：UPSTREAMS 为 JSON 数组，每项可单独配置连接池参数，例如
+# [{"url": "https://a.example/api", "max_connections": 100, "max_keepalive_connections": 20,
+#   "keepalive_expiry": 30, "http2": true, "proxy": null}]
+# 未设置时使用逗号分隔的 UPSTREAM_URLS，再退回 MOONSHOT_BASE_URL
+UPSTREAMS = json.loads(os.getenv("UPSTREAMS") or "[]") or [
+    {"url": url.strip()}
+    for url in os.getenv("UPSTREAM_URLS", MOONSHOT_BASE_URL).split(",")
+    if url.strip()
+]
+for _upstream in UPSTREAMS:
+    _upstream.setdefault("proxy", HTTPS_PROXY)
+
+# 负载均衡策略：least_outstanding 或 ewma
+UPSTREAM_BALANCER = os.getenv("UPSTREAM_BALANCER", "least_outstanding")
+# 连续失败多少次后熔断，以及熔断冷却时间（秒）
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "5"))
+UPSTREAM_COOLDOWN = float(os.getenv("UPSTREAM_COOLDOWN", "30"))
+
+# 流式请求对冲（默认关闭）：首字节超过 TTFB 分位数仍未到达时发出重复请求
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "10.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# 对冲产生的额外请求占总请求数的上限比例
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))
+
+# 流量录制（默认关闭）：按采样率把请求/响应写入轮转的 JSONL 文件
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "false").lower() == "true"
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "captures/requests.jsonl")
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "0.01"))
+# 单个文件的最大字节数和保留的历史文件数，磁盘占用上限约为两者之积
+CAPTURE_MAX_FILE_BYTES = int(os.getenv("CAPTURE_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+CAPTURE_MAX_FILES = int(os.getenv("CAPTURE_MAX_FILES", "5"))
+# 待写入队列长度，队列满时丢弃新记录
+CAPTURE_QUEUE_SIZE = int(os.getenv("CAPTURE_QUEUE_SIZE", "1000"))
+CAPTURE_MAX_RECORD_BYTES = int(os.getenv("CAPTURE_MAX_RECORD_BYTES", str(1024 * 1024)))
+
+# 准入控制（默认关闭）：按 API key 限流 + 按上游自适应并发上限 + 优先级队列
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "false").lower() == "true"
+# 每个 API key 每秒的请求数 / 估算 token 数及突发容量，0 表示不限制
+ADMISSION_KEY_RPS = float(os.getenv("ADMISSION_KEY_RPS", "0"))
+ADMISSION_KEY_BURST = float(os.getenv("ADMISSION_KEY_BURST", "20"))
+ADMISSION_KEY_TPS = float(os.getenv("ADMISSION_KEY_TPS", "0"))
+ADMISSION_KEY_TOKEN_BURST = float(os.getenv("ADMISSION_KEY_TOKEN_BURST", "1000000"))
+# 每个优先级队列的长度上限和最长排队时间（秒）
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30"))
+# 每个上游的自适应并发上限：初始值、下限、上限
+UPSTREAM_CONCURRENCY = {
+    "initial": float(os.getenv("UPSTREAM_CONCURRENCY_INITIAL", "32")),
+    "minimum": float(os.getenv("UPSTREAM_CONCURRENCY_MIN", "4")),
+    "maximum": float(os.getenv("UPSTREAM_CONCURRENCY_MAX", "256")),
+}
+
+# 本地 token 计数：安装 tiktoken 时使用该编码，否则按每 token 的 ASCII 字符数估算
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+TOKEN_ESTIMATE_CHARS_PER_TOKEN = float(os.getenv("TOKEN_ESTIMATE_CHARS_PER_TOKEN", "3.5"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "4096"))
+
+# 按估算的输入 token 数把 max_tokens 限制在模型上下文窗口之内，输入本身超出窗口时直接返回 400
+MAX_TOKENS_CLAMP_ENABLED = os.getenv("MAX_TOKENS_CLAMP_ENABLED", "false").lower() == "true"
+# 未安装 tiktoken 时按字符数估算会偏高，估算值超过窗口的该倍数才拒绝请求，收缩时也按该倍数折算
+TOKEN_ESTIMATE_SAFETY_MARGIN = float(os.getenv("TOKEN_ESTIMATE_SAFETY_MARGIN", "1.5"))
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "262144"))
+# 按模型名覆盖上下文窗口，例如 {"kimi-k2.5": 262144, "moonshot-v1-32k": 32768}
+MODEL_CONTEXT_WINDOWS = json.loads(os.getenv("MODEL_CONTEXT_WINDOWS") or "{}")
+
+# 提示缓存断点注入（/v1/messages 直连 Anthropic 格式上游时生效）
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "false").lower() == "true"
+# 前缀累计 token 数达到该值才放置断点（上游不缓存更短的前缀）
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_MAX_SESSIONS = int(os.getenv("PROMPT_CACHE_MAX_SESSIONS", "10000"))
+# 缓存有效期，留空使用上游默认值（5 分钟），可设为 1h
+PROMPT_CACHE_TTL = os.getenv("PROMPT_CACHE_TTL", "")
+
+# 本地批处理接口 /v1/batches：结果保存目录、单个批次的并发窗口和条目数上限
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+# 已结束批次的保留秒数（从最后一次写入结果算起），过期后自动删除，0 为永久保留
+BATCH_RETENTION = float(os.getenv("BATCH_RETENTION", "604800"))
+
+# 多 worker 共享状态目录（建议位于 /dev/shm），设置后响应缓存、按 key 限流和缓存命中统计在所有 worker 间共享
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", "")
+# 限流令牌桶的槽位数（按 key 哈希直接映射，冲突的 key 会互相覆盖）
+SHARED_STATE_SLOTS = int(os.getenv("SHARED_STATE_SLOTS", "65536"))
+
+# 启动预热：每个上游预先建立的连接数（0 为不预热连接）、整体超时（秒）
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+# 设置后在预热时用该凭证预取 /models，使用相同凭证的客户端直接命中缓存
+WARMUP_API_KEY = os.getenv("WARMUP_API_KEY", "")
+# /v1/models 响应按凭证缓存的时间（秒），0 为不缓存
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "300"))
+
+# 请求追踪的采样率（0 为关闭），被采样的请求返回 Server-Timing 头并计入慢请求记录
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# 每 SLOW_REQUEST_INTERVAL 秒保留最慢的 SLOW_REQUEST_LOG_SIZE 个请求，共保留 SLOW_REQUEST_INTERVALS 个窗口
+SLOW_REQUEST_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", "10"))
+SLOW_REQUEST_INTERVAL = float(os.getenv("SLOW_REQUEST_INTERVAL", "60"))
+SLOW_REQUEST_INTERVALS = int(os.getenv("SLOW_REQUEST_INTERVALS", "60"))
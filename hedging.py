@@ -0,0 +1,192 @@
+"""
+对冲请求：首字节迟迟未到时向上游发出一个重复请求，采用先成功产生数据的流
+"""
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+Sender = Callable[[], Awaitable[httpx.Response]]
+Reader = Callable[[httpx.Response], AsyncIterator[bytes]]
+HedgeResult = Tuple[httpx.Response, Optional[AsyncIterator[bytes]]]
+
+
+class TTFBTracker:
+    """按路由记录最近的首字节延迟，用于计算对冲延迟的分位数"""
+
+    def __init__(self, window: int = 500):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._sorted: Optional[list] = None
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, ttfb: float) -> None:
+        self._samples.append(ttfb)
+        self._sorted = None
+
+    def percentile(self, percentile: float) -> float:
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        index = int(round(percentile / 100 * (len(self._sorted) - 1)))
+        return self._sorted[index]
+
+
+class HedgeBudget:
+    """
+    对冲流量预算：每个请求积累 ratio 个令牌，每次对冲消耗一个
+
+    长期来看对冲产生的额外上游请求不超过总请求数的 ratio 倍，burst 限制短时突发。
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+
+    def on_request(self) -> None:
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+async def _prepend(first: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+class Hedger:
+    """
+    流式请求的对冲
+
+    首个 body 字节超过该路由 TTFB 的 percentile 分位数（样本不足时为 default_delay，
+    且不低于 min_delay）仍未到达时，在预算允许的情况下发出重复请求。
+    只有返回 200 并产生首个 body 字节的请求胜出，另一个被取消并关闭连接；
+    返回非 200 状态或抛出异常的请求视为失败，继续等待另一个，两者都失败时返回主请求的结果。
+    每个完成的请求都计入 TTFB 样本，被取消的请求以取消时已等待的时间计入（其 TTFB 不低于此值），
+    避免样本只来自较快的胜出者而使分位数偏低。
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        min_delay: float = 1.0,
+        default_delay: float = 10.0,
+        min_samples: int = 20,
+        budget_ratio: float = 0.1,
+        budget_burst: float = 10.0
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.budget = HedgeBudget(budget_ratio, budget_burst)
+        self._trackers: Dict[str, TTFBTracker] = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay_for(self, route: str) -> float:
+        tracker = self._trackers.get(route)
+        if tracker is None or len(tracker) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, tracker.percentile(self.percentile))
+
+    def _record(self, route: str, ttfb: float) -> None:
+        self._trackers.setdefault(route, TTFBTracker()).record(ttfb)
+
+    async def open(self, route: str, send: Sender, reader: Reader) -> HedgeResult:
+        """
+        打开上游流并预读首个 chunk
+
+        返回 (response, chunks)；状态码非 200 时 chunks 为 None，响应体未读取。
+        """
+        self.budget.on_request()
+        primary = asyncio.ensure_future(self._attempt(route, send, reader))
+        started = {primary: time.monotonic()}
+        pending: Set[asyncio.Future] = {primary}
+        finished: List[asyncio.Future] = []
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.delay_for(route))
+            if done or not self.budget.try_spend():
+                result = await primary
+                pending.clear()
+                return result
+
+            self.hedged += 1
+            print(f"[Proxy] No first byte on {route} after {self.delay_for(route):.2f}s, hedging")
+            hedge = asyncio.ensure_future(self._attempt(route, send, reader))
+            started[hedge] = time.monotonic()
+            pending.add(hedge)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先采用主请求
+                finished.extend(sorted(done, key=lambda t: t is not primary))
+                winner = next((task for task in finished if self._won(task)), None)
+                if winner is not None:
+                    finished.remove(winner)
+                    if winner is hedge:
+                        self.hedge_wins += 1
+                    return winner.result()
+
+            # 两个请求都失败，返回主请求的结果（非 200 响应或异常）
+            finished.remove(primary)
+            return primary.result()
+        finally:
+            for task in pending:
+                await self._discard(task)
+                self._record(route, time.monotonic() - started[task])
+            for task in finished:
+                await self._discard(task)
+
+    @staticmethod
+    def _won(task: asyncio.Future) -> bool:
+        """请求返回 200 并已读到首个 body 字节"""
+        if task.cancelled() or task.exception() is not None:
+            return False
+        response, _ = task.result()
+        return response.status_code == 200
+
+    async def _attempt(self, route: str, send: Sender, reader: Reader) -> HedgeResult:
+        start = time.monotonic()
+        response = await send()
+        if response.status_code != 200:
+            return response, None
+
+        try:
+            chunks = reader(response).__aiter__()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = b""
+        except BaseException:
+            await response.aclose()
+            raise
+
+        self._record(route, time.monotonic() - start)
+        return response, _prepend(first, chunks)
+
+    @staticmethod
+    async def _discard(task: asyncio.Future) -> None:
+        """取消落败的请求并关闭其响应"""
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+            return
+        if not task.cancelled() and task.exception() is None:
+            response, _ = task.result()
+            await response.aclose()
+
+    def stats(self) -> Dict[str, float]:
+        return {"hedged": self.hedged, "hedge_wins": self.hedge_wins}
@@ -5,63 +5,383 @@ Kimi Thinking 模型代理服务
 import json
 import httpx
 import asyncio
+import time
 from uuid import uuid4
 from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse
 from contextlib import asynccontextmanager
-from message_transformer import ReasoningContentTransformer
-from anthropic_adapter import AnthropicAdapter
-from config import HTTPS_PROXY
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+from message_transformer import (
+    ANTHROPIC_HISTORY_FIXER,
+    OPENAI_HISTORY_FIXER,
+    MessageHashes,
+    ReasoningContentTransformer,
+)
+from anthropic_adapter import AnthropicAdapter, AnthropicStreamTranslator
+from stream_relay import (
+    RAW_RELAY_HEADERS,
+    SSE_HEADERS,
+    STREAM_STATS,
+    DisconnectGuard,
+    iter_raw,
+    iter_sse,
+    passthrough_headers,
+)
+from response_cache import ResponseCache
+from shared_state import open_shared_state
+from single_flight import SingleFlight, StreamBody
+from upstream_pool import UpstreamPool
+from hedging import Hedger
+from capture import TrafficCapture
+from batch import BatchError, BatchRunner, forwarded_headers, owner_digest
+from warmup import WarmUp
+from tracing import SlowRequestLog, TracingMiddleware, span
+from admission import AdmissionController, AdmissionMiddleware, KeyLimiter
+from token_counter import TokenCounter
+from prompt_cache import PromptCacheOptimizer
+from raw_body import RawJSONBody, encode_body
+from stream_aggregator import AnthropicStreamAggregator, OpenAIStreamAggregator
+from metrics import (
+    BODY_PARSE_SECONDS,
+    METRICS_CONTENT_TYPE,
+    PROMPT_CACHE_BREAKPOINTS_TOTAL,
+    TRANSFORM_SECONDS,
+    InflightMiddleware,
+    StreamMeter,
+    observe_response,
+    render_metrics,
+    timed,
+)
+from config import (
+    ADMISSION_ENABLED,
+    ADMISSION_KEY_BURST,
+    ADMISSION_KEY_RPS,
+    ADMISSION_KEY_TOKEN_BURST,
+    ADMISSION_KEY_TPS,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_QUEUE_SIZE,
+    BATCH_CONCURRENCY,
+    BATCH_DIR,
+    BATCH_MAX_ITEMS,
+    BATCH_RETENTION,
+    CAPTURE_ENABLED,
+    CAPTURE_MAX_FILE_BYTES,
+    CAPTURE_MAX_FILES,
+    CAPTURE_MAX_RECORD_BYTES,
+    CAPTURE_PATH,
+    CAPTURE_QUEUE_SIZE,
+    CAPTURE_SAMPLE_RATE,
+    DEBUG,
+    HEDGE_BUDGET_RATIO,
+    HEDGE_DEFAULT_DELAY,
+    HEDGE_ENABLED,
+    HEDGE_MIN_DELAY,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
+    DEFAULT_CONTEXT_WINDOW,
+    MAX_TOKENS_CLAMP_ENABLED,
+    MIN_TOKENS_FOR_THINKING,
+    MODELS_CACHE_TTL,
+    MODEL_CONTEXT_WINDOWS,
+    MESSAGES_UPSTREAM_FORMAT,
+    PROMPT_CACHE_ENABLED,
+    PROMPT_CACHE_MAX_SESSIONS,
+    PROMPT_CACHE_MIN_TOKENS,
+    PROMPT_CACHE_TTL,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL,
+    SINGLE_FLIGHT_BUFFER_CHUNKS,
+    SINGLE_FLIGHT_ENABLED,
+    SINGLE_FLIGHT_REPLAY_CHUNKS,
+    SHARED_STATE_DIR,
+    SHARED_STATE_SLOTS,
+    SLOW_REQUEST_INTERVAL,
+    SLOW_REQUEST_INTERVALS,
+    SLOW_REQUEST_LOG_SIZE,
+    UPSTREAM_BALANCER,
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_COOLDOWN,
+    UPSTREAM_FAILURE_THRESHOLD,
+    UPSTREAMS,
+    TOKEN_COUNT_CACHE_SIZE,
+    TOKEN_ESTIMATE_CHARS_PER_TOKEN,
+    TOKEN_ESTIMATE_SAFETY_MARGIN,
+    TOKENIZER_ENCODING,
+    TRACE_SAMPLE_RATE,
+    WARMUP_API_KEY,
+    WARMUP_CONNECTIONS,
+    WARMUP_TIMEOUT,
+)
 
 # 配置
-MOONSHOT_BASE_URL = "https://zenmux.ai/api/anthropic"
 DEFAULT_TIMEOUT = 120.0
+# Anthropic 接口允许的最小 thinking 预算
+THINKING_MIN_BUDGET_TOKENS = 1024
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    transport = httpx.AsyncHTTPTransport(proxy=HTTPS_PROXY)
-    app.state.client = httpx.AsyncClient(
-        base_url=MOONSHOT_BASE_URL,
-        timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=10.0),
-        http2=True,
-        transport=transport
+    app.state.upstreams = UpstreamPool.from_config(
+        UPSTREAMS,
+        timeout=DEFAULT_TIMEOUT,
+        balancer=UPSTREAM_BALANCER,
+        failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+        cooldown=UPSTREAM_COOLDOWN,
+        concurrency=UPSTREAM_CONCURRENCY
     )
+    app.state.token_counter = TokenCounter(
+        TOKENIZER_ENCODING,
+        chars_per_token=TOKEN_ESTIMATE_CHARS_PER_TOKEN,
+        cache_size=TOKEN_COUNT_CACHE_SIZE
+    )
+    app.state.prompt_cache = None
+    if PROMPT_CACHE_ENABLED:
+        app.state.prompt_cache = PromptCacheOptimizer(
+            app.state.token_counter,
+            min_tokens=PROMPT_CACHE_MIN_TOKENS,
+            max_sessions=PROMPT_CACHE_MAX_SESSIONS,
+            ttl=PROMPT_CACHE_TTL or None
+        )
+    # 多 worker 部署时，响应缓存和按 key 限流放在共享内存中
+    shared = open_shared_state(SHARED_STATE_DIR, SHARED_STATE_SLOTS) if SHARED_STATE_DIR else None
+    app.state.admission = None
+    if ADMISSION_ENABLED:
+        key_limiter = None
+        if ADMISSION_KEY_RPS > 0 or ADMISSION_KEY_TPS > 0:
+            key_limiter = (shared.key_limiter if shared is not None else KeyLimiter)(
+                request_rate=ADMISSION_KEY_RPS,
+                request_burst=ADMISSION_KEY_BURST,
+                token_rate=ADMISSION_KEY_TPS,
+                token_burst=ADMISSION_KEY_TOKEN_BURST
+            )
+        upstreams = app.state.upstreams
+        app.state.admission = AdmissionController(
+            lambda: [u.limit for u in upstreams.upstreams if u.available],
+            key_limiter=key_limiter,
+            queue_size=ADMISSION_QUEUE_SIZE,
+            max_wait=ADMISSION_MAX_WAIT
+        )
+    app.state.response_cache = None
+    if RESPONSE_CACHE_ENABLED:
+        app.state.response_cache = (shared.response_cache if shared is not None else ResponseCache)(
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            ttl=RESPONSE_CACHE_TTL,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES
+        )
+    app.state.single_flight = SingleFlight(
+        max_buffer_chunks=SINGLE_FLIGHT_BUFFER_CHUNKS,
+        replay_chunks=SINGLE_FLIGHT_REPLAY_CHUNKS
+    )
+    app.state.hedger = None
+    if HEDGE_ENABLED:
+        app.state.hedger = Hedger(
+            percentile=HEDGE_PERCENTILE,
+            min_delay=HEDGE_MIN_DELAY,
+            default_delay=HEDGE_DEFAULT_DELAY,
+            min_samples=HEDGE_MIN_SAMPLES,
+            budget_ratio=HEDGE_BUDGET_RATIO
+        )
+    app.state.capture = None
+    if CAPTURE_ENABLED:
+        app.state.capture = TrafficCapture(
+            CAPTURE_PATH,
+            sample_rate=CAPTURE_SAMPLE_RATE,
+            max_file_bytes=CAPTURE_MAX_FILE_BYTES,
+            max_files=CAPTURE_MAX_FILES,
+            queue_size=CAPTURE_QUEUE_SIZE,
+            max_record_bytes=CAPTURE_MAX_RECORD_BYTES
+        )
+        app.state.capture.start()
+    app.state.batches = BatchRunner(
+        app,
+        directory=BATCH_DIR,
+        concurrency=BATCH_CONCURRENCY,
+        max_items=BATCH_MAX_ITEMS,
+        retention=BATCH_RETENTION
+    )
+    app.state.batches.start()
+    app.state.models_cache = ResponseCache(max_entries=64, ttl=MODELS_CACHE_TTL, max_bytes=4 * 1024 * 1024)
+    # 预热在后台进行，完成前 /health 返回 503
+    app.state.warmup = WarmUp(timeout=WARMUP_TIMEOUT)
+    app.state.warmup.start(app, WARMUP_CONNECTIONS, WARMUP_API_KEY)
     yield
-    await app.state.client.aclose()
+    await app.state.warmup.stop()
+    await app.state.batches.aclose()
+    await app.state.upstreams.aclose()
+    if app.state.capture is not None:
+        app.state.capture.stop()
+    if shared is not None:
+        shared.close()
 
 app = FastAPI(title="Kimi Thinking Proxy", version="1.0.0", lifespan=lifespan)
+app.add_middleware(InflightMiddleware)
+# 准入控制在并发统计之外，排队中的请求不计入并发数
+app.add_middleware(AdmissionMiddleware)
+# 追踪在最外层，覆盖准入排队时间
+SLOW_REQUESTS = SlowRequestLog(
+    size=SLOW_REQUEST_LOG_SIZE,
+    interval=SLOW_REQUEST_INTERVAL,
+    intervals=SLOW_REQUEST_INTERVALS
+)
+app.add_middleware(TracingMiddleware, sample_rate=TRACE_SAMPLE_RATE, slow_log=SLOW_REQUESTS)
+
+def get_single_flight(request: Request) -> Optional[SingleFlight]:
+    """返回用于合并当前请求的 SingleFlight；未启用或客户端要求绕过缓存时返回 None"""
+    if not SINGLE_FLIGHT_ENABLED or ResponseCache.is_bypassed(request.headers):
+        return None
+    return getattr(request.app.state, "single_flight", None)
+
+async def open_upstream_stream(
+    request: Request,
+    route: str,
+    reader: Callable[[httpx.Response], AsyncIterator[bytes]],
+    **kwargs
+) -> Tuple[httpx.Response, Optional[AsyncIterator[bytes]]]:
+    """打开上游流；启用对冲时预读首个 chunk，返回 (response, chunks)"""
+    async def send():
+        return await request.app.state.upstreams.send_stream("POST", route, **kwargs)
+
+    hedger = getattr(request.app.state, "hedger", None)
+    if hedger is None:
+        return await send(), None
+    return await hedger.open(route, send, reader)
+
+async def fetch_aggregated(
+    request: Request,
+    route: str,
+    aggregator: Any,
+    **kwargs
+) -> Tuple[int, Any]:
+    """
+    发起流式请求并把整个上游流聚合为一个完整的响应对象
+    返回 (状态码, 响应对象)；上游返回错误状态时响应对象为原始错误响应体字节，流中出现错误时为 502
+    """
+    meter = StreamMeter(route)
+    response, chunks = await open_upstream_stream(request, route, lambda r: r.aiter_bytes(), **kwargs)
+    try:
+        if response.status_code != 200:
+            return response.status_code, await response.aread()
+        async for chunk in meter.wrap(chunks or response.aiter_bytes()):
+            aggregator.feed(chunk)
+        aggregator.flush()
+    finally:
+        await response.aclose()
+    return (502 if aggregator.error is not None else 200), aggregator.result()
+
+def capture_exchange(request: Request, route: str, body: RawJSONBody, response: Response, started: float) -> None:
+    """
+    按采样率录制一次请求；流式响应只记录状态码
+    录制客户端发来的原始请求体，而不是经过修复、强制流式和缓存断点注入后发往上游的请求体
+    """
+    capture = getattr(request.app.state, "capture", None)
+    if capture is None or not capture.sampled():
+        return
+    content = None if isinstance(response, StreamingResponse) else response.body
+    capture.record(route, request.headers, body.raw, response.status_code, started, content)
+
+def clamp_max_tokens(request: Request, body: dict, hashes: Optional[MessageHashes] = None) -> Optional[str]:
+    """
+    按估算的输入 token 数把 max_tokens 限制在模型上下文窗口之内（同时收缩 thinking 预算）
+    输入本身已超出窗口时返回错误信息，不再发往上游；hashes 为本次请求共用的消息哈希表
+
+    没有 tiktoken 时字符数估算偏高，估算值先除以 TOKEN_ESTIMATE_SAFETY_MARGIN 再比较，
+    只有明显超出窗口的请求才被拒绝。thinking 预算不会被压到 THINKING_MIN_BUDGET_TOKENS 以下，
+    做不到时保持请求原样，交由上游判断。
+    """
+    if not MAX_TOKENS_CLAMP_ENABLED:
+        return None
+    window = MODEL_CONTEXT_WINDOWS.get(body.get("model"), DEFAULT_CONTEXT_WINDOW)
+    counter = request.app.state.token_counter
+    with span("tokens"):
+        prompt_tokens = counter.count_request(body, hashes)
+    if counter.method != "tiktoken":
+        prompt_tokens = int(prompt_tokens / TOKEN_ESTIMATE_SAFETY_MARGIN)
+    available = window - prompt_tokens
+    if available <= 0:
+        return f"prompt is too long: ~{prompt_tokens} tokens > {window} maximum"
+
+    max_tokens = body.get("max_tokens")
+    if not isinstance(max_tokens, int) or max_tokens <= available:
+        return None
+    thinking = body.get("thinking")
+    budget = thinking.get("budget_tokens") if isinstance(thinking, dict) else None
+    if isinstance(budget, int) and budget >= available:
+        if available - 1 < THINKING_MIN_BUDGET_TOKENS:
+            return None
+        body["thinking"] = dict(thinking, budget_tokens=available - 1)
+    print(f"[Proxy] Clamping max_tokens {max_tokens} -> {available} (~{prompt_tokens} prompt tokens)")
+    body["max_tokens"] = available
+    return None
+
+def build_stream_response(
+    request: Request,
+    status_code: int,
+    headers: Dict[str, str],
+    body: StreamBody,
+    max_tokens: Optional[int]
+) -> Response:
+    """根据上游结果构造响应：完整响应体直接返回，字节流则带断开检测地转发"""
+    if isinstance(body, bytes):
+        return Response(content=body, status_code=status_code, headers=headers)
+    return StreamingResponse(
+        DisconnectGuard(request, max_tokens).relay(body),
+        status_code=status_code,
+        headers=headers
+    )
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """
     代理 chat completions 接口，修复 reasoning_content 问题
     """
+    started = time.monotonic()
     try:
-        body = await request.json()
+        with timed(BODY_PARSE_SECONDS, "/v1/chat/completions", "parse"):
+            body = RawJSONBody(await request.body())
+        # 消息哈希只计算一次，历史修复和 token 计数共用
+        hashes = MessageHashes(body)
         
         # ===== 关键修复 1: 修复请求消息 =====
         if "messages" in body:
             original_messages = body["messages"]
-            body["messages"] = ReasoningContentTransformer.fix_messages(original_messages)
+            with timed(TRANSFORM_SECONDS, "/v1/chat/completions", "transform"):
+                body["messages"] = OPENAI_HISTORY_FIXER.fix(
+                    original_messages, hashes, request.headers.get("authorization", "")
+                )
             
             # 打印调试信息（生产环境可移除）
             print(f"[Proxy] Fixed {len(original_messages)} messages")
         
         # ===== 关键修复 2: 确保启用了 thinking 时，max_tokens 足够大 =====
         if body.get("thinking") or body.get("extra_body", {}).get("thinking"):
-            if body.get("max_tokens", 0) < 16000:
-                body["max_tokens"] = 16000
+            if body.get("max_tokens", 0) < MIN_TOKENS_FOR_THINKING:
+                body["max_tokens"] = MIN_TOKENS_FOR_THINKING
             # 确保 temperature 为 1.0（Kimi K2.5 Thinking 要求）
             body["temperature"] = 1.0
+
+        # ===== 上下文窗口: max_tokens 不超过窗口减去输入 =====
+        overflow = clamp_max_tokens(request, body, hashes)
+        if overflow:
+            return JSONResponse(
+                status_code=400,
+                content={"error": {
+                    "message": overflow,
+                    "type": "invalid_request_error",
+                    "code": "context_length_exceeded",
+                }}
+            )
         
         # ===== 关键修复 3: 确保使用流式传输（避免超时） =====
         is_streaming = body.get("stream", False)
+        aggregate = False
         if not is_streaming and body.get("thinking"):
-            # 对于 thinking 模式，强制使用流式以避免大响应超时
+            # 对于 thinking 模式，强制上游使用流式以避免大响应超时，再聚合为非流式响应返回给客户端
             print("[Proxy] Auto-enabling stream for thinking mode")
             body["stream"] = True
-            is_streaming = True
+            body["stream_options"] = {"include_usage": True}
+            aggregate = True
         
         # 转发请求到 Moonshot API
         headers = {
@@ -70,125 +390,235 @@ async def chat_completions(request: Request):
         }
         
         if is_streaming:
-            return await handle_streaming_response(request, body, headers)
+            response = await handle_streaming_response(request, body, headers)
         else:
-            return await handle_non_streaming_response(request, body, headers)
+            response = await handle_non_streaming_response(request, body, headers, aggregate)
+        capture_exchange(request, "/v1/chat/completions", body, response, started)
+        return response
             
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def handle_non_streaming_response(request: Request, body: dict, headers: dict):
-    """处理非流式响应"""
-    response = await request.app.state.client.post(
-        "/chat/completions",
-        json=body,
-        headers=headers
-    )
-    
-    if response.status_code != 200:
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            headers=dict(response.headers)
+async def handle_non_streaming_response(request: Request, body: dict, headers: dict, aggregate: bool = False):
+    """处理非流式响应；aggregate 为 True 时上游以流式请求，聚合后返回"""
+    cache = getattr(request.app.state, "response_cache", None)
+    cache_key = None
+    if cache is not None:
+        cache_key, cached = cache.lookup(
+            request.headers, "/chat/completions", body, headers["Authorization"]
         )
+        if cached is not None:
+            return cached
+
+    async def fetch():
+        if aggregate:
+            status_code, data = await fetch_aggregated(
+                request,
+                "/chat/completions",
+                OpenAIStreamAggregator(),
+                content=encode_body(body),
+                headers=headers
+            )
+            if status_code != 200:
+                if isinstance(data, bytes):
+                    return Response(content=data, status_code=status_code, media_type="application/json")
+                return JSONResponse(content=data, status_code=status_code)
+            return cache_json(data)
+
+        started = time.monotonic()
+        response = await request.app.state.upstreams.request(
+            "POST",
+            "/chat/completions",
+            content=encode_body(body),
+            headers=headers
+        )
+        observe_response("/chat/completions", started, response.content)
     
-    data = response.json()
+        if response.status_code != 200:
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                headers=dict(response.headers)
+            )
     
-    # ===== 关键修复 4: 修复响应中的 assistant 消息 =====
-    if "choices" in data:
-        for choice in data["choices"]:
-            if "message" in choice:
-                choice["message"] = ReasoningContentTransformer.ensure_assistant_message_complete(
-                    choice["message"]
-                )
+        data = response.json()
     
-    return JSONResponse(content=data)
+        # ===== 关键修复 4: 修复响应中的 assistant 消息 =====
+        if "choices" in data:
+            for choice in data["choices"]:
+                if "message" in choice:
+                    choice["message"] = ReasoningContentTransformer.ensure_assistant_message_complete(
+                        choice["message"]
+                    )
+        return cache_json(data)
+
+    def cache_json(data: dict) -> Response:
+        json_response = JSONResponse(content=data)
+        if cache is not None:
+            if cache_key:
+                cache.set(cache_key, json_response.body, 200, "application/json")
+            ResponseCache.mark(json_response, cache_key)
+        return json_response
+
+    flights = get_single_flight(request)
+    if flights is None:
+        return await fetch()
+    return await flights.call(
+        cache_key or ResponseCache.make_key("/chat/completions", body, headers["Authorization"]),
+        fetch
+    )
 
 async def handle_streaming_response(request: Request, body: dict, headers: dict):
     """处理流式响应，实时修复每个 chunk"""
     
-    async def generate():
-        async with request.app.state.client.stream(
-            "POST",
+    async def open_stream():
+        meter = StreamMeter("/chat/completions")
+        response, chunks = await open_upstream_stream(
+            request,
             "/chat/completions",
-            json=body,
+            lambda r: r.aiter_bytes(),
+            content=encode_body(body),
             headers=headers
-        ) as response:
-            
-            if response.status_code != 200:
-                error_content = await response.aread()
-                yield f"data: {json.dumps({'error': error_content.decode()})}\n\n"
-                return
-            
-            async for line in response.aiter_lines():
-                if not line:
-                    continue
-                
-                if line.startswith("data: "):
-                    data_str = line[6:].strip()
-                    
-                    if data_str == "[DONE]":
-                        yield "data: [DONE]\n\n"
-                        continue
-                    
-                    try:
-                        chunk = json.loads(data_str)
-                        
-                        # ===== 关键修复 5: 修复每个流式 chunk =====
-                        if "choices" in chunk:
-                            for choice in chunk["choices"]:
-                                if "delta" in choice:
-                                    delta = choice["delta"]
-                                    
-                                    # 处理 reasoning_content 字段
-                                    if delta.get("role") == "assistant":
-                                        if "reasoning_content" not in delta:
-                                            # 如果 content 以 <thinking> 开头，提取它
-                                            content = delta.get("content", "")
-                                            if content and content.startswith("<thinking>"):
-                                                end_idx = content.find("</thinking>")
-                                                if end_idx != -1:
-                                                    delta["reasoning_content"] = content[10:end_idx]
-                                                    delta["content"] = content[end_idx+11:]
-                                                else:
-                                                    delta["reasoning_content"] = content[10:]
-                                                    delta["content"] = ""
-                                            else:
-                                                delta["reasoning_content"] = None
-                        
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                        
-                    except json.JSONDecodeError:
-                        yield f"{line}\n\n"
-                else:
-                    yield f"{line}\n\n"
-    
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
+        )
+
+        if response.status_code != 200:
+            error_content = await response.aread()
+            await response.aclose()
+            error_frame = f"data: {json.dumps({'error': error_content.decode()})}\n\n"
+            return 200, dict(SSE_HEADERS), error_frame.encode()
+
+        # 按原始字节转发，只解码需要修复的帧
+        return 200, dict(SSE_HEADERS), meter.wrap(iter_sse(response, chunks))
+
+    flights = get_single_flight(request)
+    if flights is None:
+        status_code, response_headers, chunks = await open_stream()
+        return build_stream_response(
+            request, status_code, response_headers, chunks, body.get("max_tokens")
+        )
+
+    # 合并后的上游流由多个客户端共享，单个客户端断开不节省 token
+    key = ResponseCache.make_key("/chat/completions:stream", body, headers["Authorization"])
+    status_code, response_headers, chunks = await flights.stream(key, open_stream)
+    return build_stream_response(request, status_code, response_headers, chunks, None)
 
 @app.get("/v1/models")
 async def list_models(request: Request):
     """代理模型列表接口"""
     headers = {"Authorization": request.headers.get("authorization", "")}
-    response = await request.app.state.client.get("/models", headers=headers)
+    models_cache = request.app.state.models_cache
+    cache_key = models_cache.make_key("/models", {}, headers["Authorization"])
+    cached = models_cache.get(cache_key) if MODELS_CACHE_TTL > 0 else None
+    if cached is not None:
+        return cached.to_response("HIT")
+
+    async def fetch():
+        response = await request.app.state.upstreams.request("GET", "/models", headers=headers)
+        if MODELS_CACHE_TTL > 0:
+            models_cache.set(cache_key, response.content, response.status_code, "application/json")
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers={"Content-Type": "application/json"}
+        )
+
+    # 模型列表与采样无关，始终合并并发请求
+    flights = getattr(request.app.state, "single_flight", None)
+    if flights is None:
+        return await fetch()
+    return await flights.call(cache_key, fetch)
+
+@app.post("/v1/messages/count_tokens")
+async def anthropic_count_tokens(request: Request):
+    """本地估算 Anthropic 请求的输入 token 数，不访问上游"""
+    try:
+        body = RawJSONBody(await request.body())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    return {"input_tokens": request.app.state.token_counter.count_request(body)}
+
+@app.post("/v1/chat/completions/count_tokens")
+async def openai_count_tokens(request: Request):
+    """本地估算 OpenAI chat completions 请求的输入 token 数，不访问上游"""
+    try:
+        body = RawJSONBody(await request.body())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    return {"input_tokens": request.app.state.token_counter.count_request(body)}
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """
+    本地批处理：请求体为 JSONL，每行一个 {"custom_id", "params"} 或 {"custom_id", "url", "body"}
+    结果按完成顺序以 JSONL 流式返回；请求头 X-Batch-Id 指定已有批次时从磁盘续跑未完成的条目
+    """
+    batches = request.app.state.batches
+    try:
+        batch_id, results = await batches.prepare(
+            request.headers.get("x-batch-id"),
+            await request.body(),
+            forwarded_headers(request.headers)
+        )
+    except BatchError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": {"message": str(e)}})
+
+    return StreamingResponse(
+        results,
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Id": batch_id}
+    )
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(request: Request, batch_id: str):
+    status = await asyncio.to_thread(request.app.state.batches.status, batch_id, owner_digest(request.headers))
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return status
+
+@app.get("/v1/batches/{batch_id}/results")
+async def get_batch_results(request: Request, batch_id: str):
+    """已保存的结果（每个条目取最后一条记录）"""
+    batches = request.app.state.batches
+    if await asyncio.to_thread(batches.status, batch_id, owner_digest(request.headers)) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    records = (await asyncio.to_thread(batches.load_results, batch_id)).values()
     return Response(
-        content=response.content,
-        status_code=response.status_code,
-        headers={"Content-Type": "application/json"}
+        content="".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records),
+        media_type="application/x-ndjson"
     )
 
+@app.get("/debug/slow-requests")
+async def slow_requests():
+    """每个时间窗口内最慢的请求及其各阶段耗时（本 worker），最近的窗口在前"""
+    return {"interval": SLOW_REQUESTS.interval, "windows": SLOW_REQUESTS.snapshot()}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/health")
 async def health():
-    """健康检查"""
-    return {"status": "ok", "service": "kimi-thinking-proxy"}
+    """健康检查；启动预热完成前返回 503"""
+    if not app.state.warmup.ready:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "warming", "service": "kimi-thinking-proxy", "warmup": app.state.warmup.stats()}
+        )
+    return {
+        "status": "ok",
+        "warmup": app.state.warmup.stats(),
+        "service": "kimi-thinking-proxy",
+        "streams": STREAM_STATS,
+        "upstreams": app.state.upstreams.stats(),
+        "capture": app.state.capture.stats() if app.state.capture is not None else None,
+        "admission": app.state.admission.stats() if app.state.admission is not None else None,
+        "token_counter": app.state.token_counter.stats(),
+        "batches": app.state.batches.stats(),
+        "prompt_cache": app.state.prompt_cache.stats() if app.state.prompt_cache is not None else None,
+    }
 
 
 @app.post("/v1/messages")
@@ -197,14 +627,12 @@ async def anthropic_messages(request: Request):
     Anthropic API 格式的代理接口
     直接转发到上游 Anthropic API，修复 reasoning_content 问题
     """
+    started = time.monotonic()
     try:
-        body = await request.json()
-
-        # 修复消息历史中的 reasoning_content 问题
-        if "messages" in body:
-            body["messages"] = ReasoningContentTransformer.fix_anthropic_messages(
-                body["messages"]
-            )
+        with timed(BODY_PARSE_SECONDS, "/v1/messages", "parse"):
+            body = RawJSONBody(await request.body())
+        # 消息哈希只计算一次，历史修复、token 计数和提示缓存断点共用
+        hashes = MessageHashes(body)
 
         # Anthropic 使用 x-api-key 头进行认证
         auth_header = request.headers.get("x-api-key", "")
@@ -212,18 +640,65 @@ async def anthropic_messages(request: Request):
             auth = request.headers.get("authorization", "")
             if auth.startswith("Bearer "):
                 auth_header = auth[7:]
+
+        # 修复消息历史中的 reasoning_content 问题
+        if "messages" in body:
+            with timed(TRANSFORM_SECONDS, "/v1/messages", "transform"):
+                body["messages"] = ANTHROPIC_HISTORY_FIXER.fix(
+                    body["messages"], hashes, auth_header
+                )
+
+        overflow = clamp_max_tokens(request, body, hashes)
+        if overflow:
+            return JSONResponse(
+                status_code=400,
+                content={"type": "error", "error": {"type": "invalid_request_error", "message": overflow}}
+            )
+
+        is_streaming = body.get("stream", False)
+        # thinking 模式的非流式请求同样以流式发往上游，聚合后返回（避免大响应超时）
+        thinking = body.get("thinking")
+        aggregate = not is_streaming and isinstance(thinking, dict) and thinking.get("type") != "disabled"
+
+        if MESSAGES_UPSTREAM_FORMAT == "openai":
+            # 转换为 OpenAI 格式发往 /chat/completions
+            headers = {
+                "Authorization": f"Bearer {auth_header}",
+                "Content-Type": "application/json",
+            }
+            if is_streaming:
+                response = await handle_translated_streaming(request, body, headers)
+            else:
+                response = await handle_translated_non_streaming(request, body, headers, aggregate)
+            capture_exchange(request, "/v1/messages", body, response, started)
+            return response
+
+        # 为稳定的长前缀注入提示缓存断点（OpenAI 格式上游不支持，只在直连时注入）
+        prompt_cache = getattr(request.app.state, "prompt_cache", None)
+        key_body = body
+        if prompt_cache is not None:
+            # 断点取决于之前的请求，响应缓存和单飞的 key 按注入前的请求体计算；
+            # apply 只替换顶层字段而不原地修改，浅拷贝即可
+            key_body = dict(body)
+            with timed(TRANSFORM_SECONDS, "/v1/messages", "transform"):
+                inserted = prompt_cache.apply(body, auth_header, hashes)
+            if inserted:
+                PROMPT_CACHE_BREAKPOINTS_TOTAL.inc(inserted)
+
         headers = {
             "x-api-key": auth_header,
             "Content-Type": "application/json",
             "anthropic-version": "2023-06-01",
         }
 
-        is_streaming = body.get("stream", False)
-
         if is_streaming:
-            return await handle_anthropic_streaming(request, body, headers)
+            response = await handle_anthropic_streaming(request, body, headers, key_body)
         else:
-            return await handle_anthropic_non_streaming(request, body, headers)
+            if aggregate:
+                body["stream"] = True
+            response = await handle_anthropic_non_streaming(request, body, headers, aggregate, key_body)
+        capture_exchange(request, "/v1/messages", body, response, started)
+        return response
 
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON")
@@ -231,58 +706,213 @@ async def anthropic_messages(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def handle_anthropic_non_streaming(request: Request, body: dict, headers: dict):
-    """直接转发 Anthropic 非流式请求和响应"""
-    print(f"[Debug] Request headers: {headers}")
-    print(f"[Debug] Request body: {json.dumps(body, ensure_ascii=False)[:500]}")
+async def handle_anthropic_non_streaming(
+    request: Request,
+    body: dict,
+    headers: dict,
+    aggregate: bool = False,
+    key_body: Optional[dict] = None
+):
+    """
+    直接转发 Anthropic 非流式请求和响应；aggregate 为 True 时上游以流式请求，聚合后返回
+    key_body 为计算缓存 key 的请求体（注入提示缓存断点之前），默认为 body
+    """
+    if key_body is None:
+        key_body = body
+    cache = getattr(request.app.state, "response_cache", None)
+    cache_key = None
+    if cache is not None:
+        cache_key, cached = cache.lookup(
+            request.headers, "/v1/messages", key_body, headers["x-api-key"]
+        )
+        if cached is not None:
+            return cached
 
-    response = await request.app.state.client.post(
-        "/v1/messages",
-        json=body,
-        headers=headers
-    )
+    async def fetch():
+        if aggregate:
+            status_code, data = await fetch_aggregated(
+                request,
+                "/v1/messages",
+                AnthropicStreamAggregator(),
+                content=encode_body(body),
+                headers=headers,
+                timeout=DEFAULT_TIMEOUT
+            )
+            if isinstance(data, bytes):
+                return Response(content=data, status_code=status_code, media_type="application/json")
+            json_response = JSONResponse(content=data, status_code=status_code)
+            if cache is not None:
+                if cache_key and status_code == 200:
+                    cache.set(cache_key, json_response.body, 200, "application/json")
+                ResponseCache.mark(json_response, cache_key)
+            return json_response
+
+        started = time.monotonic()
+        response = await request.app.state.upstreams.request(
+            "POST",
+            "/v1/messages",
+            content=encode_body(body),
+            headers=headers
+        )
+        observe_response("/v1/messages", started, response.content)
 
-    print(f"[Debug] Response status: {response.status_code}")
-    print(f"[Debug] Response content: {response.text[:1000]}")
+        if DEBUG:
+            print(f"[Debug] Response status: {response.status_code}")
 
-    return Response(
-        content=response.content,
-        status_code=response.status_code,
-        headers=dict(response.headers)
+        proxied = Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers=dict(response.headers)
+        )
+        if cache is not None:
+            if cache_key:
+                cache.set(
+                    cache_key,
+                    response.content,
+                    response.status_code,
+                    response.headers.get("content-type", "application/json")
+                )
+            ResponseCache.mark(proxied, cache_key)
+        return proxied
+
+    flights = get_single_flight(request)
+    if flights is None:
+        return await fetch()
+    return await flights.call(
+        cache_key or ResponseCache.make_key("/v1/messages", key_body, headers["x-api-key"]),
+        fetch
     )
 
 
-async def handle_anthropic_streaming(request: Request, body: dict, headers: dict):
-    """直接转发 Anthropic 流式请求和响应"""
+async def handle_anthropic_streaming(request: Request, body: dict, headers: dict, key_body: Optional[dict] = None):
+    """直接转发 Anthropic 流式请求和响应（原始字节透传）；key_body 含义同上"""
 
-    async def generate():
-        async with request.app.state.client.stream(
-            "POST",
+    async def open_stream():
+        meter = StreamMeter("/v1/messages")
+        response, chunks = await open_upstream_stream(
+            request,
             "/v1/messages",
-            json=body,
-            headers=headers,
-            timeout=120.0
-        ) as response:
+            lambda r: r.aiter_raw(),
+            content=encode_body(body),
+            headers=dict(headers, **RAW_RELAY_HEADERS),
+            timeout=DEFAULT_TIMEOUT
+        )
+        if DEBUG:
             print(f"[Debug] Stream response status: {response.status_code}")
 
-            if response.status_code != 200:
-                error_content = await response.aread()
-                print(f"[Debug] Stream error: {error_content.decode()[:500]}")
-                yield error_content
-                return
+        if response.status_code != 200:
+            error_content = await response.aread()
+            await response.aclose()
+            if DEBUG:
+                print(f"[Debug] Stream error: {error_content.decode(errors='replace')[:500]}")
+            error_headers = {"Content-Type": response.headers.get("content-type", "application/json")}
+            return response.status_code, error_headers, error_content
 
-            async for chunk in response.aiter_text():
-                yield chunk
+        return response.status_code, passthrough_headers(response), meter.wrap(iter_raw(response, chunks))
 
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
+    flights = get_single_flight(request)
+    if flights is None:
+        status_code, response_headers, chunks = await open_stream()
+        return build_stream_response(
+            request, status_code, response_headers, chunks, body.get("max_tokens")
+        )
+
+    key = ResponseCache.make_key("/v1/messages:stream", body if key_body is None else key_body, headers["x-api-key"])
+    status_code, response_headers, chunks = await flights.stream(key, open_stream)
+    return build_stream_response(request, status_code, response_headers, chunks, None)
+
+async def handle_translated_non_streaming(request: Request, body: dict, headers: dict, aggregate: bool = False):
+    """Anthropic 请求转换为 OpenAI 格式发往上游，响应转换回 Anthropic 格式；aggregate 含义同上"""
+    openai_body = AnthropicAdapter.anthropic_request_to_openai(body)
+    if aggregate:
+        openai_body["stream"] = True
+        openai_body["stream_options"] = {"include_usage": True}
+    cache = getattr(request.app.state, "response_cache", None)
+    cache_key = None
+    if cache is not None:
+        cache_key, cached = cache.lookup(
+            request.headers, "/v1/messages:openai", openai_body, headers["Authorization"]
+        )
+        if cached is not None:
+            return cached
+
+    async def fetch():
+        if aggregate:
+            status_code, data = await fetch_aggregated(
+                request, "/chat/completions", OpenAIStreamAggregator(), json=openai_body, headers=headers
+            )
+            if status_code != 200 and not isinstance(data, bytes):
+                data = json.dumps(data).encode()
+        else:
+            started = time.monotonic()
+            response = await request.app.state.upstreams.request(
+                "POST",
+                "/chat/completions",
+                json=openai_body,
+                headers=headers
+            )
+            observe_response("/chat/completions", started, response.content)
+            status_code = response.status_code
+            data = response.json() if status_code == 200 else response.content
+
+        if status_code != 200:
+            return JSONResponse(
+                content=AnthropicAdapter.error_response(status_code, data),
+                status_code=status_code
+            )
+
+        json_response = JSONResponse(
+            content=AnthropicAdapter.openai_to_anthropic_response(data, body.get("model", ""))
+        )
+        if cache is not None:
+            if cache_key:
+                cache.set(cache_key, json_response.body, 200, "application/json")
+            ResponseCache.mark(json_response, cache_key)
+        return json_response
+
+    flights = get_single_flight(request)
+    if flights is None:
+        return await fetch()
+    return await flights.call(
+        cache_key or ResponseCache.make_key("/v1/messages:openai", openai_body, headers["Authorization"]),
+        fetch
     )
 
+
+async def handle_translated_streaming(request: Request, body: dict, headers: dict):
+    """OpenAI 格式的上游 SSE 流逐帧转换为 Anthropic 事件序列"""
+    openai_body = AnthropicAdapter.anthropic_request_to_openai(body)
+
+    async def open_stream():
+        meter = StreamMeter("/chat/completions")
+        response, chunks = await open_upstream_stream(
+            request,
+            "/chat/completions",
+            lambda r: r.aiter_bytes(),
+            json=openai_body,
+            headers=headers
+        )
+
+        if response.status_code != 200:
+            error_content = await response.aread()
+            await response.aclose()
+            error = AnthropicAdapter.error_response(response.status_code, error_content)
+            return response.status_code, {"Content-Type": "application/json"}, json.dumps(error).encode()
+
+        translator = AnthropicStreamTranslator(body.get("model", ""))
+        return 200, dict(SSE_HEADERS), meter.wrap(iter_sse(response, chunks, translator))
+
+    flights = get_single_flight(request)
+    if flights is None:
+        status_code, response_headers, chunks = await open_stream()
+        return build_stream_response(
+            request, status_code, response_headers, chunks, body.get("max_tokens")
+        )
+
+    key = ResponseCache.make_key("/v1/messages:openai:stream", openai_body, headers["Authorization"])
+    status_code, response_headers, chunks = await flights.stream(key, open_stream)
+    return build_stream_response(request, status_code, response_headers, chunks, None)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
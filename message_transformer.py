@@ -1,11 +1,21 @@
 """
 处理 reasoning_content 字段的转换和修复
 """
+import hashlib
 import json
 import re
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
 from uuid import uuid4
 
+from config import HISTORY_FIXER_CACHE_SIZE
+
+# 预编译的 <thinking> 标签匹配（sub 时整段替换，search 时取 group(1)）
+_THINKING_PATTERN = re.compile(r'<thinking>(.*?)</thinking>', re.DOTALL)
+
+# 工具调用消息缺少推理内容时使用的占位文本
+PLACEHOLDER_REASONING = "[Continuing previous tool execution analysis...]"
+
 class ReasoningContentTransformer:
     """
     修复 Kimi Thinking 模型在工具调用时的 reasoning_content 缺失问题
@@ -16,34 +26,39 @@ class ReasoningContentTransformer:
         """
         修复请求中的消息历史，确保 assistant 消息包含 reasoning_content
         """
-        fixed_messages = []
-        
-        for msg in messages:
-            if msg.get("role") == "assistant":
-                # 检查是否缺少 reasoning_content 但包含工具调用
-                has_tool_calls = "tool_calls" in msg and msg["tool_calls"]
-                has_reasoning = "reasoning_content" in msg
-                
-                if has_tool_calls and not has_reasoning:
-                    # 情况1：如果 content 包含 <thinking> 标签，提取出来
-                    content = msg.get("content", "") or ""
-                    reasoning_match = re.search(r'<thinking>(.*?)</thinking>', content, re.DOTALL)
-                    
-                    if reasoning_match:
-                        msg["reasoning_content"] = reasoning_match.group(1).strip()
-                        msg["content"] = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
-                    else:
-                        # 情况2：构造一个占位 reasoning_content（告诉模型"继续思考"）
-                        # 这是关键：让 Kimi API 知道这是一个延续的思考过程
-                        msg["reasoning_content"] = "[Continuing previous tool execution analysis...]"
-                
-                # 确保 reasoning_content 不为 None，而是字符串
-                if "reasoning_content" in msg and msg["reasoning_content"] is None:
-                    msg["reasoning_content"] = ""
-                    
-            fixed_messages.append(msg)
-        
-        return fixed_messages
+        return [ReasoningContentTransformer.fix_message(msg) for msg in messages]
+
+    @staticmethod
+    def fix_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        修复单条 OpenAI 格式消息，需要修改时返回副本，不修改调用方的 dict
+        """
+        if msg.get("role") != "assistant":
+            return msg
+
+        # 检查是否缺少 reasoning_content 但包含工具调用
+        has_tool_calls = "tool_calls" in msg and msg["tool_calls"]
+        has_reasoning = "reasoning_content" in msg
+
+        if has_tool_calls and not has_reasoning:
+            msg = dict(msg)
+            # 情况1：如果 content 包含 <thinking> 标签，提取出来
+            content = msg.get("content", "") or ""
+            reasoning_match = _THINKING_PATTERN.search(content)
+
+            if reasoning_match:
+                msg["reasoning_content"] = reasoning_match.group(1).strip()
+                msg["content"] = _THINKING_PATTERN.sub('', content).strip()
+            else:
+                # 情况2：构造一个占位 reasoning_content（告诉模型"继续思考"）
+                # 这是关键：让 Kimi API 知道这是一个延续的思考过程
+                msg["reasoning_content"] = PLACEHOLDER_REASONING
+        elif has_reasoning and msg["reasoning_content"] is None:
+            # 确保 reasoning_content 不为 None，而是字符串
+            msg = dict(msg)
+            msg["reasoning_content"] = ""
+
+        return msg
     
     @staticmethod
     def add_reasoning_to_assistant_chunk(chunk: Dict[str, Any]) -> Dict[str, Any]:
@@ -64,6 +79,40 @@ class ReasoningContentTransformer:
         
         return chunk
 
+    @staticmethod
+    def fix_stream_delta(
+        delta: Dict[str, Any],
+        extractor: Optional["ThinkingStreamExtractor"] = None
+    ) -> Dict[str, Any]:
+        """
+        修复流式响应中 assistant delta 缺失的 reasoning_content
+
+        传入 extractor 时，content 中跨 chunk 的 <thinking> 标签会被增量拆分
+        """
+        if "reasoning_content" in delta:
+            return delta
+
+        content = delta.get("content")
+        if extractor is not None and isinstance(content, str):
+            reasoning, content = extractor.feed(content)
+            delta["content"] = content
+            if reasoning:
+                delta["reasoning_content"] = reasoning
+        elif delta.get("role") == "assistant" and content and content.startswith("<thinking>"):
+            # 如果 content 以 <thinking> 开头，提取它
+            end_idx = content.find("</thinking>")
+            if end_idx != -1:
+                delta["reasoning_content"] = content[10:end_idx]
+                delta["content"] = content[end_idx+11:]
+            else:
+                delta["reasoning_content"] = content[10:]
+                delta["content"] = ""
+
+        if delta.get("role") == "assistant" and "reasoning_content" not in delta:
+            delta["reasoning_content"] = None
+
+        return delta
+
     @staticmethod
     def ensure_assistant_message_complete(message: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -74,10 +123,10 @@ class ReasoningContentTransformer:
                 # 尝试从 content 中提取 <thinking> 标签
                 content = message.get("content", "") or ""
                 if "<thinking>" in content:
-                    match = re.search(r'<thinking>(.*?)</thinking>', content, re.DOTALL)
+                    match = _THINKING_PATTERN.search(content)
                     if match:
                         message["reasoning_content"] = match.group(1).strip()
-                        message["content"] = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
+                        message["content"] = _THINKING_PATTERN.sub('', content).strip()
                 else:
                     message["reasoning_content"] = None
 
@@ -88,27 +137,261 @@ class ReasoningContentTransformer:
         """
         修复 Anthropic 格式的消息历史，确保 assistant 消息包含 reasoning_content
         """
-        fixed_messages = []
+        return [ReasoningContentTransformer.fix_anthropic_message(msg) for msg in messages]
+
+    @staticmethod
+    def fix_anthropic_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        修复单条 Anthropic 格式消息，需要修改时返回副本，不修改调用方的 dict
+        """
+        if msg.get("role") != "assistant":
+            return msg
+
+        # 检查是否有 thinking 字段（Anthropic 格式）
+        content = msg.get("content", [])
+
+        # content 是数组格式
+        if isinstance(content, list):
+            has_thinking = any(c.get("type") == "thinking" for c in content)
+            has_tool_use = any(c.get("type") == "tool_use" for c in content)
+
+            # 如果有 tool_use 但没有 thinking，在数组开头添加占位 thinking
+            if has_tool_use and not has_thinking:
+                msg = dict(msg)
+                msg["content"] = [{
+                    "type": "thinking",
+                    "thinking": PLACEHOLDER_REASONING
+                }] + content
+
+        return msg
+
+
+class ThinkingStreamExtractor:
+    """
+    流式 content 开头 <thinking> 段的增量拆分器（每个流 / choice 一个实例）
+
+    只有出现在任何非空白内容之前的 <thinking> 才视为推理段，回答正文中提到的标签原样保留；
+    推理段结束或正文开始后不再检查后续内容。标签可以在任意位置被 chunk 边界切断，
+    只缓存可能构成标签前缀的尾部字符，内存占用不超过最长标签的长度。
+    """
+
+    OPEN_TAG = "<thinking>"
+    CLOSE_TAG = "</thinking>"
+
+    # 拆分状态：等待开头的标签 / 推理段内 / 之后的内容原样输出
+    _LEADING, _THINKING, _DONE = range(3)
+
+    def __init__(self):
+        self._state = self._LEADING
+        self._pending = ""
+
+    @property
+    def active(self) -> bool:
+        """是否处于 thinking 段内或持有未决的标签前缀"""
+        return self._state == self._THINKING or bool(self._pending)
+
+    @property
+    def done(self) -> bool:
+        """之后的 content 不再需要拆分"""
+        return self._state == self._DONE
+
+    def stop(self) -> None:
+        """尚未出现推理段时结束检查（例如上游原生返回 reasoning_content 或开始工具调用）"""
+        if self._state == self._LEADING and not self._pending:
+            self._state = self._DONE
+
+    def feed(self, text: str) -> Tuple[str, str]:
+        """输入一段 content，返回 (reasoning, content)"""
+        if self._state == self._DONE:
+            return "", text
+        if self._pending:
+            text = self._pending + text
+            self._pending = ""
+
+        content = ""
+        if self._state == self._LEADING:
+            stripped = text.lstrip()
+            content = text[:len(text) - len(stripped)]
+            if stripped.startswith(self.OPEN_TAG):
+                self._state = self._THINKING
+                text = stripped[len(self.OPEN_TAG):]
+            elif stripped and self.OPEN_TAG.startswith(stripped):
+                self._pending = stripped
+                return "", content
+            else:
+                if stripped:
+                    self._state = self._DONE
+                return "", text
+
+        idx = text.find(self.CLOSE_TAG)
+        if idx != -1:
+            self._state = self._DONE
+            return text[:idx], content + text[idx + len(self.CLOSE_TAG):]
+        hold = self._partial_tag_length(text, self.CLOSE_TAG)
+        if hold:
+            self._pending = text[-hold:]
+            text = text[:-hold]
+        return text, content
+
+    def flush(self) -> Tuple[str, str]:
+        """流结束时输出残留的标签前缀"""
+        pending, self._pending = self._pending, ""
+        if self._state == self._THINKING:
+            return pending, ""
+        return "", pending
+
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """text 末尾与 tag 前缀重合的最大长度"""
+        start = text.rfind("<", max(0, len(text) - len(tag) + 1))
+        if start != -1 and tag.startswith(text[start:]):
+            return len(text) - start
+        return 0
+
+
+class IncrementalHistoryFixer:
+    """
+    带前缀记忆的消息历史修复器
+
+    为每次请求的消息序列计算滚动摘要，缓存已修复前缀中被修改过的消息；
+    多轮对话的下一次请求命中上一轮的前缀后，只需修复新增的尾部消息。
+    缓存按 (凭证, 前缀摘要) 索引，不同凭证的请求不会共用修复结果。
+    返回的修复后消息在请求之间共享，调用方不得原地修改。
+    """
+
+    def __init__(
+        self,
+        fix_one: Callable[[Dict[str, Any]], Dict[str, Any]],
+        max_entries: int = 1024
+    ):
+        self._fix_one = fix_one
+        self.max_entries = max_entries
+        # (凭证, 前缀摘要) -> {消息下标: 修复后的消息}
+        self._prefixes: "OrderedDict[Tuple[str, bytes], Dict[int, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def fix(
+        self,
+        messages: List[Dict[str, Any]],
+        hashes: Optional["MessageHashes"] = None,
+        credential: str = ""
+    ) -> List[Dict[str, Any]]:
+        """
+        hashes 为本次请求共用的消息摘要表，之后的 token 计数和提示缓存复用同一份结果；
+        credential 为请求的凭证，修复结果只在同一凭证的请求之间复用
+        """
+        if not messages:
+            return []
+
+        keys = [(credential, prefix) for prefix in (hashes or MessageHashes()).prefixes(messages)]
+
+        # 从最长前缀开始查找已修复的结果
+        start = 0
+        patches: Dict[int, Dict[str, Any]] = {}
+        for length in range(len(messages), 0, -1):
+            cached = self._prefixes.get(keys[length - 1])
+            if cached is not None:
+                self._prefixes.move_to_end(keys[length - 1])
+                start, patches = length, cached
+                break
+
+        if start:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        fixed = list(messages)
+        for index, msg in patches.items():
+            fixed[index] = msg
+
+        if start == len(messages):
+            return fixed
+
+        patches = dict(patches)
+        for index in range(start, len(messages)):
+            msg = self._fix_one(messages[index])
+            if msg is not messages[index]:
+                fixed[index] = msg
+                patches[index] = msg
+
+        self._prefixes[keys[-1]] = patches
+        while len(self._prefixes) > self.max_entries:
+            self._prefixes.popitem(last=False)
 
+        return fixed
+
+
+class MessageHashes:
+    """
+    单个请求内的消息内容摘要表，按消息对象身份记忆
+
+    历史修复、token 计数和提示缓存断点都要对整个消息历史求摘要，同一请求内只计算一次。
+    由 RawJSONBody 创建时直接使用解析时算好的原文片段摘要，未修改的消息无需 freeze；
+    修复后新产生的消息对象才按 content_digest 计算。
+    摘要为 128 位 blake2b，跨请求的缓存直接以摘要为 key，不再另做相等比较。
+    """
+
+    def __init__(self, body: Any = None):
+        # id(消息) -> (消息, 摘要)；保留消息的引用，避免 id 被回收后复用
+        self._memo: Dict[int, Tuple[Any, bytes]] = {}
+        original = getattr(body, "original_message_hashes", None)
+        if original is not None:
+            for msg, digest in original():
+                self._memo[id(msg)] = (msg, digest)
+
+    def get(self, msg: Any) -> bytes:
+        entry = self._memo.get(id(msg))
+        if entry is not None and entry[0] is msg:
+            return entry[1]
+        digest = content_digest(msg)
+        self._memo[id(msg)] = (msg, digest)
+        return digest
+
+    def prefixes(self, messages: List[Any], seed: bytes = b"") -> List[bytes]:
+        """逐条消息的滚动摘要，第 i 项对应前 i+1 条消息组成的前缀"""
+        digests = []
+        previous = seed
         for msg in messages:
-            if msg.get("role") == "assistant":
-                # 检查是否有 thinking 字段（Anthropic 格式）
-                content = msg.get("content", [])
-
-                # content 是数组格式
-                if isinstance(content, list):
-                    has_thinking = any(c.get("type") == "thinking" for c in content)
-                    has_tool_use = any(c.get("type") == "tool_use" for c in content)
-
-                    # 如果有 tool_use 但没有 thinking，添加一个占位 thinking
-                    if has_tool_use and not has_thinking:
-                        # 在数组开头添加占位 thinking
-                        content.insert(0, {
-                            "type": "thinking",
-                            "thinking": "[Continuing previous tool execution analysis...]"
-                        })
-                        msg["content"] = content
-
-            fixed_messages.append(msg)
-
-        return fixed_messages
\ No newline at end of file
+            previous = hashlib.blake2b(previous + self.get(msg), digest_size=DIGEST_SIZE).digest()
+            digests.append(previous)
+        return digests
+
+
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def freeze(value: Any) -> Any:
+    """把 JSON 值转换为可哈希的嵌套 tuple（标量原样保留，避免逐层递归）"""
+    if isinstance(value, dict):
+        return (dict, tuple([
+            (key, item if item.__class__ in _SCALAR_TYPES else freeze(item))
+            for key, item in value.items()
+        ]))
+    if isinstance(value, list):
+        return (list, tuple([
+            item if item.__class__ in _SCALAR_TYPES else freeze(item)
+            for item in value
+        ]))
+    return value
+
+
+# 内容摘要的字节数（128 位，碰撞概率可以忽略）
+DIGEST_SIZE = 16
+
+
+def content_digest(value: Any) -> bytes:
+    """
+    JSON 值的内容摘要：freeze 结果的 repr 取 blake2b
+
+    repr 区分 1 / True / 1.0 和 "1" / 1，而这些值的 Python hash 相同。
+    """
+    return hashlib.blake2b(repr(freeze(value)).encode(), digest_size=DIGEST_SIZE, person=b"frozen").digest()
+
+
+OPENAI_HISTORY_FIXER = IncrementalHistoryFixer(
+    ReasoningContentTransformer.fix_message, HISTORY_FIXER_CACHE_SIZE
+)
+ANTHROPIC_HISTORY_FIXER = IncrementalHistoryFixer(
+    ReasoningContentTransformer.fix_anthropic_message, HISTORY_FIXER_CACHE_SIZE
+)
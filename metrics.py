@@ -0,0 +1,287 @@
+"""
+Prometheus 指标
+设置 PROMETHEUS_MULTIPROC_DIR 时使用 prometheus_client 的多进程模式，在 gunicorn 的多个 worker 之间聚合；
+未安装 prometheus_client 时所有指标为空操作
+"""
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional, Tuple
+
+from tracing import current_trace
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        REGISTRY,
+        CollectorRegistry,
+        Counter,
+        Gauge,
+        Histogram,
+        generate_latest,
+        multiprocess,
+    )
+except ImportError:  # pragma: no cover - 可选依赖
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+    Counter = Gauge = Histogram = None
+
+# 统计并发数的路由
+TRACKED_ROUTES = frozenset({"/v1/chat/completions", "/v1/messages"})
+
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+CHUNK_BUCKETS = (1, 10, 50, 100, 500, 1000, 2500, 5000, 10000, 50000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# 从响应 / 流的 usage 块中提取输出 token 数（OpenAI 与 Anthropic 两种字段名）
+_OUTPUT_TOKENS_PATTERN = re.compile(rb'"(?:completion_tokens|output_tokens)"\s*:\s*(\d+)')
+# 提示缓存命中 / 写入的输入 token 数（Anthropic 的 cache_*_input_tokens，OpenAI 的 cached_tokens 计为命中）
+_CACHE_TOKENS_PATTERN = re.compile(rb'"(cache_read_input_tokens|cached_tokens|cache_creation_input_tokens)"\s*:\s*(\d+)')
+# 跨 chunk 边界匹配 usage 字段时保留的流尾部字节数（大于上面任一字段的最大长度）
+_USAGE_TAIL_BYTES = 128
+
+
+class _NoopMetric:
+    """prometheus_client 不可用时的占位指标"""
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+def _histogram(name: str, documentation: str, labels: tuple, buckets: tuple) -> Any:
+    if Histogram is None:
+        return _NoopMetric()
+    return Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name: str, documentation: str, labels: tuple) -> Any:
+    if Counter is None:
+        return _NoopMetric()
+    return Counter(name, documentation, labels)
+
+
+def _gauge(name: str, documentation: str, labels: tuple) -> Any:
+    if Gauge is None:
+        return _NoopMetric()
+    # 多进程模式下对所有存活 worker 求和
+    return Gauge(name, documentation, labels, multiprocess_mode="livesum")
+
+
+BODY_PARSE_SECONDS = _histogram(
+    "proxy_body_parse_seconds", "Time spent parsing the request body", ("route",), STAGE_BUCKETS
+)
+TRANSFORM_SECONDS = _histogram(
+    "proxy_transform_seconds", "Time spent in ReasoningContentTransformer fixes", ("route",), STAGE_BUCKETS
+)
+UPSTREAM_TTFB_SECONDS = _histogram(
+    "proxy_upstream_ttfb_seconds", "Time from upstream request to first body byte", ("route",), LATENCY_BUCKETS
+)
+UPSTREAM_DURATION_SECONDS = _histogram(
+    "proxy_upstream_duration_seconds", "Total time of non-streaming upstream requests", ("route",), LATENCY_BUCKETS
+)
+STREAM_DURATION_SECONDS = _histogram(
+    "proxy_stream_duration_seconds", "Total duration of relayed streams", ("route",), LATENCY_BUCKETS
+)
+STREAM_CHUNKS = _histogram(
+    "proxy_stream_chunks", "Chunks relayed per stream", ("route",), CHUNK_BUCKETS
+)
+STREAM_BYTES = _histogram(
+    "proxy_stream_bytes", "Bytes relayed per stream", ("route",), BYTE_BUCKETS
+)
+OUTPUT_TOKENS_PER_SECOND = _histogram(
+    "proxy_output_tokens_per_second", "Output tokens per second derived from usage", ("route",), TOKEN_RATE_BUCKETS
+)
+OUTPUT_TOKENS_TOTAL = _counter(
+    "proxy_output_tokens", "Output tokens reported by upstream usage", ("route",)
+)
+UPSTREAM_RESPONSES_TOTAL = _counter(
+    "proxy_upstream_responses", "Upstream responses by status code", ("route", "status")
+)
+STREAM_ABORTS_TOTAL = _counter(
+    "proxy_stream_aborts", "Upstream streams aborted after client disconnect", ()
+)
+STREAM_SAVED_TOKENS_TOTAL = _counter(
+    "proxy_stream_saved_tokens", "Estimated tokens saved by aborting upstream streams", ()
+)
+PROMPT_CACHE_READ_TOKENS_TOTAL = _counter(
+    "proxy_prompt_cache_read_tokens", "Input tokens read from the upstream prompt cache", ("route",)
+)
+PROMPT_CACHE_CREATION_TOKENS_TOTAL = _counter(
+    "proxy_prompt_cache_creation_tokens", "Input tokens written to the upstream prompt cache", ("route",)
+)
+PROMPT_CACHE_BREAKPOINTS_TOTAL = _counter(
+    "proxy_prompt_cache_breakpoints", "Cache breakpoints injected into requests", ()
+)
+ADMISSION_REJECTED_TOTAL = _counter(
+    "proxy_admission_rejected", "Requests rejected by admission control", ("reason",)
+)
+INFLIGHT_REQUESTS = _gauge(
+    "proxy_inflight_requests", "Requests currently being handled", ("route",)
+)
+UPSTREAM_OUTSTANDING = _gauge(
+    "proxy_upstream_outstanding", "Outstanding requests per upstream", ("upstream",)
+)
+ADMISSION_QUEUED = _gauge(
+    "proxy_admission_queued", "Requests waiting in the admission queue", ("priority",)
+)
+UPSTREAM_CONCURRENCY_LIMIT = _gauge(
+    "proxy_upstream_concurrency_limit", "Adaptive concurrency limit per upstream", ("upstream",)
+)
+UPSTREAM_CONNECTIONS = _gauge(
+    "proxy_upstream_connections", "Open pooled connections per upstream", ("upstream",)
+)
+
+
+@contextmanager
+def timed(histogram: Any, route: str, span: Optional[str] = None) -> Iterator[None]:
+    """记录代码块耗时；指定 span 时同时计入当前请求的追踪"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.labels(route).observe(elapsed)
+        if span is not None:
+            trace = current_trace()
+            if trace is not None:
+                trace.add(span, elapsed)
+
+
+def parse_output_tokens(data: bytes) -> Optional[int]:
+    """从响应字节中取最后一个 usage 输出 token 数"""
+    if b"_tokens" not in data:
+        return None
+    matches = _OUTPUT_TOKENS_PATTERN.findall(data)
+    return int(matches[-1]) if matches else None
+
+
+def parse_cache_tokens(data: bytes) -> Optional[Tuple[int, int]]:
+    """从响应字节中取最后一次出现的 (缓存命中, 缓存写入) token 数"""
+    if b"cache" not in data:
+        return None
+    usage = {}
+    for name, value in _CACHE_TOKENS_PATTERN.findall(data):
+        usage[name] = int(value)
+    if not usage:
+        return None
+    read = usage.get(b"cache_read_input_tokens", usage.get(b"cached_tokens", 0))
+    return read, usage.get(b"cache_creation_input_tokens", 0)
+
+
+def observe_cache_tokens(route: str, usage: Optional[Tuple[int, int]]) -> None:
+    if not usage:
+        return
+    read, creation = usage
+    if read:
+        PROMPT_CACHE_READ_TOKENS_TOTAL.labels(route).inc(read)
+    if creation:
+        PROMPT_CACHE_CREATION_TOKENS_TOTAL.labels(route).inc(creation)
+
+
+def observe_output_tokens(route: str, tokens: Optional[int], duration: float) -> None:
+    if not tokens:
+        return
+    OUTPUT_TOKENS_TOTAL.labels(route).inc(tokens)
+    if duration > 0:
+        OUTPUT_TOKENS_PER_SECOND.labels(route).observe(tokens / duration)
+
+
+def observe_response(route: str, started: float, content: bytes) -> None:
+    """记录非流式响应的上游总耗时（不是首字节延迟，记入单独的直方图）和输出 token 速率"""
+    duration = time.monotonic() - started
+    UPSTREAM_DURATION_SECONDS.labels(route).observe(duration)
+    observe_output_tokens(route, parse_output_tokens(content), duration)
+    observe_cache_tokens(route, parse_cache_tokens(content))
+
+
+class StreamMeter:
+    """
+    单个流的计量：首字节延迟、总时长、chunk 数、字节数、输出 token 速率和提示缓存 token 数
+
+    只在包含 "_tokens" / "cache" 的 chunk 上做正则匹配，其余 chunk 只累加计数。
+    usage 可能在流中多次出现（Anthropic 的 message_start 和 message_delta），取最后一次的值。
+    usage 字段可能被 chunk 边界切断，另外在"流尾部 + 本 chunk 开头"拼成的窗口上匹配一次。
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.monotonic()
+
+    async def wrap(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        count = 0
+        size = 0
+        output_tokens = None
+        cache_tokens = None
+        tail = b""
+        try:
+            async for chunk in chunks:
+                if not count:
+                    UPSTREAM_TTFB_SECONDS.labels(self.route).observe(time.monotonic() - self.started)
+                count += 1
+                size += len(chunk)
+                # 先匹配跨边界的窗口，再匹配 chunk 本身：chunk 内完整的值更新，覆盖窗口的结果
+                for data in (tail + chunk[:_USAGE_TAIL_BYTES], chunk):
+                    tokens = parse_output_tokens(data)
+                    if tokens is not None:
+                        output_tokens = tokens
+                    usage = parse_cache_tokens(data)
+                    if usage is not None:
+                        cache_tokens = usage
+                tail = chunk[-_USAGE_TAIL_BYTES:] if len(chunk) >= _USAGE_TAIL_BYTES \
+                    else (tail + chunk)[-_USAGE_TAIL_BYTES:]
+                yield chunk
+        finally:
+            duration = time.monotonic() - self.started
+            STREAM_DURATION_SECONDS.labels(self.route).observe(duration)
+            STREAM_CHUNKS.labels(self.route).observe(count)
+            STREAM_BYTES.labels(self.route).observe(size)
+            observe_output_tokens(self.route, output_tokens, duration)
+            observe_cache_tokens(self.route, cache_tokens)
+
+
+class InflightMiddleware:
+    """ASGI 中间件：按路由统计正在处理（含流式转发中）的请求数"""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        path = scope.get("path") if scope["type"] == "http" else None
+        if path not in TRACKED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        gauge = INFLIGHT_REQUESTS.labels(path)
+        gauge.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gauge.dec()
+
+
+def render_metrics() -> bytes:
+    """生成 Prometheus 文本格式；多进程模式下汇总所有 worker 的指标文件"""
+    if Counter is None:
+        return b""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
@@ -0,0 +1,180 @@
+"""
+提示缓存断点注入：为 /v1/messages 请求中稳定且足够长的前缀自动加上 cache_control
+
+上游按 tools → system → messages 的顺序缓存到断点为止的前缀，每个请求最多 4 个断点。
+客户端没有自己设置断点时，代理按会话记录各段前缀的哈希：
+- tools / system 在同一凭据和模型下重复出现即视为稳定
+- 同一会话（相同的 tools、system 和首条消息）上一轮请求的消息前缀在本轮再次出现即视为稳定，
+  在该前缀末尾放置读缓存的断点，并在本轮最后一条消息上放置写缓存的断点供下一轮读取
+累计 token 数不足 min_tokens 的前缀不会被上游缓存，不放置断点。
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from message_transformer import MessageHashes, content_digest
+from token_counter import TokenCounter
+
+# 上游每个请求允许的最多断点数
+MAX_BREAKPOINTS = 4
+# 不能携带 cache_control 的 content block
+_UNCACHEABLE_BLOCKS = frozenset({"thinking", "redacted_thinking"})
+
+
+def has_cache_control(body: Dict[str, Any]) -> bool:
+    """请求中是否已有客户端设置的断点"""
+    raw = getattr(body, "raw", None)
+    if raw is not None:
+        # RawJSONBody 直接在原始字节上查找，避免遍历所有 content block
+        return b'"cache_control"' in raw
+
+    blocks: List[Any] = list(body.get("tools") or [])
+    if isinstance(body.get("system"), list):
+        blocks.extend(body["system"])
+    for msg in body.get("messages") or []:
+        if isinstance(msg, dict) and isinstance(msg.get("content"), list):
+            blocks.extend(msg["content"])
+    return any(isinstance(block, dict) and "cache_control" in block for block in blocks)
+
+
+class PromptCacheOptimizer:
+    """
+    按会话跟踪前缀哈希并注入缓存断点
+
+    min_tokens 为可缓存前缀的最小 token 数（按 TokenCounter 估算）；
+    max_sessions 限制记录的前缀和会话数，按 LRU 淘汰；
+    ttl 非空时写入 cache_control 的 ttl 字段（如 "1h"）。
+    注入时复制被修改的对象而不原地修改，修复器缓存的消息和 RawJSONBody 的变更检测依赖这一点。
+    """
+
+    def __init__(
+        self,
+        counter: TokenCounter,
+        min_tokens: int = 1024,
+        max_sessions: int = 10000,
+        ttl: Optional[str] = None
+    ):
+        self.counter = counter
+        self.min_tokens = min_tokens
+        self.max_sessions = max_sessions
+        self.cache_control: Dict[str, str] = {"type": "ephemeral"}
+        if ttl:
+            self.cache_control["ttl"] = ttl
+        self._prefixes: "OrderedDict[bytes, None]" = OrderedDict()
+        self._sessions: "OrderedDict[bytes, Set[bytes]]" = OrderedDict()
+        self.requests = 0
+        self.breakpoints = 0
+
+    def _seen(self, key: bytes) -> bool:
+        """记录一个前缀哈希，返回它之前是否出现过"""
+        seen = key in self._prefixes
+        self._prefixes[key] = None
+        self._prefixes.move_to_end(key)
+        if len(self._prefixes) > self.max_sessions:
+            self._prefixes.popitem(last=False)
+        return seen
+
+    def _previous_prefixes(self, session: bytes, prefixes: Set[bytes]) -> Optional[Set[bytes]]:
+        """替换会话记录的消息前缀哈希，返回上一轮的记录"""
+        previous = self._sessions.pop(session, None)
+        self._sessions[session] = prefixes
+        if len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return previous
+
+    def _mark_blocks(self, blocks: Any) -> Optional[List[Any]]:
+        """复制 content block 列表，在最后一个可缓存的 block 上加断点"""
+        if isinstance(blocks, str):
+            if not blocks:
+                return None
+            return [{"type": "text", "text": blocks, "cache_control": self.cache_control}]
+        if not isinstance(blocks, list):
+            return None
+        for index in range(len(blocks) - 1, -1, -1):
+            block = blocks[index]
+            if isinstance(block, dict) and block.get("type") not in _UNCACHEABLE_BLOCKS:
+                marked = list(blocks)
+                marked[index] = dict(block, cache_control=self.cache_control)
+                return marked
+        return None
+
+    def apply(self, body: Dict[str, Any], credential: str, hashes: Optional[MessageHashes] = None) -> int:
+        """为请求注入缓存断点，返回注入的断点数；hashes 为本次请求共用的消息哈希表"""
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages or has_cache_control(body):
+            return 0
+
+        tools = body.get("tools") or []
+        system = body.get("system")
+        tools_key = content_digest([credential, body.get("model"), tools])
+        system_key = content_digest([tools_key, system])
+        tools_stable = self._seen(tools_key)
+        system_stable = self._seen(system_key)
+
+        # 滚动摘要：prefixes[i] 对应前 i + 1 条消息
+        if hashes is None:
+            hashes = MessageHashes(body)
+        prefixes = hashes.prefixes(messages, seed=system_key)
+        previous = self._previous_prefixes(system_key + hashes.get(messages[0]), set(prefixes))
+
+        # 候选断点按前缀从短到长排列：("tools"|"system"|消息下标, 前缀 token 数)
+        candidates = []
+        tokens = self.counter.count_tools(tools)
+        if tools and tools_stable:
+            candidates.append(("tools", tokens))
+        tokens += self.counter.count_system(system)
+        if system and system_stable:
+            candidates.append(("system", tokens))
+
+        stable = 0
+        if previous:
+            for index in range(len(prefixes) - 1, -1, -1):
+                if prefixes[index] in previous:
+                    stable = index + 1
+                    break
+        message_tokens = [self.counter.count_message(msg, hashes.get(msg)) for msg in messages]
+        if stable:
+            candidates.append((stable - 1, tokens + sum(message_tokens[:stable])))
+            if stable < len(messages):
+                # 会话在延续：最后一条消息上的断点写入缓存，下一轮从这里读取
+                candidates.append((len(messages) - 1, tokens + sum(message_tokens)))
+
+        # 前缀越长覆盖越多，超出上限时保留最长的几个
+        targets = [target for target, size in candidates if size >= self.min_tokens][-MAX_BREAKPOINTS:]
+        if not targets:
+            return 0
+
+        inserted = 0
+        new_messages = None
+        for target in targets:
+            if target == "tools":
+                marked_tool = dict(tools[-1], cache_control=self.cache_control) if isinstance(tools[-1], dict) else None
+                if marked_tool is not None:
+                    body["tools"] = tools[:-1] + [marked_tool]
+                    inserted += 1
+            elif target == "system":
+                marked = self._mark_blocks(system)
+                if marked is not None:
+                    body["system"] = marked
+                    inserted += 1
+            else:
+                msg = messages[target]
+                marked = self._mark_blocks(msg.get("content")) if isinstance(msg, dict) else None
+                if marked is not None:
+                    if new_messages is None:
+                        new_messages = list(messages)
+                    new_messages[target] = dict(msg, content=marked)
+                    inserted += 1
+        if new_messages is not None:
+            body["messages"] = new_messages
+
+        if inserted:
+            self.requests += 1
+            self.breakpoints += inserted
+        return inserted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "breakpoints": self.breakpoints,
+            "sessions": len(self._sessions),
+        }
@@ -0,0 +1,191 @@
+"""
+保留原始字节的请求体：修复后只把变化的片段重新序列化并拼接回原文
+
+大上下文请求（长历史、base64 图片）的请求体常有数 MB，完整的 json.dumps 重新序列化
+占据了请求路径上的大部分 CPU 和峰值内存；而修复通常只涉及少数几条 assistant 消息。
+"""
+import hashlib
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from message_transformer import DIGEST_SIZE
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+Span = Tuple[int, int]
+
+
+class RawJSONBody(dict):
+    """
+    JSON 对象请求体（dict 子类），记录每个顶层字段值以及 messages 中每条消息在原文中的位置
+
+    to_bytes() 对比当前值与解析出的原始对象（按对象身份），只重新序列化被替换的顶层字段
+    或 messages 中被替换的消息；没有任何修改时直接返回原始字节。
+    修改必须通过替换对象完成（body["x"] = ... 或替换 messages 中的元素），
+    对解析出的嵌套对象的原地修改不会被检测到。
+    """
+
+    def __init__(self, raw: bytes):
+        super().__init__()
+        self.raw = raw
+        self._spans: Dict[str, Span] = {}
+        self._originals: Dict[str, Any] = {}
+        self._message_spans: List[Span] = []
+        self._message_hashes: List[bytes] = []
+        self._messages: Optional[List[Any]] = None
+        self._close = 0
+        try:
+            text = raw.decode("utf-8")
+        except UnicodeDecodeError as e:
+            raise json.JSONDecodeError("Invalid UTF-8", "", e.start) from None
+        self._parse(text)
+
+    def _parse(self, text: str) -> None:
+        pos = self._skip(text, 0)
+        self._expect(text, pos, "{")
+        pos = self._skip(text, pos + 1)
+
+        if text.startswith("}", pos):
+            self._close = pos
+        else:
+            while True:
+                self._expect(text, pos, '"')
+                key, pos = _DECODER.raw_decode(text, pos)
+                pos = self._skip(text, pos)
+                self._expect(text, pos, ":")
+                pos = self._skip(text, pos + 1)
+
+                if key == "messages" and text.startswith("[", pos):
+                    value, end = self._parse_messages(text, pos)
+                else:
+                    value, end = _DECODER.raw_decode(text, pos)
+                self[key] = value
+                self._originals[key] = value
+                self._spans[key] = (pos, end)
+
+                pos = self._skip(text, end)
+                if text.startswith(",", pos):
+                    pos = self._skip(text, pos + 1)
+                    continue
+                self._expect(text, pos, "}")
+                self._close = pos
+                break
+
+        if self._skip(text, self._close + 1) != len(text):
+            raise json.JSONDecodeError("Extra data", text, self._close + 1)
+
+    def _parse_messages(self, text: str, pos: int) -> Tuple[List[Any], int]:
+        """逐条解析 messages 数组，记录每条消息的位置和原文片段的摘要"""
+        messages: List[Any] = []
+        spans: List[Span] = []
+        hashes: List[bytes] = []
+        pos = self._skip(text, pos + 1)
+        if not text.startswith("]", pos):
+            while True:
+                value, end = _DECODER.raw_decode(text, pos)
+                messages.append(value)
+                spans.append((pos, end))
+                hashes.append(hashlib.blake2b(
+                    text[pos:end].encode(), digest_size=DIGEST_SIZE, person=b"raw-json"
+                ).digest())
+                pos = self._skip(text, end)
+                if text.startswith(",", pos):
+                    pos = self._skip(text, pos + 1)
+                    continue
+                self._expect(text, pos, "]")
+                break
+        self._messages = messages
+        self._message_spans = spans
+        self._message_hashes = hashes
+        return list(messages), pos + 1
+
+    def original_message_hashes(self) -> List[Tuple[Any, bytes]]:
+        """
+        解析出的每条原始消息及其原文片段的 blake2b 摘要
+
+        对原文片段求摘要是 C 实现的线性扫描，远快于遍历解析后的对象；
+        原文相同的消息摘要相同，可以代替 content_digest 作为未修改消息的内容摘要。
+        """
+        return list(zip(self._messages or (), self._message_hashes))
+
+    @staticmethod
+    def _skip(text: str, pos: int) -> int:
+        return _WHITESPACE.match(text, pos).end()
+
+    @staticmethod
+    def _expect(text: str, pos: int, char: str) -> None:
+        if not text.startswith(char, pos):
+            raise json.JSONDecodeError(f"Expecting '{char}'", text, pos)
+
+    def _splices(self) -> Optional[List[Tuple[int, int, str]]]:
+        """计算 (起点, 终点, 替换文本) 列表；有字段被删除时返回 None，需要整体重新序列化"""
+        if any(key not in self for key in self._spans):
+            return None
+
+        splices = []
+        inserts: List[str] = []
+        for key, value in self.items():
+            if key not in self._spans:
+                # 新增字段插入到右花括号之前；对象中已有成员（原有字段或先插入的字段）时需要逗号分隔
+                prefix = "," if self._spans or inserts else ""
+                inserts.append(f"{prefix}{json.dumps(key)}:{json.dumps(value, ensure_ascii=False)}")
+                continue
+
+            original = self._originals[key]
+            if value is original:
+                continue
+            if key == "messages" and self._messages is not None and isinstance(value, list) \
+                    and len(value) == len(self._messages):
+                for (start, end), new, old in zip(self._message_spans, value, self._messages):
+                    if new is not old:
+                        splices.append((start, end, json.dumps(new, ensure_ascii=False)))
+                continue
+            if value.__class__ is original.__class__ and not isinstance(value, (dict, list)) \
+                    and value == original:
+                continue
+            start, end = self._spans[key]
+            splices.append((start, end, json.dumps(value, ensure_ascii=False)))
+        if inserts:
+            # 合并为一个片段，保持插入顺序
+            splices.append((self._close, self._close, "".join(inserts)))
+        return splices
+
+    def to_bytes(self) -> bytes:
+        """序列化为发往上游的请求体"""
+        splices = self._splices()
+        if splices is None:
+            return json.dumps(self, ensure_ascii=False).encode()
+        if not splices:
+            return self.raw
+
+        splices.sort()
+        if self.raw.isascii():
+            # 纯 ASCII 时字符位置即字节位置，直接在原始字节上拼接
+            source: Any = self.raw
+            pieces: List[Any] = []
+            pos = 0
+            for start, end, replacement in splices:
+                pieces.append(source[pos:start])
+                pieces.append(replacement.encode())
+                pos = end
+            pieces.append(source[pos:])
+            return b"".join(pieces)
+
+        text = self.raw.decode("utf-8")
+        pieces = []
+        pos = 0
+        for start, end, replacement in splices:
+            pieces.append(text[pos:start])
+            pieces.append(replacement)
+            pos = end
+        pieces.append(text[pos:])
+        return "".join(pieces).encode()
+
+
+def encode_body(body: Dict[str, Any]) -> bytes:
+    """请求体序列化：RawJSONBody 只拼接修改过的片段，普通 dict 完整序列化"""
+    if isinstance(body, RawJSONBody):
+        return body.to_bytes()
+    return json.dumps(body, ensure_ascii=False).encode()
@@ -0,0 +1,125 @@
+"""
+回放录制的流量
+
+按记录中的时间间隔（可按倍率缩放）把请求重新发送到目标代理，完整读取响应并统计状态码与耗时。
+
+用法:
+  python replay.py captures/requests.jsonl --target http://127.0.0.1:8000
+  python replay.py captures/requests.jsonl.1 captures/requests.jsonl --speed 2 --api-key sk-...
+  python replay.py captures/requests.jsonl --speed 0 --concurrency 16   # 不等待间隔，尽快发送
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+import httpx
+
+
+def load_records(paths: List[str]) -> List[Dict[str, Any]]:
+    """读取录制文件，跳过没有请求体（被截断）或无法解析的行，按时间排序"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record.get("body"), dict) and record.get("path"):
+                    records.append(record)
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
+
+
+def build_headers(record: Dict[str, Any], api_key: str) -> Dict[str, str]:
+    """录制时凭证已脱敏，回放使用命令行提供的凭证"""
+    headers = {
+        name: value for name, value in record.get("headers", {}).items()
+        if name not in ("authorization", "x-api-key")
+    }
+    headers["Content-Type"] = "application/json"
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+        headers["x-api-key"] = api_key
+    return headers
+
+
+async def send(client: httpx.AsyncClient, record: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+    start = time.monotonic()
+    try:
+        async with client.stream(
+            "POST", record["path"], json=record["body"], headers=build_headers(record, api_key)
+        ) as response:
+            async for _ in response.aiter_raw():
+                pass
+        status = str(response.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    return {
+        "status": status,
+        "original_status": record.get("status"),
+        "duration": time.monotonic() - start,
+        "original_duration": record.get("duration"),
+    }
+
+
+async def replay(records: List[Dict[str, Any]], target: str, speed: float, concurrency: int, api_key: str):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=target, timeout=300.0, limits=limits) as client:
+        async def run(record: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await send(client, record, api_key)
+
+        tasks = []
+        first_ts = records[0].get("ts", 0)
+        started = time.monotonic()
+        for record in records:
+            if speed > 0:
+                delay = (record.get("ts", first_ts) - first_ts) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(run(record)))
+        results = await asyncio.gather(*tasks)
+        return results, time.monotonic() - started
+
+
+def report(results: List[Dict[str, Any]], elapsed: float) -> None:
+    durations = sorted(r["duration"] for r in results)
+    print(f"{len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.1f} req/s)")
+    print(f"latency p50 {durations[len(durations) // 2] * 1000:.0f}ms, "
+          f"p99 {durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000:.0f}ms")
+    print("status:", dict(Counter(r["status"] for r in results)))
+    changed = [r for r in results if str(r["original_status"]) != r["status"]]
+    if changed:
+        print(f"{len(changed)} requests returned a different status than recorded:",
+              dict(Counter(f"{r['original_status']} -> {r['status']}" for r in changed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="录制的 JSONL 文件")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="目标代理地址")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速率倍数，0 表示不等待原始间隔")
+    parser.add_argument("--concurrency", type=int, default=64, help="最大并发请求数")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的请求数")
+    parser.add_argument("--api-key", default=os.getenv("ZENMUX_API_KEY", ""), help="回放使用的 API 密钥")
+    args = parser.parse_args()
+
+    records = load_records(args.files)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("no replayable records")
+
+    results, elapsed = asyncio.run(replay(records, args.target, args.speed, args.concurrency, args.api_key))
+    report(results, elapsed)
+
+
+if __name__ == "__main__":
+    main()
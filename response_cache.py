@@ -0,0 +1,144 @@
+"""
+非流式响应的内容寻址缓存
+按修复后的完整请求体规范化哈希，LRU + TTL 淘汰
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from fastapi import Response
+
+# 不参与缓存键计算的请求字段：只影响传输方式，流式与非流式已由路由区分
+CACHE_KEY_EXCLUDED_FIELDS = frozenset({"stream"})
+
+CACHE_STATUS_HEADER = "X-Proxy-Cache"
+CACHE_BYPASS_HEADER = "x-proxy-cache"
+
+
+class CachedResponse(NamedTuple):
+    """缓存的上游响应"""
+    content: bytes
+    status_code: int
+    media_type: str
+    expires_at: float
+
+    def to_response(self, cache_status: str) -> Response:
+        return Response(
+            content=self.content,
+            status_code=self.status_code,
+            media_type=self.media_type,
+            headers={CACHE_STATUS_HEADER: cache_status}
+        )
+
+
+class ResponseCache:
+    """
+    进程内响应缓存
+
+    只缓存 200 响应；条目数和总字节数都有上限，超出时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(route: str, body: Dict[str, Any], credential: str) -> str:
+        """
+        计算请求的规范化哈希，不同 API key 的缓存互相隔离
+
+        除 CACHE_KEY_EXCLUDED_FIELDS 外的所有字段都参与计算（键按字典序排列），
+        任何可能改变输出的字段（包括上游扩展字段）不同的请求都不会共享缓存或合并。
+        """
+        canonical = {field: value for field, value in body.items() if field not in CACHE_KEY_EXCLUDED_FIELDS}
+        payload = json.dumps(
+            [route, canonical],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False
+        )
+        digest = hashlib.sha256(credential.encode())
+        digest.update(payload.encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def is_bypassed(headers: Mapping[str, str]) -> bool:
+        """客户端通过 Cache-Control: no-cache / no-store 或 X-Proxy-Cache: bypass 绕过缓存"""
+        if headers.get(CACHE_BYPASS_HEADER, "").lower() == "bypass":
+            return True
+        cache_control = headers.get("cache-control", "").lower()
+        return "no-cache" in cache_control or "no-store" in cache_control
+
+    def lookup(
+        self,
+        headers: Mapping[str, str],
+        route: str,
+        body: Dict[str, Any],
+        credential: str
+    ) -> Tuple[Optional[str], Optional[Response]]:
+        """返回 (cache_key, 命中的响应)；绕过缓存时 cache_key 为 None"""
+        if self.is_bypassed(headers):
+            return None, None
+
+        key = self.make_key(route, body, credential)
+        cached = self.get(key)
+        if cached is None:
+            return key, None
+        return key, cached.to_response("HIT")
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: str, content: bytes, status_code: int, media_type: str) -> None:
+        if status_code != 200 or len(content) > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CachedResponse(
+            content=content,
+            status_code=status_code,
+            media_type=media_type,
+            expires_at=time.monotonic() + self.ttl
+        )
+        self._bytes += len(content)
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.content)
+
+    @staticmethod
+    def mark(response: Response, key: Optional[str]) -> Response:
+        """为未命中缓存的响应添加 X-Proxy-Cache 头"""
+        response.headers[CACHE_STATUS_HEADER] = "MISS" if key else "BYPASS"
+        return response
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,321 @@
+"""
+gunicorn 多 worker 之间共享的状态：响应缓存条目、按 key 限流的令牌桶和统计计数
+
+全部存放在共享内存文件系统（默认 /dev/shm）的目录下，不依赖外部服务：
+- 响应缓存每个条目一个文件，写入临时文件后原子重命名，读取无需加锁
+- 令牌桶和计数器存放在 mmap 的定长槽位表中，每次读改写只对单个槽位加 fcntl 字节范围锁，
+  不同 key 之间互不阻塞
+Prometheus 指标在多进程模式（PROMETHEUS_MULTIPROC_DIR）下已由 prometheus_client 汇总，不在此重复。
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from response_cache import CachedResponse, ResponseCache
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows 无 fcntl，只能使用进程内状态
+    fcntl = None
+
+# 缓存文件头：过期时间（Unix 时间戳）、状态码、media_type 长度
+_ENTRY_HEADER = struct.Struct("<dIH")
+
+
+def stable_hash(key: str) -> int:
+    """跨进程一致的 64 位哈希（内置 hash() 对字符串按进程随机化），0 保留给空槽位"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+
+class SharedTable:
+    """
+    mmap 的定长槽位表：每个槽位为 64 位 key 哈希加 fields 个 float64
+
+    直接映射（哈希取模定位槽位），冲突时新 key 覆盖旧 key，相当于淘汰；
+    因此只适合丢失后可以重建的状态（令牌桶重置为满、计数器从零开始）。
+    """
+
+    def __init__(self, path: str, slots: int, fields: int):
+        self.slots = slots
+        self.fields = fields
+        self._record = struct.Struct(f"<Q{fields}d")
+        size = slots * self._record.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            # 每个 worker 都会执行，截断到相同长度是幂等的；槽位数变化时旧数据作废
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _locked(self, offset: int) -> Iterator[None]:
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._record.size, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._record.size, offset)
+
+    def update(self, key: str, fn: Callable[[Optional[Tuple[float, ...]]], Tuple[Tuple[float, ...], Any]]) -> Any:
+        """
+        在槽位锁内读改写：fn 接收当前值（槽位属于其他 key 或为空时为 None），
+        返回 (新值, 返回值)；新值为 None 时不写入
+        """
+        digest = stable_hash(key)
+        offset = (digest % self.slots) * self._record.size
+        with self._locked(offset):
+            record = self._record.unpack_from(self._map, offset)
+            values, result = fn(record[1:] if record[0] == digest else None)
+            if values is not None:
+                self._record.pack_into(self._map, offset, digest, *values)
+        return result
+
+    def read(self, key: str) -> Optional[Tuple[float, ...]]:
+        """无锁读取（可能读到并发写入中的值，只用于统计展示）"""
+        digest = stable_hash(key)
+        record = self._record.unpack_from(self._map, (digest % self.slots) * self._record.size)
+        return record[1:] if record[0] == digest else None
+
+
+class SharedCounters:
+    """跨 worker 的命名计数器"""
+
+    def __init__(self, table: SharedTable):
+        self._table = table
+
+    def inc(self, name: str, amount: float = 1) -> None:
+        self._table.update(name, lambda current: (((current[0] if current else 0) + amount,), None))
+
+    def get(self, name: str) -> int:
+        current = self._table.read(name)
+        return int(current[0]) if current else 0
+
+
+def _refill(tokens: float, updated: float, rate: float, burst: float, now: float) -> float:
+    # 文件跨重启保留时单调时钟会回退，按未经过时间处理
+    return min(burst, tokens + max(now - updated, 0) * rate)
+
+
+class SharedKeyLimiter:
+    """
+    与 admission.KeyLimiter 接口相同的按 key 限流，令牌桶状态存放在 SharedTable 中
+
+    每个 key 一个槽位：(请求令牌数, 请求桶更新时间, token 令牌数, token 桶更新时间)；
+    检查和扣减在同一次槽位锁内完成。
+    """
+
+    def __init__(
+        self,
+        table: SharedTable,
+        request_rate: float,
+        request_burst: float,
+        token_rate: float,
+        token_burst: float
+    ):
+        self._table = table
+        self.request_rate = request_rate
+        self.request_burst = request_burst
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+
+    def check(self, key: str, tokens: int) -> Optional[float]:
+        """通过时扣减两个桶并返回 None，否则返回建议的等待秒数"""
+        def take(current: Optional[Tuple[float, ...]]) -> Tuple[Tuple[float, ...], Optional[float]]:
+            now = time.monotonic()
+            if current is None:
+                current = (self.request_burst, now, self.token_burst, now)
+            requests = _refill(current[0], current[1], self.request_rate, self.request_burst, now)
+            token_budget = _refill(current[2], current[3], self.token_rate, self.token_burst, now)
+
+            wait = None
+            if self.request_rate > 0 and requests < 1:
+                wait = (1 - requests) / self.request_rate
+            amount = min(tokens, self.token_burst)
+            if wait is None and self.token_rate > 0 and token_budget < amount:
+                wait = (amount - token_budget) / self.token_rate
+            if wait is None:
+                if self.request_rate > 0:
+                    requests -= 1
+                if self.token_rate > 0:
+                    token_budget -= amount
+            return (requests, now, token_budget, now), wait
+
+        return self._table.update(key, take)
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    跨 worker 的响应缓存，接口与 ResponseCache 相同
+
+    每个条目一个文件：写入临时文件后 os.replace 原子替换，读者总是看到完整的条目，无需加锁。
+    命中时更新文件的修改时间，超出条目数或总字节数时按修改时间淘汰（近似 LRU），
+    淘汰扫描每 sweep_interval 次写入执行一次。命中 / 未命中计数通过 SharedCounters 汇总。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        counters: SharedCounters,
+        max_entries: int,
+        ttl: float,
+        max_bytes: int,
+        sweep_interval: int = 64
+    ):
+        super().__init__(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes)
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self._counters = counters
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self._counters.inc("response_cache.misses")
+            return None
+
+        expires_at, status_code, media_length = _ENTRY_HEADER.unpack_from(data)
+        if expires_at <= time.time():
+            self._unlink(path)
+            self._counters.inc("response_cache.misses")
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._counters.inc("response_cache.hits")
+        start = _ENTRY_HEADER.size + media_length
+        return CachedResponse(
+            content=data[start:],
+            status_code=status_code,
+            media_type=data[_ENTRY_HEADER.size:start].decode(),
+            expires_at=math.inf  # 过期判断已用文件中的时间完成
+        )
+
+    def set(self, key: str, content: bytes, status_code: int, media_type: str) -> None:
+        if status_code != 200 or len(content) > self.max_bytes:
+            return
+
+        media = media_type.encode()
+        header = _ENTRY_HEADER.pack(time.time() + self.ttl, status_code, len(media))
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(header + media + content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[Proxy] Shared cache write failed: {e}")
+            self._unlink(tmp_path)
+            return
+
+        self._writes += 1
+        if self._writes % self.sweep_interval == 0:
+            self.sweep()
+
+    def sweep(self) -> None:
+        """删除过期条目，并按修改时间从旧到新淘汰超出上限的条目"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if stat.st_mtime + self.ttl <= now:
+                self._unlink(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, path in entries:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self._unlink(path)
+            count -= 1
+            total -= size
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        entries = 0
+        size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".tmp"):
+                entries += 1
+                try:
+                    size += entry.stat().st_size
+                except OSError:
+                    pass
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self._counters.get("response_cache.hits"),
+            "misses": self._counters.get("response_cache.misses"),
+        }
+
+
+class SharedState:
+    """
+    一个 worker 打开的共享状态目录：counters.bin 存放计数器，buckets.bin 存放限流令牌桶，
+    cache/ 存放响应缓存条目
+    """
+
+    def __init__(self, directory: str, slots: int = 65536):
+        if fcntl is None:
+            raise RuntimeError("shared state requires fcntl (POSIX)")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._tables = {
+            "counters": SharedTable(os.path.join(directory, "counters.bin"), 1024, 1),
+            "buckets": SharedTable(os.path.join(directory, "buckets.bin"), slots, 4),
+        }
+        self.counters = SharedCounters(self._tables["counters"])
+
+    def response_cache(self, max_entries: int, ttl: float, max_bytes: int) -> SharedResponseCache:
+        return SharedResponseCache(
+            os.path.join(self.directory, "cache"),
+            self.counters,
+            max_entries=max_entries,
+            ttl=ttl,
+            max_bytes=max_bytes
+        )
+
+    def key_limiter(self, request_rate: float, request_burst: float, token_rate: float, token_burst: float) -> SharedKeyLimiter:
+        return SharedKeyLimiter(self._tables["buckets"], request_rate, request_burst, token_rate, token_burst)
+
+    def close(self) -> None:
+        for table in self._tables.values():
+            table.close()
+
+
+def open_shared_state(directory: str, slots: int) -> Optional[SharedState]:
+    """打开共享状态目录；平台不支持时打印提示并返回 None（退回进程内状态）"""
+    try:
+        return SharedState(directory, slots)
+    except (OSError, RuntimeError) as e:
+        print(f"[Proxy] Shared state unavailable ({e}), using per-worker state")
+        return None
@@ -0,0 +1,193 @@
+"""
+相同上游请求的合并（single-flight）
+并发的相同请求只发一次上游调用：非流式共享同一个结果，流式以 fan-out 方式共享同一个上游 SSE 流
+"""
+import asyncio
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+# 流式 opener 的返回值：(status_code, headers, 完整响应体或字节迭代器)
+StreamBody = Union[bytes, AsyncIterator[bytes]]
+StreamOpener = Callable[[], Awaitable[Tuple[int, Dict[str, str], StreamBody]]]
+
+
+class SubscriberOverflow(Exception):
+    """订阅者消费过慢，缓冲区溢出"""
+
+
+class _Subscriber:
+    """单个订阅者的有界缓冲区"""
+
+    __slots__ = ("chunks", "event", "error", "closed")
+
+    def __init__(self, history: List[bytes]):
+        self.chunks: Deque[bytes] = deque(history)
+        self.event = asyncio.Event()
+        self.error: Optional[BaseException] = None
+        self.closed = False
+
+
+class StreamBroadcast:
+    """
+    一个上游流与多个订阅者之间的 fan-out
+
+    流开始后的一段时间内保留历史 chunk，晚到的订阅者先回放历史再接收新数据；
+    历史超过 replay_chunks 后不再接受新订阅者。
+    """
+
+    def __init__(self, max_buffer_chunks: int, replay_chunks: int):
+        self.max_buffer_chunks = max_buffer_chunks
+        self.replay_chunks = replay_chunks
+        self.ready: "asyncio.Future[Tuple[int, Dict[str, str], Optional[bytes]]]" = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.task: Optional[asyncio.Task] = None
+        self._subscribers: List[_Subscriber] = []
+        self._history: Optional[List[bytes]] = []
+        self._finished = False
+
+    @property
+    def joinable(self) -> bool:
+        return self._history is not None and not self._finished
+
+    def subscribe(self) -> Optional[_Subscriber]:
+        if not self.joinable:
+            return None
+        subscriber = _Subscriber(self._history)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber) -> None:
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+        # 所有订阅者都离开后中止上游
+        if not self._subscribers and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def publish(self, chunk: bytes) -> None:
+        if self._history is not None:
+            self._history.append(chunk)
+            if len(self._history) > self.replay_chunks:
+                self._history = None
+
+        for subscriber in list(self._subscribers):
+            if len(subscriber.chunks) >= self.max_buffer_chunks:
+                subscriber.chunks.clear()
+                subscriber.error = SubscriberOverflow("subscriber buffer overflow")
+                self._subscribers.remove(subscriber)
+            else:
+                subscriber.chunks.append(chunk)
+            subscriber.event.set()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        self._finished = True
+        self._history = None
+        for subscriber in self._subscribers:
+            subscriber.closed = True
+            if error is not None and subscriber.error is None:
+                subscriber.error = error
+            subscriber.event.set()
+
+    async def iterate(self, subscriber: _Subscriber) -> AsyncIterator[bytes]:
+        """按顺序输出订阅者缓冲区中的 chunk"""
+        try:
+            while True:
+                while subscriber.chunks:
+                    yield subscriber.chunks.popleft()
+                if subscriber.error is not None:
+                    raise subscriber.error
+                if subscriber.closed:
+                    return
+                subscriber.event.clear()
+                await subscriber.event.wait()
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class SingleFlight:
+    """
+    按请求键合并并发的相同上游调用
+
+    上游调用在独立任务中执行，发起者断开不会影响其他等待者。
+    """
+
+    def __init__(self, max_buffer_chunks: int = 1024, replay_chunks: int = 256):
+        self.max_buffer_chunks = max_buffer_chunks
+        self.replay_chunks = replay_chunks
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, StreamBroadcast] = {}
+        self.coalesced = 0
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """非流式调用：相同 key 的并发调用共享同一个结果"""
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget_call(key, t))
+        return await asyncio.shield(task)
+
+    def _forget_call(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 所有等待者都取消时避免 "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def stream(
+        self,
+        key: str,
+        opener: StreamOpener
+    ) -> Tuple[int, Dict[str, str], StreamBody]:
+        """流式调用：相同 key 的并发请求订阅同一个上游流"""
+        broadcast = self._streams.get(key)
+        subscriber = broadcast.subscribe() if broadcast is not None else None
+        if subscriber is not None:
+            self.coalesced += 1
+        else:
+            broadcast = StreamBroadcast(self.max_buffer_chunks, self.replay_chunks)
+            subscriber = broadcast.subscribe()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.ensure_future(self._pump(key, broadcast, opener))
+
+        try:
+            status_code, headers, body = await asyncio.shield(broadcast.ready)
+        except BaseException:
+            broadcast.unsubscribe(subscriber)
+            raise
+
+        if body is not None:
+            broadcast.unsubscribe(subscriber)
+            return status_code, headers, body
+        return status_code, headers, broadcast.iterate(subscriber)
+
+    async def _pump(self, key: str, broadcast: StreamBroadcast, opener: StreamOpener) -> None:
+        """在独立任务中读取上游流并分发给所有订阅者"""
+        chunks = None
+        error: Optional[BaseException] = None
+        try:
+            status_code, headers, body = await opener()
+            if isinstance(body, bytes):
+                broadcast.ready.set_result((status_code, headers, body))
+                return
+            chunks = body
+            broadcast.ready.set_result((status_code, headers, None))
+            async for chunk in chunks:
+                broadcast.publish(chunk)
+        except asyncio.CancelledError as exc:
+            error = exc
+        except Exception as exc:
+            error = exc
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            if not broadcast.ready.done():
+                if error is None or isinstance(error, asyncio.CancelledError):
+                    broadcast.ready.cancel()
+                else:
+                    broadcast.ready.set_exception(error)
+            broadcast.close(None if isinstance(error, asyncio.CancelledError) else error)
+            if chunks is not None and hasattr(chunks, "aclose"):
+                await chunks.aclose()
@@ -0,0 +1,249 @@
+"""
+SSE 流 -> 完整 JSON 响应的聚合器
+
+thinking 模式下代理强制向上游发起流式请求以避免超时；客户端要的是非流式响应时，
+由聚合器消费整个上游流并还原出一个完整的响应对象。
+文本、推理和工具参数按片段追加到各自的 StringIO 中，不保留每个 chunk 的 dict。
+"""
+import io
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from message_transformer import ReasoningContentTransformer
+
+
+class _SSEAggregator:
+    """按空行切分 SSE 帧，把 (event, data) 交给子类处理"""
+
+    def __init__(self):
+        self._buffer = b""
+        self.error: Optional[Dict[str, Any]] = None
+
+    def feed(self, chunk: bytes) -> None:
+        data = self._buffer + chunk if self._buffer else chunk
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+
+        cut = data.rfind(b"\n\n")
+        if cut == -1:
+            self._buffer = data
+            return
+
+        complete, self._buffer = data[:cut], data[cut + 2:]
+        for frame in complete.split(b"\n\n"):
+            self._process_frame(frame)
+
+    def flush(self) -> None:
+        data, self._buffer = self._buffer, b""
+        if data.strip():
+            self._process_frame(data.strip())
+
+    def _process_frame(self, frame: bytes) -> None:
+        event = None
+        payload = None
+        for line in frame.split(b"\n"):
+            if line.startswith(b"data:"):
+                payload = line[5:].strip()
+            elif line.startswith(b"event:"):
+                event = line[6:].strip().decode()
+        if payload is None or payload == b"[DONE]":
+            return
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            self._handle(event, data)
+
+    def _handle(self, event: Optional[str], data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class _OpenAIChoice:
+    __slots__ = ("content", "reasoning", "tool_calls", "finish_reason")
+
+    def __init__(self):
+        self.content = io.StringIO()
+        self.reasoning = io.StringIO()
+        # tool_call index -> [id, name, arguments]
+        self.tool_calls: Dict[int, List[Any]] = {}
+        self.finish_reason: Optional[str] = None
+
+
+class OpenAIStreamAggregator(_SSEAggregator):
+    """
+    OpenAI 格式 chat.completion.chunk 流 -> chat.completion 对象
+
+    还原每个 choice 的 content、reasoning_content、tool_calls 和 finish_reason，以及 usage；
+    content 中的 <thinking> 标签由 ensure_assistant_message_complete 拆分。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.id: Optional[str] = None
+        self.model: Optional[str] = None
+        self.created: Optional[int] = None
+        self.system_fingerprint: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self._choices: Dict[int, _OpenAIChoice] = {}
+
+    def _handle(self, event: Optional[str], chunk: Dict[str, Any]) -> None:
+        if "error" in chunk:
+            error = chunk["error"]
+            self.error = error if isinstance(error, dict) else {"message": str(error)}
+            return
+
+        if self.id is None:
+            self.id = chunk.get("id")
+            self.model = chunk.get("model")
+            self.created = chunk.get("created")
+        if chunk.get("system_fingerprint"):
+            self.system_fingerprint = chunk["system_fingerprint"]
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+
+        for choice in chunk.get("choices") or []:
+            index = choice.get("index", 0)
+            state = self._choices.get(index)
+            if state is None:
+                state = self._choices[index] = _OpenAIChoice()
+
+            delta = choice.get("delta") or {}
+            content = delta.get("content")
+            if content:
+                state.content.write(content)
+            reasoning = delta.get("reasoning_content")
+            if reasoning:
+                state.reasoning.write(reasoning)
+
+            for call in delta.get("tool_calls") or []:
+                slot = state.tool_calls.get(call.get("index", 0))
+                if slot is None:
+                    slot = state.tool_calls[call.get("index", 0)] = [None, io.StringIO(), io.StringIO()]
+                if call.get("id"):
+                    slot[0] = call["id"]
+                function = call.get("function") or {}
+                if function.get("name"):
+                    slot[1].write(function["name"])
+                if function.get("arguments"):
+                    slot[2].write(function["arguments"])
+
+            if choice.get("finish_reason"):
+                state.finish_reason = choice["finish_reason"]
+
+    def result(self) -> Dict[str, Any]:
+        """聚合结果；流中出现错误时返回 OpenAI 错误格式"""
+        if self.error is not None:
+            return {"error": self.error}
+
+        choices = []
+        for index in sorted(self._choices):
+            state = self._choices[index]
+            message: Dict[str, Any] = {"role": "assistant", "content": state.content.getvalue() or None}
+            reasoning = state.reasoning.getvalue()
+            if reasoning:
+                message["reasoning_content"] = reasoning
+            if state.tool_calls:
+                message["tool_calls"] = [
+                    {
+                        "id": call_id,
+                        "type": "function",
+                        "function": {"name": name.getvalue(), "arguments": arguments.getvalue()},
+                    }
+                    for call_id, name, arguments in (state.tool_calls[i] for i in sorted(state.tool_calls))
+                ]
+            choices.append({
+                "index": index,
+                "message": ReasoningContentTransformer.ensure_assistant_message_complete(message),
+                "finish_reason": state.finish_reason,
+            })
+
+        response: Dict[str, Any] = {
+            "id": self.id,
+            "object": "chat.completion",
+            "created": self.created or int(time.time()),
+            "model": self.model,
+            "choices": choices,
+        }
+        if self.system_fingerprint:
+            response["system_fingerprint"] = self.system_fingerprint
+        if self.usage is not None:
+            response["usage"] = self.usage
+        return response
+
+
+class AnthropicStreamAggregator(_SSEAggregator):
+    """
+    Anthropic 事件流 -> message 对象
+
+    以 message_start 中的 message 为骨架，按 index 还原 text / thinking / tool_use 等内容块，
+    合并 message_delta 中的 stop_reason、stop_sequence 和 usage。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.message: Dict[str, Any] = {
+            "type": "message", "role": "assistant", "content": [], "stop_reason": None, "stop_sequence": None,
+        }
+        # index -> [content_block, 增量字段名, StringIO]
+        self._blocks: Dict[int, List[Any]] = {}
+
+    def _handle(self, event: Optional[str], data: Dict[str, Any]) -> None:
+        event_type = data.get("type", event)
+        if event_type == "content_block_delta":
+            slot = self._blocks.get(data.get("index", 0))
+            delta = data.get("delta") or {}
+            if slot is None:
+                return
+            delta_type = delta.get("type")
+            if delta_type == "text_delta":
+                slot[2].write(delta.get("text", ""))
+            elif delta_type == "thinking_delta":
+                slot[2].write(delta.get("thinking", ""))
+            elif delta_type == "input_json_delta":
+                slot[2].write(delta.get("partial_json", ""))
+            elif delta_type == "signature_delta":
+                slot[0]["signature"] = slot[0].get("signature", "") + delta.get("signature", "")
+            elif delta_type == "citations_delta":
+                slot[0].setdefault("citations", []).append(delta.get("citation"))
+        elif event_type == "content_block_start":
+            block = dict(data.get("content_block") or {})
+            field = {"text": "text", "thinking": "thinking"}.get(block.get("type"))
+            if block.get("type") in ("tool_use", "server_tool_use"):
+                field = "input"
+            buffer = io.StringIO()
+            if field and isinstance(block.get(field), str):
+                buffer.write(block[field])
+            self._blocks[data.get("index", len(self._blocks))] = [block, field, buffer]
+        elif event_type == "message_start":
+            message = data.get("message") or {}
+            self.message.update({key: value for key, value in message.items() if key != "content"})
+        elif event_type == "message_delta":
+            delta = data.get("delta") or {}
+            for key in ("stop_reason", "stop_sequence"):
+                if key in delta:
+                    self.message[key] = delta[key]
+            if data.get("usage"):
+                self.message["usage"] = dict(self.message.get("usage") or {}, **data["usage"])
+        elif event_type == "error":
+            self.error = data.get("error") or {"type": "api_error", "message": "stream error"}
+
+    def result(self) -> Dict[str, Any]:
+        """聚合结果；流中出现错误时返回 Anthropic 错误格式"""
+        if self.error is not None:
+            return {"type": "error", "error": self.error}
+
+        content = []
+        for index in sorted(self._blocks):
+            block, field, buffer = self._blocks[index]
+            if field == "input":
+                partial = buffer.getvalue()
+                try:
+                    block["input"] = json.loads(partial) if partial else block.get("input") or {}
+                except ValueError:
+                    block["input"] = {}
+            elif field:
+                block[field] = buffer.getvalue()
+            content.append(block)
+        return dict(self.message, content=content)
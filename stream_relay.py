@@ -0,0 +1,295 @@
+"""
+上游 SSE 字节流的快速转发
+只对可能需要修复的帧做 JSON 解码，其余帧按原始字节转发
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from fastapi import Request
+
+from metrics import STREAM_ABORTS_TOTAL, STREAM_SAVED_TOKENS_TOTAL
+from message_transformer import ReasoningContentTransformer, ThinkingStreamExtractor
+
+# SSE 响应的公共头
+SSE_HEADERS: Dict[str, str] = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
+# 透传时保留的上游响应头
+_PASSTHROUGH_HEADERS = ("content-type", "content-encoding")
+
+# 原始字节透传的上游请求头：要求上游不压缩，否则 httpx 默认的 gzip / deflate 会被原样转发给未要求压缩的客户端
+RAW_RELAY_HEADERS: Dict[str, str] = {"Accept-Encoding": "identity"}
+
+# 客户端断开导致的上游中止统计（进程内）
+STREAM_STATS: Dict[str, int] = {
+    "aborted_streams": 0,
+    "saved_tokens": 0,
+}
+
+# 只有包含这些标记的帧才可能需要修复（"<" 可能是被切断的 <thinking> 标签）
+_INSPECT_MARKERS = (b'"assistant"', b"<", b"\\u003c")
+
+
+class SSERelay:
+    """
+    OpenAI 格式 SSE 流的逐帧转发器（每个流一个实例）
+
+    以字节为单位按空行切分 SSE 帧，未命中标记的整段数据直接原样转发，
+    避免对每个 chunk 做 json.loads / json.dumps。
+    只有 content 开头的 <thinking> 段需要拆分：正文开始之前逐帧解码，之后回到按标记筛选。
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._extractors: Dict[int, ThinkingStreamExtractor] = {}
+        # 所有 choice 的开头都已确定（推理段结束或正文已开始）
+        self._settled = False
+        # 第一个解码过的 chunk 的 id / model 等字段，用于补发残留内容的帧
+        self._envelope: Dict[str, Any] = {}
+
+    def feed(self, chunk: bytes) -> bytes:
+        """输入一段上游字节，返回可以立即发给客户端的字节"""
+        data = self._buffer + chunk if self._buffer else chunk
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+
+        cut = data.rfind(b"\n\n")
+        if cut == -1:
+            self._buffer = data
+            return b""
+
+        cut += 2
+        complete, self._buffer = data[:cut], data[cut:]
+        if not self._needs_inspection(complete):
+            return complete
+
+        frames = complete.split(b"\n\n")
+        frames.pop()  # 以 \n\n 结尾，最后一段为空
+        return b"".join(self._process_frame(frame) + b"\n\n" for frame in frames)
+
+    def flush(self) -> bytes:
+        """上游结束时输出残留的不完整帧，以及 <thinking> 拆分器中尚未输出的内容"""
+        data, self._buffer = self._buffer, b""
+        out = self._process_frame(data.rstrip(b"\n")) + b"\n\n" if data.strip() else b""
+        return out + self._flush_extractors()
+
+    def _flush_extractors(self) -> bytes:
+        """
+        流在没有 finish_reason 的情况下结束时，把各拆分器缓存的标签前缀作为一个额外的帧输出
+        """
+        choices = []
+        for index, extractor in self._extractors.items():
+            if not extractor.active:
+                continue
+            reasoning, content = extractor.flush()
+            delta: Dict[str, Any] = {}
+            if reasoning:
+                delta["reasoning_content"] = reasoning
+            if content:
+                delta["content"] = content
+            if delta:
+                choices.append({"index": index, "delta": delta, "finish_reason": None})
+        if not choices:
+            return b""
+        chunk = dict(self._envelope, choices=choices)
+        return b"data: " + json.dumps(chunk).encode() + b"\n\n"
+
+    def _needs_inspection(self, data: bytes) -> bool:
+        if not self._settled:
+            return True
+        return any(marker in data for marker in _INSPECT_MARKERS)
+
+    def _process_frame(self, frame: bytes) -> bytes:
+        """解码并修复单个帧，无需修改时返回原始字节"""
+        if not frame.startswith(b"data:") or b"\n" in frame:
+            return frame
+        if not self._needs_inspection(frame):
+            return frame
+
+        payload = frame[5:].strip()
+        if payload == b"[DONE]":
+            # 残留内容必须在 [DONE] 之前发出
+            return self._flush_extractors() + frame
+
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            return frame
+
+        if not isinstance(chunk, dict):
+            return frame
+        if not self._envelope:
+            self._envelope = {key: chunk[key] for key in ("id", "object", "created", "model") if key in chunk}
+        if not self._fix_chunk(chunk):
+            return frame
+        return b"data: " + json.dumps(chunk).encode()
+
+    def _fix_chunk(self, chunk: Dict[str, Any]) -> bool:
+        """修复 chunk 中的 delta，返回是否需要重新序列化"""
+        changed = False
+        choices: List[Dict[str, Any]] = chunk.get("choices") or []
+        for choice in choices:
+            delta = choice.get("delta")
+            if not isinstance(delta, dict):
+                continue
+
+            index = choice.get("index", 0)
+            extractor = self._extractors.get(index)
+            if extractor is None:
+                extractor = self._extractors[index] = ThinkingStreamExtractor()
+            if "reasoning_content" in delta or delta.get("tool_calls"):
+                # 上游原生返回推理内容或开始工具调用，content 开头不会再出现 <thinking>
+                extractor.stop()
+                if "reasoning_content" in delta:
+                    continue
+            elif extractor.done and delta.get("role") != "assistant":
+                # 开头的推理段已结束或正文已开始，正文中出现的标签原样转发
+                continue
+
+            before = delta.get("content")
+            ReasoningContentTransformer.fix_stream_delta(delta, extractor)
+
+            if choice.get("finish_reason") and extractor.active:
+                reasoning, content = extractor.flush()
+                if reasoning:
+                    delta["reasoning_content"] = (delta.get("reasoning_content") or "") + reasoning
+                if content:
+                    delta["content"] = (delta.get("content") or "") + content
+
+            if "reasoning_content" in delta or delta.get("content") != before:
+                changed = True
+        self._settled = bool(self._extractors) and all(
+            extractor.done for extractor in self._extractors.values()
+        )
+        return changed
+
+
+def passthrough_headers(response: httpx.Response) -> Dict[str, str]:
+    """
+    构造透传给客户端的响应头，保留上游的 content-type / content-encoding
+
+    上游请求需带上 RAW_RELAY_HEADERS；上游仍返回压缩内容时，content-encoding 与透传的字节保持一致。
+    """
+    headers = dict(SSE_HEADERS)
+    for name in _PASSTHROUGH_HEADERS:
+        value = response.headers.get(name)
+        if value:
+            headers[name.title()] = value
+    return headers
+
+
+class DisconnectGuard:
+    """
+    客户端断开检测（每个流一个实例）
+
+    后台任务监听 http.disconnect，断开时如果正在等待上游数据则立即取消读取，
+    由调用方关闭上游响应并把连接 / HTTP2 stream 还给连接池。
+    """
+
+    def __init__(self, request: Request, max_tokens: Optional[int] = None):
+        self._request = request
+        self._max_tokens = max_tokens or 0
+        self._reading = False
+        self._frames = 0
+        # 由 _watch 发出的取消（与服务器关闭等外部取消区分）
+        self._cancelled = False
+        self.aborted = False
+
+    async def relay(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """转发上游 chunk，客户端断开后停止迭代"""
+        task = asyncio.current_task()
+        watcher = asyncio.create_task(self._watch(task))
+        iterator = chunks.__aiter__()
+        try:
+            while True:
+                self._reading = True
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                except asyncio.CancelledError:
+                    # 只吞掉自己发出的那一次取消；同时存在外部取消时照常向上抛出
+                    if not self._cancelled or task.uncancel() > 0:
+                        raise
+                    break
+                finally:
+                    self._reading = False
+
+                # 每个 data 帧约对应一个 token 增量
+                self._frames += chunk.count(b"data:")
+                yield chunk
+                if self.aborted:
+                    break
+        finally:
+            watcher.cancel()
+            if self.aborted:
+                self._record_abort()
+
+    async def _watch(self, task: asyncio.Task) -> None:
+        while True:
+            message = await self._request.receive()
+            if message["type"] == "http.disconnect":
+                break
+        self.aborted = True
+        if self._reading:
+            self._cancelled = True
+            task.cancel()
+
+    def _record_abort(self) -> None:
+        saved = max(self._max_tokens - self._frames, 0)
+        STREAM_STATS["aborted_streams"] += 1
+        STREAM_STATS["saved_tokens"] += saved
+        STREAM_ABORTS_TOTAL.inc()
+        STREAM_SAVED_TOKENS_TOTAL.inc(saved)
+        print(f"[Proxy] Client disconnected, aborted upstream stream (~{saved} tokens saved)")
+
+
+async def iter_raw(
+    response: httpx.Response,
+    chunks: Optional[AsyncIterator[bytes]] = None
+) -> AsyncIterator[bytes]:
+    """
+    原样转发上游字节（不解码 content-encoding，也不做字符集转换），上游请求需带上 RAW_RELAY_HEADERS
+
+    每个 chunk 都等待客户端 send 完成后才读取下一个，慢客户端的背压会直接传递到上游连接。
+    chunks 为已开始读取的 response.aiter_raw()（例如对冲时预读了首个 chunk）。
+    """
+    if chunks is None:
+        chunks = response.aiter_raw()
+    try:
+        async for chunk in chunks:
+            if chunk:
+                yield chunk
+    finally:
+        await response.aclose()
+
+
+async def iter_sse(
+    response: httpx.Response,
+    chunks: Optional[AsyncIterator[bytes]] = None,
+    relay: Optional[Any] = None
+) -> AsyncIterator[bytes]:
+    """
+    经 SSERelay 修复后转发 OpenAI 格式的上游 SSE 流，chunks 含义同 iter_raw
+
+    relay 可替换为其他带 feed / flush 的逐帧转换器（例如 AnthropicStreamTranslator）
+    """
+    if chunks is None:
+        chunks = response.aiter_bytes()
+    if relay is None:
+        relay = SSERelay()
+    try:
+        async for chunk in chunks:
+            out = relay.feed(chunk)
+            if out:
+                yield out
+        tail = relay.flush()
+        if tail:
+            yield tail
+    finally:
+        await response.aclose()
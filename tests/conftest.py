@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+# 模块位于仓库根目录（没有打包），测试直接导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    """
+    把 main.app 连接到 httpx.MockTransport 上游，缓存、单飞、对冲、录制和准入默认关闭；
+    返回 connect(handler, **state)，state 覆盖 app.state 上的同名属性
+    """
+    import httpx
+
+    import main
+    from token_counter import TokenCounter
+    from upstream_pool import Upstream, UpstreamPool
+
+    monkeypatch.setattr(main, "SINGLE_FLIGHT_ENABLED", False)
+    monkeypatch.setattr(main, "MAX_TOKENS_CLAMP_ENABLED", False)
+
+    def connect(handler, **state):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://upstream")
+        values = {
+            "upstreams": UpstreamPool([Upstream("http://upstream", client)]),
+            "single_flight": None,
+            "response_cache": None,
+            "hedger": None,
+            "capture": None,
+            "admission": None,
+            "prompt_cache": None,
+            "token_counter": TokenCounter(),
+        }
+        values.update(state)
+        for name, value in values.items():
+            monkeypatch.setattr(main.app.state, name, value, raising=False)
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy")
+
+    return connect
@@ -0,0 +1,186 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from admission import (
+    AdaptiveLimit,
+    AdmissionController,
+    AdmissionMiddleware,
+    AdmissionRejected,
+    KeyLimiter,
+    TokenBucket,
+    estimate_tokens,
+    request_priority,
+)
+
+
+def controller(capacity=1, **kwargs):
+    limit = AdaptiveLimit(initial=capacity, minimum=1)
+    return AdmissionController(lambda: [limit], **kwargs)
+
+
+def test_token_bucket_reports_wait_time():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.try_take(1) == 0 and bucket.try_take(1) == 0
+    assert bucket.try_take(1) == pytest.approx(0.1, abs=0.01)
+    # 超过容量的单次请求只要求桶是满的
+    assert TokenBucket(rate=1, burst=5).try_take(100) == 0
+
+
+def test_key_limiter_gives_back_the_request_when_tokens_run_out():
+    limiter = KeyLimiter(request_rate=1, request_burst=2, token_rate=1, token_burst=100)
+    assert limiter.check("a", 100) is None
+    assert limiter.check("a", 50) is not None
+    # 上一次因 token 不足被拒绝时归还了请求令牌
+    limiter._get("a")[1]._tokens = 100
+    assert limiter.check("a", 50) is None
+    assert limiter.check("b", 1) is None
+
+
+def test_adaptive_limit_backs_off_and_recovers():
+    limit = AdaptiveLimit(initial=32, minimum=4)
+    limit.on_throttle()
+    assert limit.current == 16
+    for _ in range(40):
+        limit.on_sample(None)
+    assert limit.current > 16
+
+
+def test_request_classification():
+    assert request_priority({"headers": []}, b'{"stream": true}') == "interactive"
+    assert request_priority({"headers": []}, b'{"stream": false}') == "batch"
+    assert request_priority({"headers": [(b"x-priority", b"BATCH")]}, b'{"stream": true}') == "batch"
+    body = b'{"max_tokens": 100, "x": "' + b"a" * 400 + b'"}'
+    assert estimate_tokens(body) == len(body) // 4 + 100
+
+
+def test_queued_requests_are_dispatched_by_priority():
+    async def scenario():
+        admission = controller(capacity=1)
+        held = await admission.acquire("k", "batch", 0)
+        order = []
+
+        async def waiter(priority):
+            acquired = await admission.acquire("k", priority, 0)
+            order.append(priority)
+            admission.release(acquired)
+
+        tasks = [asyncio.create_task(waiter("batch")), asyncio.create_task(waiter("interactive"))]
+        await asyncio.sleep(0)
+        assert admission.queued() == 2
+        admission.release(held)
+        await asyncio.gather(*tasks)
+        return order, admission
+
+    order, admission = asyncio.run(scenario())
+    assert order == ["interactive", "batch"]
+    assert admission.inflight == 0
+
+
+def test_full_queue_and_queue_timeout_are_rejected():
+    async def scenario():
+        admission = controller(capacity=1, queue_size=1, max_wait=0.05)
+        await admission.acquire("k", "batch", 0)
+        queued = asyncio.create_task(admission.acquire("k", "batch", 0))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await admission.acquire("k", "batch", 0)
+        with pytest.raises(AdmissionRejected) as timeout:
+            await queued
+        return full.value, timeout.value, admission
+
+    full, timeout, admission = asyncio.run(scenario())
+    assert full.reason == "queue_full" and full.retry_after >= 1
+    assert timeout.reason == "queue_timeout"
+    assert admission.queued() == 0 and admission.inflight == 1
+
+
+def call_middleware(admission, path="/v1/messages", headers=()):
+    """经过 AdmissionMiddleware 发送一个请求，返回 (状态码, 响应头, 响应体, 应用是否被调用)"""
+    called = []
+
+    async def app(scope, receive, send):
+        called.append((await receive())["body"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sent = []
+    messages = [{"type": "http.request", "body": b'{"max_tokens": 10}', "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # 客户端一直保持连接
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "path": path,
+        "headers": list(headers),
+        "app": SimpleNamespace(state=SimpleNamespace(admission=admission)),
+    }
+    asyncio.run(AdmissionMiddleware(app)(scope, receive, send))
+    return sent[0]["status"], dict(sent[0]["headers"]), sent[1]["body"], called
+
+
+def test_middleware_replays_the_body_and_releases_the_slot():
+    admission = controller(capacity=2)
+    status, _, body, called = call_middleware(admission)
+    assert (status, body, called) == (200, b"ok", [b'{"max_tokens": 10}'])
+    assert admission.inflight == 0 and admission.admitted == 1
+
+
+@pytest.mark.parametrize("path, error_type", [
+    ("/v1/messages", "rate_limit_error"),
+    ("/v1/chat/completions", "rate_limit_exceeded"),
+])
+def test_middleware_rejects_with_retry_after(path, error_type):
+    limiter = KeyLimiter(request_rate=0.5, request_burst=1, token_rate=0, token_burst=0)
+    admission = controller(capacity=4, key_limiter=limiter)
+    assert call_middleware(admission, path, [(b"x-api-key", b"sk-a")])[0] == 200
+
+    status, headers, body, called = call_middleware(admission, path, [(b"x-api-key", b"sk-a")])
+    assert status == 429 and not called
+    assert headers[b"retry-after"] == b"2"
+    error = json.loads(body)
+    assert (error["error"].get("type")) == error_type
+    assert admission.rejected == 1
+
+
+def test_client_disconnecting_while_queued_leaves_the_queue():
+    async def scenario():
+        admission = controller(capacity=1)
+        held = await admission.acquire("k", "batch", 0)
+        messages = [
+            {"type": "http.disconnect"},
+            {"type": "http.request", "body": b"{}", "more_body": False},
+        ]
+        called = []
+
+        async def app(scope, receive, send):
+            called.append(scope)
+
+        async def receive():
+            await asyncio.sleep(0.01)
+            return messages.pop()
+
+        async def send(message):
+            raise AssertionError("no response expected")
+
+        scope = {
+            "type": "http",
+            "path": "/v1/messages",
+            "headers": [],
+            "app": SimpleNamespace(state=SimpleNamespace(admission=admission)),
+        }
+        await AdmissionMiddleware(app)(scope, receive, send)
+        assert not called and admission.queued() == 0
+        admission.release(held)
+        return admission
+
+    assert asyncio.run(scenario()).inflight == 0
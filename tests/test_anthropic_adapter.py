@@ -0,0 +1,54 @@
+import pytest
+
+from anthropic_adapter import AnthropicAdapter
+
+
+def convert(**fields):
+    body = {"model": "m", "max_tokens": 100, "messages": [{"role": "user", "content": "hi"}]}
+    body.update(fields)
+    return AnthropicAdapter.anthropic_request_to_openai(body)
+
+
+@pytest.mark.parametrize("budget, effort", [(1024, "low"), (8000, "medium"), (32000, "high")])
+def test_thinking_budget_maps_to_reasoning_effort(budget, effort):
+    thinking = {"type": "enabled", "budget_tokens": budget}
+    converted = convert(thinking=thinking)
+    assert converted["thinking"] == thinking
+    assert converted["reasoning_effort"] == effort
+
+
+def test_disabled_thinking_is_forwarded_without_effort():
+    converted = convert(thinking={"type": "disabled"})
+    assert converted["thinking"] == {"type": "disabled"}
+    assert "reasoning_effort" not in converted
+
+
+def test_image_blocks_become_image_url_parts_in_order():
+    messages = [{"role": "user", "content": [
+        {"type": "text", "text": "compare"},
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "QUJD"}},
+        {"type": "image", "source": {"type": "url", "url": "https://example.com/a.jpg"}},
+        {"type": "text", "text": "please"},
+    ]}]
+    [message] = convert(messages=messages)["messages"]
+    assert message["content"] == [
+        {"type": "text", "text": "compare"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,QUJD"}},
+        {"type": "image_url", "image_url": {"url": "https://example.com/a.jpg"}},
+        {"type": "text", "text": "please"},
+    ]
+
+
+def test_image_only_message_after_tool_result_is_kept():
+    messages = [{"role": "user", "content": [
+        {"type": "tool_result", "tool_use_id": "t1", "content": "ok"},
+        {"type": "image", "source": {"type": "url", "url": "https://example.com/a.jpg"}},
+    ]}]
+    converted = convert(messages=messages)["messages"]
+    assert [m["role"] for m in converted] == ["tool", "user"]
+    assert converted[1]["content"][0]["type"] == "image_url"
+
+
+def test_text_only_content_stays_a_string():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "a"}, {"type": "text", "text": "b"}]}]
+    assert convert(messages=messages)["messages"][0]["content"] == "a\nb"
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from batch import BatchError, BatchRunner, owner_digest
+
+ITEMS = b"\n".join(
+    json.dumps({"custom_id": f"c{index}", "params": {"model": "m", "messages": []}}).encode()
+    for index in range(4)
+)
+
+
+def make_app(calls, delay=0.05):
+    """记录条目请求的最小 ASGI 应用"""
+    async def app(scope, receive, send):
+        message = await receive()
+        calls.append(json.loads(message["body"]))
+        await asyncio.sleep(delay)
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"ok": true}'})
+    return app
+
+
+async def drain(results):
+    return [json.loads(line) async for line in results]
+
+
+def test_batch_runs_and_resume_replays_results(tmp_path):
+    async def scenario():
+        calls = []
+        runner = BatchRunner(make_app(calls), str(tmp_path), concurrency=2)
+        _, results = await runner.prepare("job", ITEMS, {})
+        assert len(await drain(results)) == 4
+        await asyncio.sleep(0)
+        _, results = await runner.prepare("job", b"", {})
+        replayed = await drain(results)
+        await runner.aclose()
+        return calls, replayed
+
+    calls, replayed = asyncio.run(scenario())
+    assert len(calls) == 4
+    assert [record["custom_id"] for record in replayed] == ["c0", "c1", "c2", "c3"]
+
+
+def test_second_submission_is_rejected_while_running(tmp_path):
+    async def scenario():
+        calls = []
+        runner = BatchRunner(make_app(calls), str(tmp_path))
+        _, results = await runner.prepare("job", ITEMS, {})
+        with pytest.raises(BatchError) as excinfo:
+            await runner.prepare("job", b"", {})
+        assert excinfo.value.status_code == 409
+        await drain(results)
+        await runner.aclose()
+        return calls
+
+    assert len(asyncio.run(scenario())) == 4
+
+
+def test_lock_is_shared_across_runners(tmp_path):
+    """两个 worker 各自的执行器共用批次目录，同一批次只能有一个在执行"""
+    async def scenario():
+        calls = []
+        first = BatchRunner(make_app(calls), str(tmp_path))
+        second = BatchRunner(make_app(calls), str(tmp_path))
+        _, results = await first.prepare("job", ITEMS, {})
+        with pytest.raises(BatchError):
+            await second.prepare("job", b"", {})
+        assert second.status("job", owner_digest({}))["running"]
+        await drain(results)
+        await asyncio.sleep(0)
+        assert not second.status("job", owner_digest({}))["running"]
+        await first.aclose()
+        await second.aclose()
+        return calls
+
+    assert len(asyncio.run(scenario())) == 4
+
+
+def test_batch_runs_when_client_never_reads(tmp_path):
+    async def scenario():
+        calls = []
+        runner = BatchRunner(make_app(calls), str(tmp_path))
+        _, results = await runner.prepare("job", ITEMS, {})
+        # 客户端在收到任何结果前断开
+        await results.aclose()
+        while runner._running:
+            await asyncio.sleep(0.01)
+        stored = runner.load_results("job")
+        await runner.aclose()
+        return stored, runner._listeners
+
+    stored, listeners = asyncio.run(scenario())
+    assert sorted(stored) == ["c0", "c1", "c2", "c3"]
+    assert listeners == {}
+
+
+def test_disconnect_during_replay_still_runs_pending_items(tmp_path):
+    async def scenario():
+        calls = []
+        runner = BatchRunner(make_app(calls), str(tmp_path))
+        _, results = await runner.prepare("job", ITEMS, {})
+        await drain(results)
+        await asyncio.sleep(0)
+        # 第二条结果改为可重试的失败，续跑时重新执行
+        results_path = tmp_path / "job" / "results.jsonl"
+        with open(results_path, "a") as f:
+            f.write(json.dumps({"custom_id": "c1", "response": {"status_code": 503, "body": None}}) + "\n")
+        _, results = await runner.prepare("job", b"", {})
+        first = json.loads(await results.__anext__())
+        await results.aclose()
+        while runner._running:
+            await asyncio.sleep(0.01)
+        await runner.aclose()
+        return calls, first, runner.load_results("job")
+
+    calls, first, stored = asyncio.run(scenario())
+    assert first["custom_id"] == "c0"
+    assert len(calls) == 5
+    assert stored["c1"]["response"]["status_code"] == 200
+
+
+def test_invalid_new_batch_leaves_no_directory(tmp_path):
+    async def scenario():
+        runner = BatchRunner(make_app([]), str(tmp_path))
+        with pytest.raises(BatchError):
+            await runner.prepare("job", b"not json", {})
+        await runner.aclose()
+
+    asyncio.run(scenario())
+    assert not (tmp_path / "job").exists()
+
+
+OWNER = {"x-api-key": "sk-owner"}
+OTHER = {"authorization": "Bearer sk-other"}
+
+
+def test_batch_is_only_visible_to_its_creator(tmp_path):
+    async def scenario():
+        calls = []
+        runner = BatchRunner(make_app(calls), str(tmp_path))
+        _, results = await runner.prepare("job", ITEMS, OWNER)
+        # 执行中和执行完后，其他凭证都看不到该批次
+        with pytest.raises(BatchError) as running:
+            await runner.prepare("job", b"", OTHER)
+        await drain(results)
+        await asyncio.sleep(0)
+        with pytest.raises(BatchError) as finished:
+            await runner.prepare("job", b"", OTHER)
+        _, replayed = await runner.prepare("job", b"", {"authorization": "Bearer sk-owner"})
+        await runner.aclose()
+        return running.value, finished.value, await drain(replayed), runner
+
+    running, finished, replayed, runner = asyncio.run(scenario())
+    assert running.status_code == finished.status_code == 404
+    assert len(replayed) == 4
+    assert runner.status("job", owner_digest(OTHER)) is None
+    assert runner.status("job", owner_digest(OWNER))["completed"] == 4
+    assert b"sk-owner" not in (tmp_path / "job" / "owner").read_bytes()
+
+
+def test_sweep_removes_only_expired_idle_batches(tmp_path):
+    async def scenario():
+        runner = BatchRunner(make_app([], delay=0.2), str(tmp_path), retention=60)
+        _, results = await runner.prepare("old", ITEMS, {})
+        await drain(results)
+        await asyncio.sleep(0)
+        expired = time.time() - 120
+        os.utime(tmp_path / "old" / "results.jsonl", (expired, expired))
+
+        _, results = await runner.prepare("running", ITEMS, {})
+        await asyncio.sleep(0.05)
+        os.utime(tmp_path / "running" / "results.jsonl", (expired, expired))
+        # 另一个 worker 正在执行的过期批次
+        other = BatchRunner(make_app([]), str(tmp_path), retention=60)
+        removed = await asyncio.to_thread(other.sweep)
+        await drain(results)
+        await runner.aclose()
+        await other.aclose()
+        return removed
+
+    assert asyncio.run(scenario()) == 1
+    assert sorted(os.listdir(tmp_path)) == ["running"]
+
+
+def test_batch_routes_check_the_credential(proxy, tmp_path):
+    async def scenario():
+        batches = BatchRunner(make_app([]), str(tmp_path))
+        async with proxy(lambda request: None, batches=batches) as client:
+            created = await client.post("/v1/batches", content=ITEMS, headers=dict(OWNER, **{"x-batch-id": "job"}))
+            responses = [
+                await client.get("/v1/batches/job", headers=OWNER),
+                await client.get("/v1/batches/job", headers=OTHER),
+                await client.get("/v1/batches/job/results", headers=OWNER),
+                await client.get("/v1/batches/job/results", headers=OTHER),
+                await client.post("/v1/batches", content=b"", headers=dict(OTHER, **{"x-batch-id": "job"})),
+            ]
+        await batches.aclose()
+        return created, responses
+
+    created, responses = asyncio.run(scenario())
+    assert created.status_code == 200 and len(created.text.splitlines()) == 4
+    assert [response.status_code for response in responses] == [200, 404, 200, 404, 404]
+    assert len(responses[2].text.splitlines()) == 4
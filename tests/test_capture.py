@@ -0,0 +1,67 @@
+import json
+import time
+from types import SimpleNamespace
+
+from fastapi import Response
+
+from capture import TrafficCapture
+from main import capture_exchange
+from raw_body import RawJSONBody
+
+ORIGINAL = {"model": "m", "thinking": {"type": "enabled"}, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_capture_records_client_body_not_transformed_body(tmp_path):
+    capture = TrafficCapture(str(tmp_path / "requests.jsonl"), sample_rate=1)
+    capture.start()
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(capture=capture)), headers={})
+
+    body = RawJSONBody(json.dumps(ORIGINAL).encode())
+    # 代理在发往上游前做的改写
+    body["stream"] = True
+    body["stream_options"] = {"include_usage": True}
+    body["messages"] = [dict(body["messages"][0], content=[{"type": "text", "text": "hi", "cache_control": {}}])]
+
+    capture_exchange(request, "/v1/messages", body, Response(content=b"{}"), time.monotonic())
+    capture.stop()
+
+    [record] = read_records(tmp_path / "requests.jsonl")
+    assert record["body"] == ORIGINAL
+
+
+def test_unparseable_body_is_kept_as_text(tmp_path):
+    capture = TrafficCapture(str(tmp_path / "requests.jsonl"), sample_rate=1)
+    capture.start()
+    capture.record("/v1/messages", {}, b"not json", 400, time.monotonic())
+    capture.stop()
+
+    [record] = read_records(tmp_path / "requests.jsonl")
+    assert record["body"] == "not json"
+
+
+def test_counters_from_event_loop_and_writer_thread_add_up(tmp_path):
+    """入队计数（调用方线程）与写入计数（后台线程）并发更新时不丢失"""
+    import threading
+
+    capture = TrafficCapture(str(tmp_path / "requests.jsonl"), sample_rate=1, queue_size=50)
+    capture.start()
+
+    def produce():
+        for _ in range(500):
+            capture.record("/v1/messages", {}, b"{}", 200, time.monotonic())
+
+    threads = [threading.Thread(target=produce) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    capture.stop()
+
+    stats = capture.stats()
+    assert stats["captured"] + stats["dropped"] == 2000
+    assert stats["written"] == stats["captured"] == len(read_records(tmp_path / "requests.jsonl"))
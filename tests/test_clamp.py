@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from token_counter import TokenCounter
+
+
+def make_request(counter: TokenCounter):
+    return SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(token_counter=counter)))
+
+
+@pytest.fixture
+def clamp(monkeypatch):
+    monkeypatch.setattr(main, "MAX_TOKENS_CLAMP_ENABLED", True)
+    monkeypatch.setattr(main, "DEFAULT_CONTEXT_WINDOW", 262144)
+    monkeypatch.setattr(main, "MODEL_CONTEXT_WINDOWS", {})
+    monkeypatch.setattr(main, "TOKEN_ESTIMATE_SAFETY_MARGIN", 1.5)
+    return lambda body, counter=None: main.clamp_max_tokens(make_request(counter or TokenCounter()), body)
+
+
+def test_disabled_by_default_leaves_body_alone(monkeypatch):
+    monkeypatch.setattr(main, "MAX_TOKENS_CLAMP_ENABLED", False)
+    body = {"model": "m", "max_tokens": 10 ** 9, "messages": [{"role": "user", "content": "x" * 10 ** 6}]}
+    assert main.clamp_max_tokens(make_request(TokenCounter()), body) is None
+    assert body["max_tokens"] == 10 ** 9
+
+
+def test_estimate_does_not_reject_prompt_near_the_window(clamp):
+    # 950k 字符的英文约 21 万 token，字符估算约 27 万，超出窗口但在安全倍数之内
+    body = {"model": "m", "max_tokens": 32000, "messages": [{"role": "user", "content": "word " * 190000}]}
+    assert clamp(body) is None
+    assert body["max_tokens"] == 32000
+
+
+def test_estimate_rejects_prompt_far_beyond_the_window(clamp):
+    body = {"model": "m", "max_tokens": 1000, "messages": [{"role": "user", "content": "word " * 400000}]}
+    assert clamp(body).startswith("prompt is too long")
+
+
+def test_tiktoken_counts_reject_without_margin(clamp, monkeypatch):
+    counter = TokenCounter()
+    monkeypatch.setattr(counter, "_encode", lambda text: text.split())
+    body = {"model": "m", "max_tokens": 1000, "messages": [{"role": "user", "content": "word " * 270000}]}
+    assert clamp(body, counter).startswith("prompt is too long")
+
+
+def test_thinking_budget_is_shrunk_with_max_tokens(clamp, monkeypatch):
+    counter = TokenCounter()
+    monkeypatch.setattr(counter, "_encode", lambda text: text.split())
+    body = {
+        "model": "m", "max_tokens": 64000, "thinking": {"type": "enabled", "budget_tokens": 60000},
+        "messages": [{"role": "user", "content": "word " * 232000}],
+    }
+    assert clamp(body, counter) is None
+    assert body["thinking"]["budget_tokens"] == body["max_tokens"] - 1
+    assert body["thinking"]["budget_tokens"] >= main.THINKING_MIN_BUDGET_TOKENS
+
+
+def test_thinking_budget_never_goes_below_minimum(clamp, monkeypatch):
+    counter = TokenCounter()
+    monkeypatch.setattr(counter, "_encode", lambda text: text.split())
+    thinking = {"type": "enabled", "budget_tokens": 8000}
+    body = {"model": "m", "max_tokens": 16000, "thinking": thinking,
+            "messages": [{"role": "user", "content": "word " * 261800}]}
+    assert clamp(body, counter) is None
+    assert body["max_tokens"] == 16000
+    assert body["thinking"] is thinking
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from stream_relay import STREAM_STATS, DisconnectGuard
+
+
+class FakeRequest:
+    """receive() 在 disconnect() 被调用后返回 http.disconnect"""
+
+    def __init__(self):
+        self._disconnected = asyncio.Event()
+
+    def disconnect(self):
+        self._disconnected.set()
+
+    async def receive(self):
+        await self._disconnected.wait()
+        return {"type": "http.disconnect"}
+
+
+class Upstream:
+    """先产出一个 chunk，然后一直等待（模拟上游还在生成）"""
+
+    def __init__(self):
+        self.closed = False
+        self.first_sent = asyncio.Event()
+
+    async def chunks(self):
+        try:
+            yield b"data: {}\n\n"
+            self.first_sent.set()
+            await asyncio.Event().wait()
+        finally:
+            self.closed = True
+
+
+async def consume(guard, upstream, received):
+    relay = guard.relay(upstream.chunks())
+    try:
+        async for chunk in relay:
+            received.append(chunk)
+    finally:
+        await relay.aclose()
+
+
+def test_disconnect_aborts_pending_read():
+    async def scenario():
+        request, upstream, received = FakeRequest(), Upstream(), []
+        guard = DisconnectGuard(request, max_tokens=100)
+        task = asyncio.create_task(consume(guard, upstream, received))
+        await upstream.first_sent.wait()
+        request.disconnect()
+        await asyncio.wait_for(task, 1)
+        return guard, upstream, received
+
+    before = dict(STREAM_STATS)
+    guard, upstream, received = asyncio.run(scenario())
+    assert guard.aborted and upstream.closed
+    assert received == [b"data: {}\n\n"]
+    assert STREAM_STATS["aborted_streams"] == before["aborted_streams"] + 1
+    assert STREAM_STATS["saved_tokens"] == before["saved_tokens"] + 99
+
+
+def test_outer_cancellation_propagates():
+    async def scenario():
+        request, upstream = FakeRequest(), Upstream()
+        task = asyncio.create_task(consume(DisconnectGuard(request), upstream, []))
+        await upstream.first_sent.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return upstream
+
+    assert asyncio.run(scenario()).closed
+
+
+def test_outer_cancellation_is_not_swallowed_by_simultaneous_disconnect():
+    """服务器关闭与客户端断开同时发生时，外部取消不能被 uncancel() 吞掉"""
+    async def scenario():
+        request, upstream = FakeRequest(), Upstream()
+        guard = DisconnectGuard(request)
+        task = asyncio.create_task(consume(guard, upstream, []))
+        await upstream.first_sent.wait()
+        request.disconnect()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return guard, task
+
+    guard, task = asyncio.run(scenario())
+    assert task.cancelled()
@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+
+from hedging import Hedger
+
+
+def sender(*attempts):
+    """依次为每次调用返回 (延迟秒数, 状态码) 对应的响应"""
+    calls = iter(attempts)
+
+    async def send() -> httpx.Response:
+        delay, status = next(calls)
+        await asyncio.sleep(delay)
+        return httpx.Response(status, content=b"data: %d\n\n" % status)
+
+    return send
+
+
+def reader(response: httpx.Response):
+    return response.aiter_bytes()
+
+
+def hedger() -> Hedger:
+    return Hedger(default_delay=0.05, min_delay=0.01, budget_burst=10)
+
+
+async def open_and_read(h: Hedger, send):
+    response, chunks = await h.open("/r", send, reader)
+    body = b"".join([chunk async for chunk in chunks]) if chunks is not None else await response.aread()
+    return response.status_code, body
+
+
+def test_fast_error_on_hedge_does_not_beat_healthy_primary():
+    h = hedger()
+    status, body = asyncio.run(open_and_read(h, sender((0.2, 200), (0.0, 429))))
+    assert (status, body) == (200, b"data: 200\n\n")
+    assert h.hedged == 1 and h.hedge_wins == 0
+
+
+def test_fast_error_on_primary_waits_for_hedge():
+    h = hedger()
+    # 主请求在对冲发出后才失败
+    status, _ = asyncio.run(open_and_read(h, sender((0.1, 503), (0.2, 200))))
+    assert status == 200
+    assert h.hedge_wins == 1
+
+
+def test_both_failing_surfaces_primary_error():
+    h = hedger()
+    status, body = asyncio.run(open_and_read(h, sender((0.1, 503), (0.0, 429))))
+    assert (status, body) == (503, b"data: 503\n\n")
+
+
+def test_error_before_hedge_delay_is_returned_without_hedging():
+    h = hedger()
+    status, _ = asyncio.run(open_and_read(h, sender((0.0, 429))))
+    assert status == 429
+    assert h.hedged == 0
+
+
+def test_cancelled_loser_is_recorded_as_ttfb_sample():
+    h = hedger()
+    status, _ = asyncio.run(open_and_read(h, sender((1.0, 200), (0.0, 200))))
+    assert status == 200 and h.hedge_wins == 1
+    samples = sorted(h._trackers["/r"]._samples)
+    # 胜出的对冲请求与被取消的主请求（至少等待了对冲延迟）各一个样本
+    assert len(samples) == 2
+    assert samples[1] >= 0.05
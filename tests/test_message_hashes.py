@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+import message_transformer
+from message_transformer import IncrementalHistoryFixer, MessageHashes, ReasoningContentTransformer
+from prompt_cache import PromptCacheOptimizer
+from raw_body import RawJSONBody
+from token_counter import TokenCounter
+
+MESSAGES = [
+    {"role": "user", "content": "hi"},
+    {"role": "assistant", "content": "<thinking>plan</thinking>ok", "tool_calls": [
+        {"id": "c0", "type": "function", "function": {"name": "f", "arguments": "{}"}},
+    ]},
+    {"role": "tool", "tool_call_id": "c0", "content": "done"},
+    {"role": "user", "content": "next"},
+]
+
+
+def raw_body():
+    return RawJSONBody(json.dumps({"model": "m", "messages": MESSAGES}).encode())
+
+
+def count_freeze(monkeypatch):
+    calls = []
+    original = message_transformer.freeze
+
+    def counting(value):
+        calls.append(value)
+        return original(value)
+
+    monkeypatch.setattr(message_transformer, "freeze", counting)
+    return calls
+
+
+def test_unmodified_messages_use_raw_hashes(monkeypatch):
+    calls = count_freeze(monkeypatch)
+    first, second = raw_body(), raw_body()
+    assert MessageHashes(first).prefixes(first["messages"]) == MessageHashes(second).prefixes(second["messages"])
+    assert calls == []
+
+
+def test_fix_count_and_breakpoints_share_one_hash_pass(monkeypatch):
+    body = raw_body()
+    hashes = MessageHashes(body)
+    fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_message)
+    calls = count_freeze(monkeypatch)
+
+    body["messages"] = fixer.fix(body["messages"], hashes)
+    counter = TokenCounter()
+    counter.count_request(body, hashes)
+    PromptCacheOptimizer(counter, min_tokens=0).apply(body, "key", hashes)
+
+    # 只有修复后新产生的那条 assistant 消息需要 freeze（其余调用为 tools、system 和嵌套的值）
+    messages = [value for value in calls if isinstance(value, dict) and "role" in value]
+    assert messages == [body["messages"][1]]
+
+
+def test_fix_with_shared_hashes_matches_full_fix():
+    fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_message)
+    expected = ReasoningContentTransformer.fix_messages(MESSAGES)
+    for _ in range(2):
+        body = raw_body()
+        assert fixer.fix(body["messages"], MessageHashes(body)) == expected
+    assert fixer.hits == 1
+
+
+def test_modified_message_is_rehashed():
+    body = raw_body()
+    hashes = MessageHashes(body)
+    before = hashes.prefixes(body["messages"])
+    changed = list(body["messages"])
+    changed[0] = dict(changed[0], content="other")
+    after = hashes.prefixes(changed)
+    assert after[0] != before[0]
+    assert hashes.prefixes(body["messages"]) == before
+
+
+@pytest.mark.parametrize("first, second", [
+    (1, True),
+    (1, 1.0),
+    ("1", 1),
+    # CPython 中 hash(-1) == hash(-2)，包含它们的 tuple 的 hash 也相同
+    (-1, -2),
+])
+def test_digest_distinguishes_values_with_equal_python_hashes(first, second):
+    hashes = MessageHashes()
+    assert hashes.get({"role": "user", "n": first}) != hashes.get({"role": "user", "n": second})
+
+
+def test_fixed_history_is_not_shared_across_credentials():
+    fixer = IncrementalHistoryFixer(ReasoningContentTransformer.fix_message)
+    messages = [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "<thinking>plan</thinking>ok"},
+    ]
+    fixer.fix(messages, credential="Bearer sk-a")
+    fixer.fix(messages, credential="Bearer sk-a")
+    assert (fixer.hits, fixer.misses) == (1, 1)
+    fixer.fix(messages, credential="Bearer sk-b")
+    assert (fixer.hits, fixer.misses) == (1, 2)
@@ -0,0 +1,71 @@
+import asyncio
+import gzip
+import json
+
+import httpx
+import pytest
+
+import main
+
+EVENTS = (
+    b'event: message_start\ndata: {"type":"message_start","message":{"id":"m","usage":{"input_tokens":3}}}\n\n'
+    b'event: content_block_delta\r\ndata: {"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"<thinking>x"}}\r\n\r\n'
+    b'event: message_stop\ndata: {"type":"message_stop"}\n\n'
+)
+
+
+class ChunkStream(httpx.AsyncByteStream):
+    """按固定大小分块产出的上游响应体（MockTransport 对 bytes 内容会预先读完，无法测试 aiter_raw）"""
+
+    def __init__(self, data: bytes, size: int = 7):
+        self._chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+@pytest.fixture
+def anthropic_upstream(proxy, monkeypatch):
+    """直连 Anthropic 格式上游，记录收到的请求"""
+    monkeypatch.setattr(main, "MESSAGES_UPSTREAM_FORMAT", "anthropic")
+    seen = []
+
+    def connect(content, headers):
+        def handler(request):
+            request.read()
+            seen.append(request)
+            return httpx.Response(200, stream=ChunkStream(content), headers=headers)
+        return proxy(handler)
+
+    return connect, seen
+
+
+def stream_messages(client):
+    async def scenario():
+        async with client:
+            return await client.post(
+                "/v1/messages",
+                json={"model": "m", "stream": True, "max_tokens": 10, "messages": [{"role": "user", "content": "hi"}]},
+                headers={"x-api-key": "sk-test"},
+            )
+    return asyncio.run(scenario())
+
+
+def test_stream_is_relayed_byte_for_byte(anthropic_upstream):
+    connect, seen = anthropic_upstream
+    response = stream_messages(connect(EVENTS, {"content-type": "text/event-stream"}))
+    # CRLF 分隔和看起来像 <thinking> 的文本都不做任何处理
+    assert response.content == EVENTS
+    assert response.headers["content-type"] == "text/event-stream"
+    assert seen[0].headers["accept-encoding"] == "identity"
+    assert json.loads(seen[0].content)["stream"] is True
+
+
+def test_compressed_stream_keeps_upstream_content_encoding(anthropic_upstream):
+    connect, _ = anthropic_upstream
+    compressed = gzip.compress(EVENTS)
+    response = stream_messages(connect(compressed, {"content-type": "text/event-stream", "content-encoding": "gzip"}))
+    assert response.headers["content-encoding"] == "gzip"
+    # httpx 客户端按 content-encoding 解压，透传的字节必须与头一致
+    assert response.content == EVENTS
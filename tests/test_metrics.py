@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import metrics
+from metrics import StreamMeter, parse_cache_tokens, parse_output_tokens
+
+ANTHROPIC_STREAM = (
+    b'event: message_start\ndata: {"type":"message_start","message":{"usage":'
+    b'{"input_tokens":12,"cache_creation_input_tokens":0,"cache_read_input_tokens":4096,"output_tokens":1}}}\n\n'
+    + b'event: content_block_delta\ndata: {"type":"content_block_delta","delta":{"text":"' + b"x" * 300 + b'"}}\n\n'
+    + b'event: message_delta\ndata: {"type":"message_delta","usage":{"output_tokens":1234}}\n\n'
+    b'event: message_stop\ndata: {"type":"message_stop"}\n\n'
+)
+
+
+def meter(chunks, monkeypatch):
+    """经过 StreamMeter 转发 chunks，返回记录的 (输出 token 数, 缓存 token 数)"""
+    recorded = {}
+    monkeypatch.setattr(metrics, "observe_output_tokens", lambda route, tokens, duration: recorded.update(output=tokens))
+    monkeypatch.setattr(metrics, "observe_cache_tokens", lambda route, usage: recorded.update(cache=usage))
+
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def drain():
+        return b"".join([chunk async for chunk in StreamMeter("/v1/messages").wrap(source())])
+
+    assert asyncio.run(drain()) == b"".join(chunks)
+    return recorded["output"], recorded["cache"]
+
+
+def test_parsers_take_the_last_value():
+    assert parse_output_tokens(ANTHROPIC_STREAM) == 1234
+    assert parse_cache_tokens(ANTHROPIC_STREAM) == (4096, 0)
+
+
+def test_whole_stream_in_one_chunk(monkeypatch):
+    assert meter([ANTHROPIC_STREAM], monkeypatch) == (1234, (4096, 0))
+
+
+@pytest.mark.parametrize("cut", range(0, len(ANTHROPIC_STREAM), 3))
+def test_usage_split_across_a_chunk_boundary(monkeypatch, cut):
+    assert meter([ANTHROPIC_STREAM[:cut], ANTHROPIC_STREAM[cut:]], monkeypatch) == (1234, (4096, 0))
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 17])
+def test_usage_split_over_many_small_chunks(monkeypatch, size):
+    chunks = [ANTHROPIC_STREAM[i:i + size] for i in range(0, len(ANTHROPIC_STREAM), size)]
+    assert meter(chunks, monkeypatch) == (1234, (4096, 0))
@@ -0,0 +1,90 @@
+import copy
+
+from prompt_cache import MAX_BREAKPOINTS, PromptCacheOptimizer
+from token_counter import TokenCounter
+
+TOOLS = [{"name": "search", "description": "d", "input_schema": {"type": "object"}}]
+SYSTEM = "You are a helpful assistant."
+
+
+def request(*contents, **extra):
+    roles = ["user", "assistant"]
+    messages = [{"role": roles[i % 2], "content": content} for i, content in enumerate(contents)]
+    return dict({"model": "m", "tools": TOOLS, "system": SYSTEM, "messages": messages}, **extra)
+
+
+def marked(body):
+    """返回带断点的位置：tools / system / 消息下标"""
+    found = []
+    if any("cache_control" in tool for tool in body.get("tools") or []):
+        found.append("tools")
+    if isinstance(body.get("system"), list) and any("cache_control" in b for b in body["system"]):
+        found.append("system")
+    for index, msg in enumerate(body["messages"]):
+        if isinstance(msg["content"], list) and any("cache_control" in b for b in msg["content"]):
+            found.append(index)
+    return found
+
+
+def optimizer(**kwargs):
+    return PromptCacheOptimizer(TokenCounter(), **dict({"min_tokens": 1}, **kwargs))
+
+
+def test_tools_and_system_are_marked_once_they_repeat():
+    cache = optimizer()
+    first = request("hi")
+    assert cache.apply(first, "key") == 0
+    assert marked(first) == []
+
+    second = request("hello")
+    assert cache.apply(second, "key") == 2
+    assert marked(second) == ["tools", "system"]
+    assert second["system"] == [{"type": "text", "text": SYSTEM, "cache_control": {"type": "ephemeral"}}]
+
+
+def test_continued_session_reads_the_previous_prefix_and_writes_the_last_message():
+    cache = optimizer()
+    cache.apply(request("q1"), "key")
+    body = request("q1", "a1", "q2")
+    assert cache.apply(body, "key") == 4 <= MAX_BREAKPOINTS
+    assert marked(body) == ["tools", "system", 0, 2]
+
+
+def test_prefixes_are_not_shared_across_credentials():
+    cache = optimizer()
+    cache.apply(request("q1"), "key-a")
+    body = request("q1", "a1", "q2")
+    assert cache.apply(body, "key-b") == 0
+
+
+def test_client_breakpoints_are_left_alone():
+    cache = optimizer()
+    cache.apply(request("q1"), "key")
+    body = request("q1", "a1", [{"type": "text", "text": "q2", "cache_control": {"type": "ephemeral"}}])
+    original = copy.deepcopy(body)
+    assert cache.apply(body, "key") == 0
+    assert body == original
+
+
+def test_short_prefixes_are_not_marked():
+    cache = optimizer(min_tokens=100000)
+    cache.apply(request("q1"), "key")
+    body = request("q1", "a1", "q2")
+    assert cache.apply(body, "key") == 0
+    assert marked(body) == []
+
+
+def test_injection_copies_instead_of_mutating():
+    cache = optimizer(ttl="1h")
+    answer = [{"type": "text", "text": "a1"}, {"type": "thinking", "thinking": "t", "signature": "s"}]
+    cache.apply(request("q1", answer), "key")
+    body = request("q1", answer, "q2")
+    messages, tools = body["messages"], body["tools"]
+    snapshot = copy.deepcopy(body)
+
+    assert cache.apply(body, "key") == 4
+    assert messages == snapshot["messages"] and tools == snapshot["tools"]
+    assert body["messages"] is not messages and body["tools"] is not tools
+    # thinking block 不能携带 cache_control，断点落在前一个 block 上
+    assert body["messages"][1]["content"][0]["cache_control"] == {"type": "ephemeral", "ttl": "1h"}
+    assert "cache_control" not in body["messages"][1]["content"][1]
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from raw_body import RawJSONBody, encode_body
+
+
+def round_trip(body: RawJSONBody):
+    """拼接结果必须是合法 JSON，且与 dict 内容一致"""
+    data = body.to_bytes()
+    assert json.loads(data) == dict(body)
+    return data
+
+
+def test_unmodified_body_returns_original_bytes():
+    raw = b'{ "model" : "m",\n "messages": [ {"role": "user", "content": "hi"} ] }'
+    assert RawJSONBody(raw).to_bytes() is raw
+
+
+@pytest.mark.parametrize("raw", [b"{}", b"{ }", b" {\n} "])
+def test_insert_into_empty_object(raw):
+    body = RawJSONBody(raw)
+    body["stream"] = True
+    assert json.loads(round_trip(body)) == {"stream": True}
+
+
+def test_several_inserts_into_empty_object():
+    body = RawJSONBody(b"{}")
+    body["stream"] = True
+    body["x"] = {"include_usage": True}
+    body["y"] = [1, "二"]
+    data = round_trip(body)
+    assert list(json.loads(data)) == ["stream", "x", "y"]
+
+
+def test_several_inserts_after_existing_fields():
+    body = RawJSONBody(b'{"model": "m"}')
+    body["stream"] = True
+    body["stream_options"] = {"include_usage": True}
+    data = round_trip(body)
+    assert list(json.loads(data)) == ["model", "stream", "stream_options"]
+
+
+def test_replace_plus_insert():
+    body = RawJSONBody(b'{"model": "m", "max_tokens": 10, "temperature": 0.5}')
+    body["max_tokens"] = 16000
+    body["temperature"] = 1.0
+    body["stream"] = True
+    data = round_trip(body)
+    assert data.startswith(b'{"model": "m", "max_tokens": 16000')
+
+
+def test_nested_values_are_replaced_whole():
+    raw = b'{"thinking": {"type": "enabled", "budget_tokens": 10}, "extra_body": {"a": {"b": [1, 2]}}}'
+    body = RawJSONBody(raw)
+    body["thinking"] = dict(body["thinking"], budget_tokens=2048)
+    body["extra_body"] = {"a": {"b": [3]}, "c": None}
+    round_trip(body)
+
+
+def test_replace_individual_messages():
+    raw = json.dumps({"messages": [
+        {"role": "user", "content": "a"},
+        {"role": "assistant", "content": "b"},
+        {"role": "user", "content": "c"},
+    ]}).encode()
+    body = RawJSONBody(raw)
+    messages = list(body["messages"])
+    messages[1] = dict(messages[1], reasoning_content="r")
+    body["messages"] = messages
+    body["stream"] = False
+    round_trip(body)
+
+
+def test_unicode_escapes_and_literal_non_ascii():
+    raw = '{"system": "\\u4e2d\\u6587 \\ud83d\\ude00", "messages": [{"role": "user", "content": "中文 😀 \\n"}], "model": "模型"}'.encode()
+    body = RawJSONBody(raw)
+    assert body["system"] == "中文 😀"
+    messages = list(body["messages"])
+    messages[0] = dict(messages[0], content="已修改 ✓")
+    body["messages"] = messages
+    body["model"] = "m2"
+    body["note"] = "插入"
+    data = round_trip(body)
+    # 未修改的字段保留原文中的转义
+    assert b'"\\u4e2d\\u6587 \\ud83d\\ude00"' in data
+
+
+def test_deleted_field_falls_back_to_full_serialization():
+    body = RawJSONBody(b'{"a": 1, "b": 2}')
+    del body["a"]
+    body["c"] = 3
+    assert json.loads(round_trip(body)) == {"b": 2, "c": 3}
+
+
+def test_encode_body_plain_dict():
+    assert json.loads(encode_body({"a": "中"})) == {"a": "中"}
+
+
+@pytest.mark.parametrize("raw", [b"", b"[]", b'{"a": 1', b'{"a": 1} x', b'\xff'])
+def test_invalid_bodies_raise_json_decode_error(raw):
+    with pytest.raises(json.JSONDecodeError):
+        RawJSONBody(raw)
@@ -0,0 +1,112 @@
+import pytest
+
+from response_cache import CACHE_KEY_EXCLUDED_FIELDS, ResponseCache
+
+BODY = {
+    "model": "kimi-k2.5",
+    "messages": [{"role": "user", "content": "hi"}],
+    "max_tokens": 100,
+    "max_completion_tokens": 5,
+    "temperature": 0.7,
+    "logprobs": True,
+    "top_logprobs": 2,
+    "logit_bias": {"42": -100},
+    "parallel_tool_calls": False,
+    "reasoning_effort": "low",
+    "extra_body": {"thinking": {"type": "enabled"}},
+    "metadata": {"session": "a"},
+    "user": "u1",
+    "stream_options": {"include_usage": True},
+    "stream": False,
+}
+
+
+def key(body, route="/chat/completions", credential="Bearer sk-1"):
+    return ResponseCache.make_key(route, body, credential)
+
+
+@pytest.mark.parametrize("field", sorted(set(BODY) - CACHE_KEY_EXCLUDED_FIELDS))
+def test_changing_any_field_changes_key(field):
+    changed = dict(BODY, **{field: ["changed"]})
+    assert key(changed) != key(BODY)
+
+
+@pytest.mark.parametrize("field", sorted(set(BODY) - CACHE_KEY_EXCLUDED_FIELDS))
+def test_removing_any_field_changes_key(field):
+    removed = {name: value for name, value in BODY.items() if name != field}
+    assert key(removed) != key(BODY)
+
+
+def test_unknown_fields_are_part_of_key():
+    assert key(dict(BODY, vendor_option=1)) != key(dict(BODY, vendor_option=2))
+
+
+def test_max_completion_tokens_changes_key():
+    assert key(dict(BODY, max_completion_tokens=5)) != key(dict(BODY, max_completion_tokens=50))
+
+
+def test_excluded_fields_do_not_change_key():
+    assert key(dict(BODY, stream=True)) == key(BODY)
+
+
+def test_key_ignores_field_order():
+    assert key(dict(reversed(list(BODY.items())))) == key(BODY)
+
+
+def test_key_isolated_by_route_and_credential():
+    assert key(BODY, route="/v1/messages") != key(BODY)
+    assert key(BODY, credential="Bearer sk-2") != key(BODY)
+
+
+def test_lookup_misses_on_different_max_completion_tokens():
+    cache = ResponseCache(max_entries=16, ttl=60, max_bytes=1024)
+    first_key, cached = cache.lookup({}, "/chat/completions", dict(BODY, max_completion_tokens=5), "k")
+    assert cached is None
+    cache.set(first_key, b"{}", 200, "application/json")
+
+    _, cached = cache.lookup({}, "/chat/completions", dict(BODY, max_completion_tokens=50), "k")
+    assert cached is None
+    _, cached = cache.lookup({}, "/chat/completions", dict(BODY, max_completion_tokens=5), "k")
+    assert cached is not None
+
+
+def test_prompt_cache_breakpoints_do_not_change_the_key(proxy, monkeypatch):
+    """提示缓存断点取决于之前的请求，相同的客户端请求仍应命中同一缓存项"""
+    import asyncio
+
+    import httpx
+
+    import main
+    from prompt_cache import PromptCacheOptimizer
+    from token_counter import TokenCounter
+
+    monkeypatch.setattr(main, "MESSAGES_UPSTREAM_FORMAT", "anthropic")
+    upstream_bodies = []
+
+    def handler(request):
+        upstream_bodies.append(request.read())
+        return httpx.Response(200, json={"type": "message", "content": [{"type": "text", "text": "ok"}]})
+
+    body = {
+        "model": "m",
+        "max_tokens": 10,
+        "system": "You are a helpful agent.",
+        "tools": [{"name": "search", "input_schema": {"type": "object"}}],
+        "messages": [{"role": "user", "content": "hi"}],
+    }
+    client = proxy(
+        handler,
+        response_cache=ResponseCache(100, 60, 1 << 20),
+        prompt_cache=PromptCacheOptimizer(TokenCounter(), min_tokens=1),
+    )
+
+    async def scenario():
+        async with client:
+            return [
+                await client.post("/v1/messages", json=body, headers={"x-api-key": "sk-test"})
+                for _ in range(3)
+            ]
+
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert len(upstream_bodies) == 1
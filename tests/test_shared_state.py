@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from shared_state import SharedState, SharedTable, stable_hash
+
+# 每个子进程各自打开共享状态目录，与 gunicorn worker 一致
+fork = multiprocessing.get_context("fork")
+
+
+def run_workers(target, directory, count=4):
+    """在 count 个进程中并发执行 target(state, results)，返回所有进程放入 results 的值"""
+    results = fork.Queue()
+    start = fork.Event()
+
+    def main():
+        state = SharedState(directory, slots=64)
+        start.wait()
+        try:
+            target(state, results)
+        finally:
+            state.close()
+
+    processes = [fork.Process(target=main) for _ in range(count)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    values = []
+    while not results.empty():
+        values.append(results.get())
+    return values
+
+
+def test_counter_increments_from_all_workers_add_up(tmp_path):
+    def increment(state, results):
+        for _ in range(5000):
+            state.counters.inc("requests")
+
+    run_workers(increment, str(tmp_path))
+    state = SharedState(str(tmp_path), slots=64)
+    assert state.counters.get("requests") == 20000
+    state.close()
+
+
+def test_key_limiter_burst_is_shared_across_workers(tmp_path):
+    def take(state, results):
+        limiter = state.key_limiter(request_rate=0.001, request_burst=1000, token_rate=0, token_burst=0)
+        results.put(sum(limiter.check("sk-a", 0) is None for _ in range(1000)))
+
+    assert sum(run_workers(take, str(tmp_path))) == 1000
+
+
+def test_token_budget_is_checked_and_taken_under_one_lock(tmp_path):
+    state = SharedState(str(tmp_path), slots=64)
+    limiter = state.key_limiter(request_rate=100, request_burst=100, token_rate=10, token_burst=1000)
+    assert limiter.check("sk-a", 600) is None
+    # 请求令牌充足，token 不足时整体拒绝，也不扣请求令牌
+    assert limiter.check("sk-a", 600) == pytest.approx(20, abs=0.1)
+    assert limiter.check("sk-a", 300) is None
+    assert limiter.check("sk-b", 1000) is None
+    state.close()
+
+
+def test_response_cache_entries_and_hit_counts_are_shared(tmp_path):
+    directory = str(tmp_path)
+    state = SharedState(directory, slots=64)
+    cache = state.response_cache(max_entries=10, ttl=60, max_bytes=1 << 20)
+    cache.set("k", b'{"ok": true}', 200, "application/json")
+
+    def read(state, results):
+        entry = state.response_cache(max_entries=10, ttl=60, max_bytes=1 << 20).get("k")
+        results.put((entry.content, entry.media_type))
+
+    assert run_workers(read, directory, count=2) == [(b'{"ok": true}', "application/json")] * 2
+    assert cache.get("missing") is None
+    assert cache.stats() == {"entries": 1, "bytes": os.path.getsize(tmp_path / "cache" / "k"), "hits": 2, "misses": 1}
+    state.close()
+
+
+def test_response_cache_expires_and_evicts_oldest(tmp_path):
+    state = SharedState(str(tmp_path), slots=64)
+    cache = state.response_cache(max_entries=2, ttl=60, max_bytes=1 << 20)
+    cache.set("expired", b"x", 200, "text/plain")
+    with open(tmp_path / "cache" / "expired", "r+b") as f:
+        f.write(b"\0" * 8)  # 过期时间改为 1970 年
+    assert cache.get("expired") is None
+    assert not (tmp_path / "cache" / "expired").exists()
+
+    for index, key in enumerate(["a", "b", "c"]):
+        cache.set(key, b"x", 200, "text/plain")
+        os.utime(tmp_path / "cache" / key, (time.time() + index, time.time() + index))
+    cache.sweep()
+    assert sorted(os.listdir(tmp_path / "cache")) == ["b", "c"]
+    # 非 200 响应不缓存
+    cache.set("error", b"x", 500, "text/plain")
+    assert cache.get("error") is None
+    state.close()
+
+
+def test_colliding_keys_overwrite_the_slot(tmp_path):
+    table = SharedTable(str(tmp_path / "table.bin"), slots=1, fields=1)
+    table.update("a", lambda current: ((1.0,), None))
+    assert table.read("a") == (1.0,)
+    previous = table.update("b", lambda current: ((2.0,), current))
+    assert previous is None
+    assert table.read("a") is None and table.read("b") == (2.0,)
+    table.close()
+
+
+def test_stable_hash_is_the_same_in_every_process(tmp_path):
+    def compute(state, results):
+        results.put(stable_hash("sk-a"))
+
+    assert set(run_workers(compute, str(tmp_path), count=2)) == {stable_hash("sk-a")}
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+from single_flight import SingleFlight
+from upstream_pool import Upstream, UpstreamPool
+
+SSE_BODY = (
+    b'data: {"id":"c","choices":[{"index":0,"delta":{"role":"assistant","content":"ok"}}]}\n\n'
+    b'data: {"id":"c","choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\n\n'
+    b"data: [DONE]\n\n"
+)
+
+
+@pytest.fixture
+def upstream_calls(monkeypatch):
+    """main.app 连接到一个记录请求体的本地上游，启用单飞合并"""
+    calls = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        calls.append(body)
+        # 保持请求在途，让并发请求有机会被合并
+        await asyncio.sleep(0.2)
+        if body.get("stream"):
+            return httpx.Response(200, content=SSE_BODY, headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": str(body.get("max_completion_tokens"))}}],
+        })
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://upstream")
+    monkeypatch.setattr(main, "SINGLE_FLIGHT_ENABLED", True)
+    monkeypatch.setattr(main, "MAX_TOKENS_CLAMP_ENABLED", False)
+    state = main.app.state
+    for name, value in {
+        "upstreams": UpstreamPool([Upstream("http://upstream", client)]),
+        "single_flight": SingleFlight(),
+        "response_cache": None,
+        "hedger": None,
+        "capture": None,
+        "admission": None,
+        "prompt_cache": None,
+    }.items():
+        monkeypatch.setattr(state, name, value, raising=False)
+    return calls
+
+
+async def post_concurrently(bodies):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        return await asyncio.gather(*(
+            client.post("/v1/chat/completions", json=body, headers={"Authorization": "Bearer sk-test"})
+            for body in bodies
+        ))
+
+
+def request(max_completion_tokens, stream=False):
+    return {
+        "model": "kimi-k2.5",
+        "messages": [{"role": "user", "content": "hi"}],
+        "max_completion_tokens": max_completion_tokens,
+        "stream": stream,
+    }
+
+
+def test_identical_requests_are_coalesced(upstream_calls):
+    responses = asyncio.run(post_concurrently([request(5), request(5)]))
+    assert [r.status_code for r in responses] == [200, 200]
+    assert len(upstream_calls) == 1
+
+
+def test_requests_differing_in_max_completion_tokens_both_reach_upstream(upstream_calls):
+    responses = asyncio.run(post_concurrently([request(5), request(50)]))
+    assert sorted(call["max_completion_tokens"] for call in upstream_calls) == [5, 50]
+    assert [r.json()["choices"][0]["message"]["content"] for r in responses] == ["5", "50"]
+
+
+def test_streams_differing_in_max_completion_tokens_both_reach_upstream(upstream_calls):
+    responses = asyncio.run(post_concurrently([request(5, stream=True), request(50, stream=True)]))
+    assert [r.status_code for r in responses] == [200, 200]
+    assert sorted(call["max_completion_tokens"] for call in upstream_calls) == [5, 50]
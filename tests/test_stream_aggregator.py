@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from stream_aggregator import AnthropicStreamAggregator, OpenAIStreamAggregator
+
+
+def frame(payload, event=None):
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + json.dumps(payload).encode() + b"\n\n"
+
+
+def chunk(delta, finish_reason=None, index=0, **extra):
+    return frame(dict({
+        "id": "c1", "object": "chat.completion.chunk", "created": 1, "model": "m",
+        "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+    }, **extra))
+
+
+OPENAI_STREAM = b"".join([
+    chunk({"role": "assistant", "content": ""}),
+    chunk({"reasoning_content": "think "}),
+    chunk({"reasoning_content": "more"}),
+    chunk({"content": "Hel"}),
+    chunk({"content": "lo"}),
+    chunk({"tool_calls": [{"index": 0, "id": "call_1", "function": {"name": "get", "arguments": '{"a"'}}]}),
+    chunk({"tool_calls": [{"index": 0, "function": {"arguments": ": 1}"}}]}),
+    chunk({}, finish_reason="tool_calls"),
+    frame({"id": "c1", "choices": [], "usage": {"prompt_tokens": 3, "completion_tokens": 5}}),
+    b"data: [DONE]\n\n",
+])
+
+ANTHROPIC_STREAM = b"".join([
+    frame({"type": "message_start", "message": {
+        "id": "msg_1", "type": "message", "role": "assistant", "model": "m", "content": [],
+        "usage": {"input_tokens": 3, "output_tokens": 1},
+    }}, "message_start"),
+    frame({"type": "content_block_start", "index": 0, "content_block": {"type": "thinking", "thinking": ""}},
+          "content_block_start"),
+    frame({"type": "content_block_delta", "index": 0, "delta": {"type": "thinking_delta", "thinking": "hmm"}},
+          "content_block_delta"),
+    frame({"type": "content_block_delta", "index": 0, "delta": {"type": "signature_delta", "signature": "sig"}},
+          "content_block_delta"),
+    frame({"type": "content_block_start", "index": 1, "content_block": {"type": "text", "text": ""}},
+          "content_block_start"),
+    frame({"type": "content_block_delta", "index": 1, "delta": {"type": "text_delta", "text": "Hi"}},
+          "content_block_delta"),
+    frame({"type": "content_block_start", "index": 2,
+           "content_block": {"type": "tool_use", "id": "t1", "name": "get", "input": {}}}, "content_block_start"),
+    frame({"type": "content_block_delta", "index": 2, "delta": {"type": "input_json_delta", "partial_json": '{"a":'}},
+          "content_block_delta"),
+    frame({"type": "content_block_delta", "index": 2, "delta": {"type": "input_json_delta", "partial_json": " 1}"}},
+          "content_block_delta"),
+    frame({"type": "message_delta", "delta": {"stop_reason": "tool_use", "stop_sequence": None},
+           "usage": {"output_tokens": 9}}, "message_delta"),
+    frame({"type": "message_stop"}, "message_stop"),
+])
+
+
+def aggregate(aggregator, data, size):
+    for i in range(0, len(data), size):
+        aggregator.feed(data[i:i + size])
+    aggregator.flush()
+    return aggregator.result()
+
+
+@pytest.mark.parametrize("size", [1, 13, 1 << 20])
+def test_openai_stream_is_rebuilt_into_a_completion(size):
+    result = aggregate(OpenAIStreamAggregator(), OPENAI_STREAM, size)
+    assert result["id"] == "c1" and result["object"] == "chat.completion" and result["model"] == "m"
+    assert result["usage"] == {"prompt_tokens": 3, "completion_tokens": 5}
+    [choice] = result["choices"]
+    assert choice["finish_reason"] == "tool_calls"
+    assert choice["message"]["content"] == "Hello"
+    assert choice["message"]["reasoning_content"] == "think more"
+    assert choice["message"]["tool_calls"] == [
+        {"id": "call_1", "type": "function", "function": {"name": "get", "arguments": '{"a": 1}'}}
+    ]
+
+
+def test_openai_thinking_tags_in_content_are_split():
+    data = chunk({"content": "<thinking>plan</thinking>"}) + chunk({"content": "answer"}, finish_reason="stop")
+    message = aggregate(OpenAIStreamAggregator(), data, 5)["choices"][0]["message"]
+    assert message["reasoning_content"] == "plan"
+    assert message["content"] == "answer"
+
+
+def test_openai_stream_error_is_reported():
+    aggregator = OpenAIStreamAggregator()
+    result = aggregate(aggregator, chunk({"content": "x"}) + frame({"error": {"message": "overloaded"}}), 64)
+    assert aggregator.error is not None
+    assert result == {"error": {"message": "overloaded"}}
+
+
+@pytest.mark.parametrize("size", [1, 29, 1 << 20])
+def test_anthropic_stream_is_rebuilt_into_a_message(size):
+    result = aggregate(AnthropicStreamAggregator(), ANTHROPIC_STREAM.replace(b"\n", b"\r\n"), size)
+    assert result["id"] == "msg_1" and result["stop_reason"] == "tool_use"
+    assert result["usage"] == {"input_tokens": 3, "output_tokens": 9}
+    assert result["content"] == [
+        {"type": "thinking", "thinking": "hmm", "signature": "sig"},
+        {"type": "text", "text": "Hi"},
+        {"type": "tool_use", "id": "t1", "name": "get", "input": {"a": 1}},
+    ]
+
+
+def test_anthropic_stream_error_is_reported():
+    error = {"type": "overloaded_error", "message": "busy"}
+    result = aggregate(AnthropicStreamAggregator(), ANTHROPIC_STREAM[:200] + frame({"type": "error", "error": error}), 64)
+    assert result == {"type": "error", "error": error}
+
+
+def test_thinking_request_is_streamed_upstream_and_aggregated(proxy):
+    seen = []
+
+    async def handler(request):
+        seen.append(json.loads(request.content))
+        return httpx.Response(200, content=OPENAI_STREAM, headers={"content-type": "text/event-stream"})
+
+    async def scenario():
+        async with proxy(handler) as client:
+            return await client.post(
+                "/v1/chat/completions",
+                json={"model": "m", "thinking": {"type": "enabled"}, "messages": [{"role": "user", "content": "hi"}]},
+                headers={"Authorization": "Bearer sk-test"},
+            )
+
+    response = asyncio.run(scenario())
+    assert seen[0]["stream"] is True
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    body = response.json()
+    assert body["choices"][0]["message"]["content"] == "Hello"
+    assert body["usage"]["completion_tokens"] == 5
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from stream_relay import SSERelay
+
+
+def frame(chunk) -> bytes:
+    return b"data: " + json.dumps(chunk).encode() + b"\n\n"
+
+
+def content_chunk(text, index=0, **extra):
+    return frame({"id": "c", "model": "m", "choices": [{"index": index, "delta": dict({"content": text}, **extra)}]})
+
+
+def relay_all(chunks):
+    relay = SSERelay()
+    out = b"".join(relay.feed(chunk) for chunk in chunks)
+    return out + relay.flush()
+
+
+def decode(data: bytes):
+    """解析 SSE 输出为 data 载荷列表（[DONE] 保留为字符串）"""
+    payloads = []
+    for block in data.split(b"\n\n"):
+        if block.startswith(b"data: "):
+            payload = block[6:]
+            payloads.append(payload.decode() if payload == b"[DONE]" else json.loads(payload))
+    return payloads
+
+
+PLAIN_STREAM = (
+    b'data:{"id":"c","choices":[{"index":0,"delta":{"content":"Hello"}}]}\n\n'
+    b": keep-alive\n\n"
+    b'data: {"id":"c",  "choices":[{"index":0,"delta":{"content":" world"},"finish_reason":"stop"}]}\n\n'
+    b"data: [DONE]\n\n"
+)
+
+
+def test_frames_without_markers_are_forwarded_byte_for_byte():
+    assert relay_all([PLAIN_STREAM]) == PLAIN_STREAM
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64])
+def test_chunk_boundaries_do_not_change_output(size):
+    chunks = [PLAIN_STREAM[i:i + size] for i in range(0, len(PLAIN_STREAM), size)]
+    assert relay_all(chunks) == PLAIN_STREAM
+
+
+def test_partial_frame_is_held_until_complete():
+    relay = SSERelay()
+    assert relay.feed(PLAIN_STREAM[:20]) == b""
+    assert relay.feed(PLAIN_STREAM[20:]) == PLAIN_STREAM
+
+
+def test_crlf_framing_is_normalized():
+    assert relay_all([PLAIN_STREAM.replace(b"\n", b"\r\n")]) == PLAIN_STREAM
+
+
+def test_trailing_frame_without_blank_line_is_flushed():
+    data = b'data: {"id":"c","choices":[{"index":0,"delta":{"content":"x"}}]}'
+    assert relay_all([data]) == data + b"\n\n"
+
+
+def test_assistant_role_frame_gets_reasoning_content():
+    data = frame({"id": "c", "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}}]})
+    (chunk,) = decode(relay_all([data]))
+    assert chunk["choices"][0]["delta"] == {"role": "assistant", "content": "", "reasoning_content": None}
+
+
+def test_multiline_and_non_data_frames_pass_through():
+    data = b"event: ping\ndata: {}\n\n" + b'data: {"choices":[{"delta":{"role":"assistant"}}]}\n\n'
+    out = relay_all([data])
+    assert out.startswith(b"event: ping\ndata: {}\n\n")
+
+
+def test_streaming_endpoint_relays_upstream_bytes(proxy):
+    upstream = content_chunk("Hi") + content_chunk(" there", finish_reason="stop") + b"data: [DONE]\n\n"
+
+    async def handler(request):
+        return httpx.Response(200, content=upstream, headers={"content-type": "text/event-stream"})
+
+    async def scenario():
+        async with proxy(handler) as client:
+            return await client.post(
+                "/v1/chat/completions",
+                json={"model": "m", "stream": True, "messages": [{"role": "user", "content": "hi"}]},
+                headers={"Authorization": "Bearer sk-test"},
+            )
+
+    response = asyncio.run(scenario())
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.content == upstream
+
+
+def relay_text(chunks):
+    """把每段 content 作为一个 chunk 经过 SSERelay，返回 (reasoning, content)"""
+    frames = [content_chunk(text) for text in chunks]
+    frames.append(frame({"id": "c", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+    frames.append(b"data: [DONE]\n\n")
+    reasoning, content = "", ""
+    for payload in decode(relay_all(frames)):
+        if payload == "[DONE]":
+            continue
+        for choice in payload["choices"]:
+            reasoning += choice["delta"].get("reasoning_content") or ""
+            content += choice["delta"].get("content") or ""
+    return reasoning, content
+
+
+def test_relay_splits_leading_thinking_across_chunks():
+    assert relay_text(["<thin", "king>pl", "an</think", "ing>answer"]) == ("plan", "answer")
+
+
+def test_relay_leaves_tags_inside_the_answer_alone():
+    chunks = ["Use the ", "<thinking>", " tag like this: ", "a</thinking>b and more"]
+    assert relay_text(chunks) == ("", "".join(chunks))
+
+
+def test_relay_forwards_answer_frames_untouched_once_content_started():
+    frames = [content_chunk("Hello "), content_chunk("<b>bold</b>")]
+    assert relay_all(frames) == b"".join(frames)
+
+
+def test_relay_flushes_unclosed_tag_before_done():
+    frames = [content_chunk("<thinking>never "), content_chunk("closed</thi"), b"data: [DONE]\n\n"]
+    payloads = decode(relay_all(frames))
+    assert payloads[-1] == "[DONE]"
+    reasoning = "".join(p["choices"][0]["delta"].get("reasoning_content") or "" for p in payloads[:-1])
+    assert reasoning == "never closed</thi"
@@ -0,0 +1,62 @@
+import pytest
+
+from message_transformer import ThinkingStreamExtractor
+
+
+def run(chunks):
+    extractor = ThinkingStreamExtractor()
+    reasoning, content = [], []
+    for chunk in chunks:
+        r, c = extractor.feed(chunk)
+        reasoning.append(r)
+        content.append(c)
+    r, c = extractor.flush()
+    return "".join(reasoning) + r, "".join(content) + c
+
+
+def split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_leading_block_is_split():
+    assert run(["<thinking>plan</thinking>answer"]) == ("plan", "answer")
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 11])
+def test_tags_split_across_chunks(size):
+    text = "<thinking>step one</thinking>The answer"
+    assert run(split_every(text, size)) == ("step one", "The answer")
+
+
+def test_leading_whitespace_before_tag_is_kept_as_content():
+    assert run(["\n ", "<think", "ing>r</thi", "nking>c"]) == ("r", "\n c")
+
+
+def test_tag_mentioned_inside_the_answer_is_not_split():
+    chunks = ["Use the ", "<thinking>", " tag like this: ", "a</thinking>b and more"]
+    assert run(chunks) == ("", "".join(chunks))
+
+
+def test_second_block_after_the_answer_is_not_split():
+    assert run(["<thinking>r</thinking>ok ", "<thinking>x</thinking>"]) == ("r", "ok <thinking>x</thinking>")
+
+
+def test_partial_open_tag_that_turns_out_to_be_text():
+    assert run(["<thi", "s is html>"]) == ("", "<this is html>")
+
+
+def test_unclosed_tag_at_end_of_stream_is_reasoning():
+    assert run(["<thinking>still ", "thinking</thin"]) == ("still thinking</thin", "")
+
+
+def test_partial_open_tag_at_end_of_stream_is_content():
+    assert run(["<think"]) == ("", "<think")
+
+
+def test_done_after_content_starts():
+    extractor = ThinkingStreamExtractor()
+    extractor.feed("  ")
+    assert not extractor.done
+    extractor.feed("Hi")
+    assert extractor.done and not extractor.active
+    assert extractor.feed("<thinking>") == ("", "<thinking>")
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from tracing import TracingMiddleware
+
+
+def run(headers, sample_rate=1.0):
+    """经过中间件执行一个两段响应体的应用，返回发出的消息"""
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": b"data: 1\n\n", "more_body": True})
+        await send({"type": "http.response.body", "body": b"data: [DONE]\n\n"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/v1/chat/completions", "headers": []}
+    asyncio.run(TracingMiddleware(app, sample_rate=sample_rate)(scope, None, send))
+    return sent
+
+
+def test_sse_response_gets_trailer():
+    sent = run([(b"content-type", b"text/event-stream; charset=utf-8")])
+    assert sent[-1]["body"].startswith(b"data: [DONE]\n\n: server-timing ")
+    assert any(name == b"server-timing" for name, _ in sent[0]["headers"])
+
+
+@pytest.mark.parametrize("headers", [
+    [(b"content-type", b"text/event-stream"), (b"content-encoding", b"gzip")],
+    [(b"Content-Type", b"text/event-stream"), (b"Content-Encoding", b"br")],
+    [(b"content-type", b"application/json")],
+    [],
+])
+def test_trailer_skipped_for_encoded_or_non_sse_responses(headers):
+    assert run(headers)[-1]["body"] == b"data: [DONE]\n\n"
+
+
+def test_tracing_is_off_by_default():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/v1/messages", "headers": []}
+    asyncio.run(TracingMiddleware(app)(scope, None, send))
+    assert sent[0]["headers"] == []
@@ -0,0 +1,116 @@
+import asyncio
+
+import httpx
+import pytest
+
+from upstream_pool import Upstream, UpstreamPool
+
+
+def test_open_connections_falls_back_without_httpcore_pool():
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(200)))
+    upstream = Upstream("http://mock", client)
+    assert upstream.open_connections() is None
+
+    async def request():
+        # 请求结束时更新连接数指标，取不到时跳过而不是报错
+        return await UpstreamPool([upstream]).request("GET", "http://mock/")
+
+    assert asyncio.run(request()).status_code == 200
+
+
+def test_open_connections_reads_default_transport_pool():
+    upstream = Upstream("http://127.0.0.1:9", httpx.AsyncClient(transport=httpx.AsyncHTTPTransport()))
+    assert upstream.open_connections() == 0
+
+
+def test_warm_sends_single_probe_to_http2_upstream():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, extensions={"http_version": b"HTTP/2"})
+
+    upstream = Upstream("http://mock", httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://mock"))
+    asyncio.run(upstream.warm(4))
+    assert len(requests) == 1
+
+
+def test_warm_opens_requested_http11_connections():
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            # 保持请求在途，让并发探测各占一条连接
+            time.sleep(0.1)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def warm():
+        client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(http2=False), base_url=url)
+        try:
+            return await Upstream(url, client).warm(3)
+        finally:
+            await client.aclose()
+
+    try:
+        assert asyncio.run(warm()) == 3
+    finally:
+        server.shutdown()
+
+
+def make_pool(first_handler):
+    """两个上游：第一个由 first_handler 处理，第二个总是返回 200；返回 (pool, 第二个上游收到的请求)"""
+    second_calls = []
+
+    def second(request):
+        second_calls.append(request)
+        return httpx.Response(200, json={"ok": True})
+
+    pool = UpstreamPool([
+        Upstream("http://a", httpx.AsyncClient(transport=httpx.MockTransport(first_handler), base_url="http://a")),
+        Upstream("http://b", httpx.AsyncClient(transport=httpx.MockTransport(second), base_url="http://b")),
+    ])
+    # 固定先选第一个上游
+    pool.select = lambda exclude=None: next(u for u in pool.upstreams if not exclude or u not in exclude)
+    return pool, second_calls
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout])
+def test_connect_phase_errors_fail_over(error):
+    def first(request):
+        raise error("down", request=request)
+
+    pool, second_calls = make_pool(first)
+    response = asyncio.run(pool.request("POST", "/chat/completions", json={}))
+    assert response.status_code == 200 and len(second_calls) == 1
+
+
+@pytest.mark.parametrize("error", [httpx.ReadTimeout, httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError])
+def test_errors_after_the_request_was_sent_are_not_retried(error):
+    def first(request):
+        raise error("broken", request=request)
+
+    pool, second_calls = make_pool(first)
+    with pytest.raises(error):
+        asyncio.run(pool.request("POST", "/chat/completions", json={}))
+    assert second_calls == []
+    assert pool.upstreams[0].outstanding == 0
+
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_gateway_errors_fail_over(status):
+    pool, second_calls = make_pool(lambda request: httpx.Response(status))
+    response = asyncio.run(pool.request("POST", "/chat/completions", json={}))
+    assert response.status_code == 200 and len(second_calls) == 1
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import warmup
+from token_counter import TokenCounter
+from warmup import WarmUp
+
+
+def make_app():
+    return SimpleNamespace(state=SimpleNamespace(token_counter=TokenCounter()))
+
+
+def test_code_paths_are_warmed_on_the_event_loop_thread(monkeypatch):
+    threads = []
+    monkeypatch.setattr(warmup, "warm_code_paths", lambda: threads.append(threading.get_ident()))
+
+    async def scenario():
+        state = WarmUp(timeout=5)
+        await state.run(make_app(), connections=0, api_key="")
+        return state
+
+    state = asyncio.run(scenario())
+    assert threads == [threading.get_ident()]
+    assert state.ready and "error" not in state.steps["code_paths"]
+
+
+def test_real_code_paths_run_without_errors():
+    warmup.warm_code_paths()
+
+
+def test_stop_waits_for_the_cancelled_warm_up(monkeypatch):
+    finished = []
+
+    async def slow_load():
+        try:
+            await asyncio.sleep(10)
+        finally:
+            finished.append(True)
+
+    async def scenario():
+        app = make_app()
+        app.state.token_counter.load = slow_load
+        state = WarmUp(timeout=30)
+        state.start(app, connections=0, api_key="")
+        await asyncio.sleep(0.01)
+        await state.stop()
+        return state
+
+    state = asyncio.run(scenario())
+    assert finished == [True]
+    assert state._task.cancelled() and not state.ready
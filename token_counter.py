@@ -0,0 +1,156 @@
+"""
+本地 token 计数：安装了 tiktoken 时使用离线 BPE 编码，否则使用按字符类别校准的估算
+
+每条消息的计数按内容哈希（与历史修复共用的 MessageHashes）缓存，多轮对话中重复的历史消息不会被重新计数。
+结果用于 count_tokens 接口和把 max_tokens 限制在模型上下文窗口之内。
+"""
+import asyncio
+import json
+import math
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from message_transformer import MessageHashes, content_digest
+
+# 每条消息的格式开销（角色、分隔符）
+MESSAGE_OVERHEAD = 4
+# 无法得知尺寸的图片按固定 token 数计
+IMAGE_TOKENS = 1600
+
+
+def estimate_text_tokens(text: str, chars_per_token: float = 3.5) -> int:
+    """
+    无分词器时的估算：ASCII 按 chars_per_token 个字符一个 token，
+    非 ASCII 字符（主要是中日韩文字）按一个字符一个 token，宁可略微高估
+    """
+    if not text:
+        return 0
+    if text.isascii():
+        return math.ceil(len(text) / chars_per_token)
+    # UTF-8 下非 ASCII 字符占 2~4 字节，用编码长度差近似其个数，避免逐字符扫描
+    non_ascii = min(len(text), (len(text.encode("utf-8")) - len(text)) // 2)
+    return math.ceil((len(text) - non_ascii) / chars_per_token) + non_ascii
+
+
+class TokenCounter:
+    """
+    请求 token 计数器
+
+    encoding 为 tiktoken 编码名，由 load() 加载（加载前及加载失败时使用估算）；
+    按消息内容哈希缓存计数结果，最多 cache_size 条。
+    """
+
+    def __init__(self, encoding: str = "o200k_base", chars_per_token: float = 3.5, cache_size: int = 4096):
+        self.encoding = encoding
+        self.chars_per_token = chars_per_token
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._encode: Optional[Callable[[str], List[int]]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _load_encoder(self) -> Optional[Callable[[str], List[int]]]:
+        try:
+            # 延迟导入：tiktoken 的导入和 BPE 文件读取较慢，不放在 worker 启动路径上
+            import tiktoken
+        except ImportError:  # pragma: no cover - 可选依赖
+            return None
+        try:
+            encoder = tiktoken.get_encoding(self.encoding)
+        except Exception as e:  # 编码文件需要下载，离线环境可能失败
+            print(f"[Proxy] tiktoken encoding {self.encoding} unavailable ({e}), using estimates")
+            return None
+        return lambda text: encoder.encode(text, disallowed_special=())
+
+    async def load(self) -> None:
+        """在线程中加载 tiktoken 编码，成功后切换到分词器计数并清空估算结果的缓存"""
+        encode = await asyncio.to_thread(self._load_encoder)
+        if encode is not None:
+            self._encode = encode
+            self._cache.clear()
+
+    @property
+    def method(self) -> str:
+        return "tiktoken" if self._encode is not None else "estimate"
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encode is not None:
+            return len(self._encode(text))
+        return estimate_text_tokens(text, self.chars_per_token)
+
+    def _count_value(self, value: Any) -> int:
+        """工具参数、schema 等结构化内容按紧凑 JSON 计数"""
+        if isinstance(value, str):
+            return self.count_text(value)
+        return self.count_text(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+
+    def _count_content(self, content: Any) -> int:
+        """OpenAI / Anthropic 两种格式的 content（字符串或 content block 数组）"""
+        if isinstance(content, str):
+            return self.count_text(content)
+        if not isinstance(content, list):
+            return 0
+        total = 0
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            part_type = part.get("type")
+            if part_type == "text":
+                total += self.count_text(part.get("text", ""))
+            elif part_type == "thinking":
+                total += self.count_text(part.get("thinking", ""))
+            elif part_type in ("image", "image_url"):
+                total += IMAGE_TOKENS
+            elif part_type == "tool_use":
+                total += self.count_text(part.get("name", "")) + self._count_value(part.get("input") or {})
+            elif part_type == "tool_result":
+                total += self._count_content(part.get("content", ""))
+            else:
+                total += self._count_value(part)
+        return total
+
+    def _count_message_uncached(self, msg: Dict[str, Any]) -> int:
+        total = MESSAGE_OVERHEAD + self._count_content(msg.get("content"))
+        reasoning = msg.get("reasoning_content")
+        if isinstance(reasoning, str):
+            total += self.count_text(reasoning)
+        for call in msg.get("tool_calls") or []:
+            function = call.get("function") or {}
+            total += self.count_text(function.get("name", "")) + self.count_text(function.get("arguments", ""))
+        return total
+
+    def count_message(self, msg: Any, digest: Optional[bytes] = None) -> int:
+        """digest 为消息的内容摘要（来自 MessageHashes），省略时现算"""
+        if not isinstance(msg, dict):
+            return MESSAGE_OVERHEAD
+        key = digest if digest is not None else content_digest(msg)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        count = self._count_message_uncached(msg)
+        self._cache[key] = count
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return count
+
+    def count_system(self, system: Any) -> int:
+        return MESSAGE_OVERHEAD + self._count_content(system) if system else 0
+
+    def count_tools(self, tools: Any) -> int:
+        return self._count_value(tools) if tools else 0
+
+    def count_request(self, body: Dict[str, Any], hashes: Optional[MessageHashes] = None) -> int:
+        """估算请求的输入 token 数（system、messages、tools）；hashes 为本次请求共用的消息哈希表"""
+        if hashes is None:
+            hashes = MessageHashes(body)
+        total = sum(self.count_message(msg, hashes.get(msg)) for msg in body.get("messages") or [])
+        return total + self.count_system(body.get("system")) + self.count_tools(body.get("tools"))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"method": self.method, "hits": self.hits, "misses": self.misses}
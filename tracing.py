@@ -0,0 +1,208 @@
+"""
+请求级追踪：按阶段计时，通过 Server-Timing 响应头返回，并保留每个时间窗口内最慢的请求
+
+阶段包括请求体解析、消息修复、准入排队、连接池获取 / 建连、上游首字节和流式转发。
+未被采样的请求不创建 Trace，各埋点只做一次 ContextVar 读取。
+"""
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+# 追踪的路由
+TRACED_ROUTES = frozenset({"/v1/chat/completions", "/v1/messages"})
+TRACE_ID_HEADER = b"x-trace-id"
+
+# httpcore trace 扩展的事件 -> 阶段名
+_HTTPCORE_SPANS = {
+    "connect_tcp": "connect",
+    "start_tls": "tls",
+    "receive_response_headers": "upstream",
+}
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """单个请求的追踪：阶段名 -> 累计耗时（秒），同名阶段多次出现时累加"""
+
+    __slots__ = ("trace_id", "route", "started", "spans", "_marks", "_pool_started")
+
+    def __init__(self, trace_id: str, route: str):
+        self.trace_id = trace_id
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self._marks: Dict[str, float] = {}
+        self._pool_started: Optional[float] = None
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def begin_upstream(self) -> None:
+        """上游请求开始发送；到 httpcore 的第一个事件为止计为连接池获取"""
+        self._pool_started = time.perf_counter()
+
+    async def httpcore_event(self, name: str, info: Dict[str, Any]) -> None:
+        """httpx 请求的 trace 扩展回调"""
+        now = time.perf_counter()
+        if self._pool_started is not None:
+            self.add("pool", now - self._pool_started)
+            self._pool_started = None
+        # 事件名形如 "http2.receive_response_headers.started"
+        step, _, phase = name.rpartition(".")
+        if phase == "started":
+            self._marks[step] = now
+            return
+        began = self._marks.pop(step, None)
+        span = _HTTPCORE_SPANS.get(step.partition(".")[2])
+        if began is not None and span is not None and phase == "complete":
+            self.add(span, now - began)
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.spans.items()]
+        if total is not None:
+            parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """记录代码块耗时到当前追踪（未采样时只有一次 ContextVar 读取）"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+class SlowRequestLog:
+    """
+    慢请求记录：每 interval 秒一个时间窗口，保留窗口内最慢的 size 个请求，
+    最多保留最近 intervals 个窗口（环形缓冲）
+    """
+
+    def __init__(self, size: int = 10, interval: float = 60.0, intervals: int = 60):
+        self.size = size
+        self.interval = interval
+        self._window_start = time.time()
+        self._current: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._history: Deque[Dict[str, Any]] = deque(maxlen=intervals)
+        self._sequence = itertools.count()
+
+    def _roll(self) -> None:
+        now = time.time()
+        if now - self._window_start < self.interval:
+            return
+        if self._current:
+            self._history.append(self._window(self._window_start, self._current))
+        self._current = []
+        self._window_start = now - (now - self._window_start) % self.interval
+
+    @staticmethod
+    def _window(start: float, heap: List[Tuple[float, int, Dict[str, Any]]]) -> Dict[str, Any]:
+        return {
+            "window_start": round(start, 3),
+            "requests": [entry for _, _, entry in sorted(heap, key=lambda item: -item[0])],
+        }
+
+    def record(self, total: float, entry: Dict[str, Any]) -> None:
+        self._roll()
+        item = (total, next(self._sequence), entry)
+        if len(self._current) < self.size:
+            heapq.heappush(self._current, item)
+        elif total > self._current[0][0]:
+            heapq.heapreplace(self._current, item)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """最近的窗口在前"""
+        self._roll()
+        windows = [self._window(self._window_start, self._current)] if self._current else []
+        return windows + list(reversed(self._history))
+
+
+class TracingMiddleware:
+    """
+    ASGI 中间件：按采样率为请求创建 Trace
+
+    响应头中加入 X-Trace-Id 和截至响应开始时的 Server-Timing；
+    未压缩的 SSE 响应在结束前追加一行包含完整耗时（含流式转发）的注释帧 ": server-timing ..."。
+    请求结束后写入慢请求记录。
+    """
+
+    def __init__(self, app: Any, sample_rate: float = 0.0, slow_log: Optional[SlowRequestLog] = None):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_log = slow_log
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope.get("path") not in TRACED_ROUTES \
+                or self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or ()).get(TRACE_ID_HEADER, b"").decode("latin-1")
+        if not (incoming.isascii() and incoming.isprintable()):
+            incoming = ""
+        trace = Trace(incoming[:64] or uuid4().hex, scope["path"])
+        token = _current.set(trace)
+        status = 0
+        is_sse = False
+        response_started = 0.0
+
+        async def traced_send(message: dict) -> None:
+            nonlocal status, is_sse, response_started
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_started = trace.elapsed()
+                headers = list(message.get("headers") or [])
+                # 只给未压缩的 SSE 响应追加注释帧：压缩的响应体中拼接明文会损坏数据
+                content_type = b""
+                encoded = False
+                for name, value in headers:
+                    name = name.lower()
+                    if name == b"content-type":
+                        content_type = value
+                    elif name == b"content-encoding" and value.strip().lower() != b"identity":
+                        encoded = True
+                is_sse = content_type.startswith(b"text/event-stream") and not encoded
+                headers.append((TRACE_ID_HEADER, trace.trace_id.encode()))
+                headers.append((b"server-timing", trace.server_timing(response_started).encode()))
+                message = dict(message, headers=headers)
+            elif message["type"] == "http.response.body" and is_sse and not message.get("more_body"):
+                total = trace.elapsed()
+                trace.add("relay", total - response_started)
+                comment = b": server-timing " + trace.server_timing(total).encode() + b"\n\n"
+                message = dict(message, body=message.get("body", b"") + comment)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            _current.reset(token)
+            total = trace.elapsed()
+            if self.slow_log is not None:
+                self.slow_log.record(total, {
+                    "trace_id": trace.trace_id,
+                    "route": trace.route,
+                    "status": status,
+                    "at": round(time.time(), 3),
+                    "total_ms": round(total * 1000, 2),
+                    "spans_ms": {name: round(seconds * 1000, 2) for name, seconds in trace.spans.items()},
+                })
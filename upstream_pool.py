@@ -0,0 +1,313 @@
+"""
+上游连接池：多上游负载均衡、被动健康检查与故障转移
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from admission import AdaptiveLimit
+from metrics import (
+    UPSTREAM_CONCURRENCY_LIMIT,
+    UPSTREAM_CONNECTIONS,
+    UPSTREAM_OUTSTANDING,
+    UPSTREAM_RESPONSES_TOTAL,
+)
+from tracing import current_trace
+
+# 视为上游故障、可以换一个上游重试的状态码
+RETRYABLE_STATUS_CODES = frozenset({502, 503, 504})
+# 可以换一个上游重试的传输错误：都发生在请求发出之前。
+# 请求发出后的错误（读超时、协议错误等）上游可能已经开始生成，重试会重复计费和重复执行副作用
+FAILOVER_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# 视为上游过载、需要收缩并发上限的状态码
+THROTTLE_STATUS_CODES = frozenset({429, 503})
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """包装响应体流，关闭时通知上游释放 outstanding 计数"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, upstream: "Upstream"):
+        self._stream = stream
+        self._upstream = upstream
+        self._released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._upstream.release()
+
+
+class Upstream:
+    """
+    单个上游端点及其独立的 httpx 客户端
+
+    记录在途请求数、首字节延迟的 EWMA 和连续失败次数，
+    连续失败达到阈值后熔断一段时间，冷却结束后放行一个探测请求。
+    limit 为准入控制使用的自适应并发上限。
+    """
+
+    def __init__(
+        self,
+        url: str,
+        client: httpx.AsyncClient,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        ewma_decay: float = 0.3,
+        limit: Optional[AdaptiveLimit] = None
+    ):
+        self.url = url
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_decay = ewma_decay
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._probing = False
+        self.limit = limit or AdaptiveLimit()
+
+    @property
+    def available(self) -> bool:
+        """熔断关闭，或冷却结束且没有正在进行的探测请求"""
+        if self.consecutive_failures < self.failure_threshold:
+            return True
+        return time.monotonic() >= self.open_until and not self._probing
+
+    def begin(self) -> None:
+        self.outstanding += 1
+        UPSTREAM_OUTSTANDING.labels(self.url).inc()
+        if self.consecutive_failures >= self.failure_threshold:
+            self._probing = True
+
+    def release(self) -> None:
+        """请求结束（响应体已读完或已关闭）"""
+        self.outstanding -= 1
+        UPSTREAM_OUTSTANDING.labels(self.url).dec()
+        self._observe_connections()
+
+    def cancel(self) -> None:
+        """请求被取消，不计入成功或失败"""
+        self.release()
+        self._probing = False
+
+    def open_connections(self) -> Optional[int]:
+        """
+        连接池中当前打开的连接数
+
+        httpx 没有公开连接池，需要读取 AsyncHTTPTransport._pool（httpcore 连接池）；
+        传输层不是 httpx 默认实现或版本变化导致属性缺失时返回 None。
+        """
+        try:
+            return len(self.client._transport._pool.connections)
+        except (AttributeError, TypeError):
+            return None
+
+    def _observe_connections(self) -> None:
+        connections = self.open_connections()
+        if connections is not None:
+            UPSTREAM_CONNECTIONS.labels(self.url).set(connections)
+
+    async def warm(self, connections: int) -> Optional[int]:
+        """
+        预先完成 TCP、TLS、代理 CONNECT 和 HTTP/2 握手，返回连接池中实际打开的连接数；
+        响应状态码无关紧要，不计入熔断和并发上限
+
+        先单独发一个 HEAD 请求建立第一条连接：httpcore 在 HTTP/2 连接握手期间就把它视为可用，
+        并发的探测请求会全部复用这一条连接，多发并不会多建连接；协商为 HTTP/2 时一条连接即可承载所有请求。
+        HTTP/1.1 下再并发发出 connections 个请求，每个请求各占一条连接。
+        """
+        async def probe() -> Optional[str]:
+            try:
+                response = await self.client.request("HEAD", "/")
+            except httpx.HTTPError as e:
+                print(f"[Proxy] Warm-up of {self.url} failed: {e!r}")
+                return None
+            return response.http_version
+
+        http_version = await probe()
+        if http_version == "HTTP/1.1" and connections > 1:
+            await asyncio.gather(*(probe() for _ in range(connections)))
+        self._observe_connections()
+        opened = self.open_connections()
+        print(f"[Proxy] Warmed {self.url}: {opened if opened is not None else '?'} connection(s) open ({http_version})")
+        return opened
+
+    def record_success(self, latency: float) -> None:
+        if self.ewma_latency:
+            self.ewma_latency += self.ewma_decay * (latency - self.ewma_latency)
+        else:
+            self.ewma_latency = latency
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def record_limit(self, status_code: Optional[int], latency: Optional[float]) -> None:
+        """根据响应更新自适应并发上限；status_code 为 None 表示超时"""
+        if status_code is None or status_code in THROTTLE_STATUS_CODES:
+            self.limit.on_throttle()
+        elif status_code < 500:
+            self.limit.on_sample(latency)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(self.url).set(self.limit.current)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            print(f"[Proxy] Upstream {self.url} circuit open for {self.cooldown:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma_latency, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "available": self.available,
+            "concurrency_limit": self.limit.current,
+        }
+
+
+class UpstreamPool:
+    """
+    多上游的负载均衡与故障转移
+
+    balancer 为 "least_outstanding"（在途请求最少）或 "ewma"（EWMA 延迟 × 在途请求数）。
+    连接失败或返回 502/503/504 且尚未向客户端发送任何数据时，自动换一个上游重试。
+    """
+
+    def __init__(self, upstreams: List[Upstream], balancer: str = "least_outstanding"):
+        if not upstreams:
+            raise ValueError("at least one upstream is required")
+        self.upstreams = upstreams
+        self.balancer = balancer
+
+    @classmethod
+    def from_config(
+        cls,
+        upstream_configs: List[Dict[str, Any]],
+        timeout: float,
+        balancer: str = "least_outstanding",
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        concurrency: Optional[Dict[str, float]] = None
+    ) -> "UpstreamPool":
+        """按配置为每个上游创建独立的客户端和连接池；concurrency 为 AdaptiveLimit 的参数"""
+        upstreams = []
+        for conf in upstream_configs:
+            limits = httpx.Limits(
+                max_connections=conf.get("max_connections", 100),
+                max_keepalive_connections=conf.get("max_keepalive_connections", 20),
+                keepalive_expiry=conf.get("keepalive_expiry", 30.0)
+            )
+            http2 = conf.get("http2", True)
+            transport = httpx.AsyncHTTPTransport(
+                proxy=conf.get("proxy"),
+                http2=http2,
+                limits=limits
+            )
+            client = httpx.AsyncClient(
+                base_url=conf["url"],
+                timeout=httpx.Timeout(timeout, connect=conf.get("connect_timeout", 10.0)),
+                transport=transport
+            )
+            upstreams.append(Upstream(
+                conf["url"],
+                client,
+                failure_threshold=failure_threshold,
+                cooldown=cooldown,
+                limit=AdaptiveLimit(**(concurrency or {}))
+            ))
+        return cls(upstreams, balancer=balancer)
+
+    def select(self, exclude: Optional[List[Upstream]] = None) -> Optional[Upstream]:
+        candidates = [u for u in self.upstreams if not exclude or u not in exclude]
+        if not candidates:
+            return None
+        healthy = [u for u in candidates if u.available]
+        if not healthy:
+            # 全部熔断时选择最早恢复的上游
+            return min(candidates, key=lambda u: u.open_until)
+
+        if self.balancer == "ewma":
+            return min(healthy, key=lambda u: (u.ewma_latency or 0.001) * (u.outstanding + 1))
+        return min(healthy, key=lambda u: (u.outstanding, u.ewma_latency))
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """发送非流式请求（响应体已读取完毕）"""
+        return await self._send(method, path, stream=False, **kwargs)
+
+    async def send_stream(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """发送流式请求，返回已收到响应头的响应，调用方负责 aclose()"""
+        return await self._send(method, path, stream=True, **kwargs)
+
+    async def _send(self, method: str, path: str, stream: bool, **kwargs) -> httpx.Response:
+        tried: List[Upstream] = []
+        while True:
+            upstream = self.select(exclude=tried)
+            tried.append(upstream)
+            is_last = len(tried) >= len(self.upstreams)
+
+            upstream.begin()
+            start = time.monotonic()
+            trace = current_trace()
+            if trace is not None:
+                # 被采样的请求通过 httpcore 的 trace 扩展记录连接池获取、建连和上游首字节
+                trace.begin_upstream()
+                kwargs["extensions"] = dict(kwargs.get("extensions") or {}, trace=trace.httpcore_event)
+            try:
+                upstream_request = upstream.client.build_request(method, path, **kwargs)
+                response = await upstream.client.send(upstream_request, stream=stream)
+            except httpx.TransportError as e:
+                UPSTREAM_RESPONSES_TOTAL.labels(path, "error").inc()
+                if isinstance(e, httpx.TimeoutException):
+                    upstream.record_limit(None, None)
+                upstream.release()
+                upstream.record_failure()
+                if is_last or not isinstance(e, FAILOVER_ERRORS):
+                    raise
+                print(f"[Proxy] Upstream {upstream.url} failed to connect ({e!r}), failing over")
+                continue
+            except BaseException:
+                upstream.cancel()
+                raise
+
+            UPSTREAM_RESPONSES_TOTAL.labels(path, str(response.status_code)).inc()
+            latency = time.monotonic() - start
+            # 流式请求在收到响应头时返回，延迟近似首字节延迟；非流式请求的耗时随输出长度变化，不作为信号
+            upstream.record_limit(response.status_code, latency if stream else None)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                upstream.record_failure()
+                if not is_last:
+                    await response.aclose()
+                    upstream.release()
+                    print(f"[Proxy] Upstream {upstream.url} returned {response.status_code}, failing over")
+                    continue
+            else:
+                upstream.record_success(latency)
+
+            if stream and not response.is_closed:
+                response.stream = _TrackedStream(response.stream, upstream)
+            else:
+                upstream.release()
+            return response
+
+    async def warm(self, connections: int) -> Dict[str, Optional[int]]:
+        """为每个上游预先建立连接，返回 {url: 打开的连接数}"""
+        opened = await asyncio.gather(*(upstream.warm(connections) for upstream in self.upstreams))
+        return {upstream.url: count for upstream, count in zip(self.upstreams, opened)}
+
+    async def aclose(self) -> None:
+        for upstream in self.upstreams:
+            await upstream.client.aclose()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [upstream.stats() for upstream in self.upstreams]
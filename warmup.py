@@ -0,0 +1,130 @@
+"""
+启动预热：在 worker 报告就绪之前完成连接建立、模型列表预取、分词器加载和热路径的首次执行
+
+滚动重启后每个 worker 接到的前几个请求原本要承担 TCP / TLS / 代理 CONNECT / HTTP/2 握手，
+以及首次执行各代码路径的开销。预热在后台进行，完成前 /health 返回 503，
+负载均衡据此只把流量发给已就绪的 worker；预热期间到达的请求照常处理。
+"""
+import asyncio
+import contextlib
+import json
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from anthropic_adapter import AnthropicStreamTranslator
+from message_transformer import ReasoningContentTransformer
+from raw_body import RawJSONBody
+from stream_aggregator import AnthropicStreamAggregator, OpenAIStreamAggregator
+from stream_relay import SSERelay
+
+# 覆盖 thinking 标签拆分、工具调用和跨帧缓冲的示例请求与响应
+_SAMPLE_MESSAGES = [
+    {"role": "user", "content": "hi"},
+    {"role": "assistant", "content": "<thinking>plan</thinking>ok", "tool_calls": [
+        {"id": "call_0", "type": "function", "function": {"name": "f", "arguments": "{}"}},
+    ]},
+    {"role": "tool", "tool_call_id": "call_0", "content": "done"},
+]
+_SAMPLE_STREAM = b"".join(
+    b"data: " + json.dumps(chunk).encode() + b"\n\n"
+    for chunk in (
+        {"id": "c", "choices": [{"index": 0, "delta": {"role": "assistant", "content": "<thin"}}]},
+        {"id": "c", "choices": [{"index": 0, "delta": {"content": "king>a</thinking>b"}}]},
+        {"id": "c", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+         "usage": {"prompt_tokens": 1, "completion_tokens": 1}},
+    )
+) + b"data: [DONE]\n\n"
+
+
+def warm_code_paths() -> None:
+    """用示例数据执行一遍请求修复、请求体拼接和各流转换器"""
+    body = RawJSONBody(json.dumps({"model": "warmup", "messages": _SAMPLE_MESSAGES}).encode())
+    body["messages"] = ReasoningContentTransformer.fix_messages(body["messages"])
+    body.to_bytes()
+    ReasoningContentTransformer.fix_anthropic_message(
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "t", "name": "f", "input": {}}]}
+    )
+
+    for relay in (SSERelay(), AnthropicStreamTranslator("warmup")):
+        relay.feed(_SAMPLE_STREAM)
+        relay.flush()
+    for aggregator in (OpenAIStreamAggregator(), AnthropicStreamAggregator()):
+        aggregator.feed(_SAMPLE_STREAM)
+        aggregator.flush()
+        aggregator.result()
+
+
+async def _warm_code_paths_inline() -> None:
+    # 直接在事件循环线程上执行（只需几毫秒）：请求都在这里处理，放到线程池里执行预热不到事件循环这一侧
+    warm_code_paths()
+
+
+class WarmUp:
+    """
+    预热状态（每个 worker 一个实例）
+
+    各步骤并发执行、互不影响，单步失败只记录不阻止就绪；
+    整体超过 timeout 秒时放弃未完成的步骤直接进入就绪状态。
+    """
+
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self.ready = False
+        self.duration: Optional[float] = None
+        self.steps: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, app: Any, connections: int, api_key: str) -> None:
+        self._task = asyncio.create_task(self.run(app, connections, api_key))
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _step(self, name: str, awaitable: Awaitable[Any]) -> None:
+        started = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception as e:
+            self.steps[name] = {"error": repr(e)}
+            print(f"[Proxy] Warm-up step {name} failed: {e!r}")
+            return
+        self.steps[name] = {"seconds": round(time.perf_counter() - started, 4), "result": result}
+
+    async def run(self, app: Any, connections: int, api_key: str) -> None:
+        started = time.perf_counter()
+        steps = [
+            self._step("tokenizer", app.state.token_counter.load()),
+            self._step("code_paths", _warm_code_paths_inline()),
+        ]
+        if connections > 0:
+            steps.append(self._step("connections", app.state.upstreams.warm(connections)))
+        if api_key:
+            steps.append(self._step("models", prefetch_models(app, f"Bearer {api_key}")))
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*steps), self.timeout)
+        except asyncio.TimeoutError:
+            print(f"[Proxy] Warm-up timed out after {self.timeout:.0f}s, marking ready")
+            self.steps["timed_out"] = True
+        self.duration = round(time.perf_counter() - started, 4)
+        self.ready = True
+        print(f"[Proxy] Warm-up finished in {self.duration:.2f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "seconds": self.duration, "steps": self.steps}
+
+
+async def prefetch_models(app: Any, authorization: str) -> int:
+    """用配置的凭证预取 /models 并写入模型列表缓存，返回上游状态码"""
+    response = await app.state.upstreams.request("GET", "/models", headers={"Authorization": authorization})
+    if response.status_code == 200:
+        app.state.models_cache.set(
+            app.state.models_cache.make_key("/models", {}, authorization),
+            response.content,
+            200,
+            "application/json"
+        )
+    return response.status_code